@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+'''Time and memory-profile each stage of the pipeline
+
+   Runs XML extraction, lemmatization, sampling, TF-IDF, PCA, trial
+   loading and test-passage plotting in-process, on the real corpus or on
+   a synthetic one, and writes wall time, CPU time and peak memory for
+   each stage to JSON. Everything runs offline, in a scratch directory.
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Config, Text, FeatureStore, Stage, Metrics, saveJson
+from mta_summer_2018 import loadScript, addMetricsArgs, startMetrics
+
+#
+# global values
+#
+
+BIN = os.path.dirname(os.path.realpath(__file__))
+
+# stages of sample.runTrial() recorded separately
+TRIAL_STEPS = ('sample', 'tfidf', 'hashed_tfidf', 'pca', 'streamed_pca', 'save')
+
+#
+# functions
+#
+
+class Measure(Stage):
+    '''A Stage that also traces Python allocations and keeps its record in RESULTS
+
+    Given STEPS, the names of stages nested inside it, e.g. those of
+    sample.runTrial(), each of their records is kept in RESULTS under its
+    own name instead of this stage's combined one.
+    '''
+
+    def __init__(self, name, results, steps=None):
+        super(Measure, self).__init__(name, trace=True)
+        self.results = results
+        self.steps = steps
+
+
+    def __enter__(self):
+        if self.steps is not None:
+            Metrics.TRACE = True
+            Metrics.RECORDS = []
+
+        return super(Measure, self).__enter__()
+
+
+    def __exit__(self, exc_type, exc, tb):
+        super(Measure, self).__exit__(exc_type, exc, tb)
+
+        if self.steps is None:
+            self.results.append(self.record)
+            return
+
+        for rec in Metrics.RECORDS:
+            step = rec['stage'].split('/')[-1]
+            if step in self.steps:
+                self.results.append(dict(rec, stage=step))
+        Metrics.TRACE = False
+        Metrics.RECORDS = None
+
+
+def gitVersion():
+    '''Current commit, if we're in a git checkout'''
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BIN,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmark(xml_root, index, bench_file, work, size=30, step=None,
+                 feature='lemmata', lemmatizer='cltk', use_sparse=False):
+    '''Run every stage on the texts in INDEX; return a list of measurements
+
+    Each stage calls the functions the scripts themselves run. LEMMATIZER
+    "whitespace" stands in lowercased whitespace tokens for lemmata; a
+    "cltk" or "table" backend that can't be loaded is an error.
+    '''
+
+    # render off-screen; must precede the first pyplot import
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    extract = loadScript('extract_texts', 'setup_2.extract_texts.py')
+    lemmatize = loadScript('lemmatize', 'lemmatize.py')
+    sample = loadScript('sample', 'sample.py')
+    plot = loadScript('plot', 'plot.py')
+
+    # lemmatize.py loads the CLTK models, or the lemma table, in initTools()
+    if lemmatizer == 'table':
+        lemmatize.initTools(backend='table',
+                            lookup=os.path.join(Config.DATA, 'lemma_lookup'))
+    elif lemmatizer == 'cltk':
+        lemmatize.initTools()
+
+    import gensim
+
+    # all outputs go to the scratch directory
+    Config.DATA = work
+    Config.INDEX = index
+    results = []
+
+    with open(index) as f:
+        corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
+
+    # XML extraction, as in setup_2.extract_texts.py
+    source = os.path.join(work, 'lines')
+    os.makedirs(source)
+    with Measure('extract', results) as stage:
+        n = 0
+        for text in corpus:
+            n += extract.extractText(os.path.join(xml_root, text.author),
+                                     os.path.join(source, text.author + '.json'))
+        stage.items['lines'] = n
+
+    # lemmatization, dictionary and feature store, as in lemmatize.py
+    # run with a single process
+    dest = os.path.join(work, feature)
+    os.makedirs(os.path.join(dest, 'partial'))
+    chunk = 500 if lemmatizer == 'cltk' else None
+    with Measure('lemmatize', results) as stage:
+        n = 0
+        tokens = 0
+        manifest = dict()
+        dictionary = gensim.corpora.Dictionary()
+        store = FeatureStore.create(os.path.join(dest, 'store'))
+        for text in corpus:
+            if lemmatizer == 'whitespace':
+                lemmatized = whitespaceTokens(text, source, dest, lemmatize.whiteTok)
+            else:
+                lemmatized = lemmatize.lemmatizeText(text, source, dest, manifest,
+                                                     None, chunk, lemmatizer)
+                lemmatize.TOOLS['cache'].drain()
+            store.addText(text.author, lemmatized, text.loci)
+            dictionary.add_documents(lemmatized)
+            n += len(lemmatized)
+            tokens += sum(len(l) for l in lemmatized)
+        dict_file = os.path.join(dest, 'gensim.dict')
+        dictionary.filter_extremes(no_below = 5)
+        dictionary.save(dict_file)
+        store.finish(dictionary, dict_file)
+        stage.items.update({'lines': n, 'tokens': tokens})
+
+    # sampling, TF-IDF and PCA, as in sample.py, each step measured on its own
+    with Measure('load_corpus', results) as stage:
+        corpus = sample.loadCorpus(feature, dictionary)
+        stage.items['lines'] = sum(len(text.loci) for text in corpus)
+
+    with Measure('trial', results, steps=TRIAL_STEPS):
+        label, n = sample.runTrial(corpus, dictionary, feature, size, step, 0,
+                                   use_sparse=use_sparse, quiet=True)
+
+    # trial load, from a cold start of the Trial class
+    with Measure('trial_load', results) as stage:
+        trial = plot.Trial(label)
+        stage.items['samples'] = len(trial.authors)
+
+    with Measure('test_passages', results) as stage:
+        fig = trial.plotTestPassages(bench_file)
+        pyplot.close(fig)
+        with open(bench_file) as f:
+            stage.items['passages'] = sum(1 for l in f if l.strip())
+
+    return results
+
+
+def whitespaceTokens(text, source, dest, whiteTok):
+    '''Lowercased whitespace tokens of one text, saved where its lemmata would be'''
+
+    text.dataFromJson(os.path.join(source, text.author + '.json'))
+    tokens = [[t for t in (whiteTok(w) for w in l.lower().split()) if t]
+              for l in text.lines]
+    saveJson(tokens, os.path.join(dest, text.author + '.json'), indent=1)
+
+    return tokens
+
+
+def compareResults(old, new):
+    '''Print per-stage ratios of NEW to OLD
+
+    Runs with different lemmatizers time different work, so they are
+    not compared.
+    '''
+
+    backends = [r['params'].get('lemmatizer', 'cltk') for r in (old, new)]
+    if backends[0] != backends[1]:
+        print('Not comparing: old run used the {} lemmatizer, new run {}'.format(*backends))
+        return False
+
+    before = {r['stage']: r for r in old['stages']}
+
+    print('{:<15} {:>10} {:>10} {:>8} {:>10}'.format(
+        'stage', 'old wall', 'new wall', 'ratio', 'mem ratio'))
+    for r in new['stages']:
+        b = before.get(r['stage'])
+        if b is None:
+            continue
+        ratio = r['wall'] / b['wall'] if b['wall'] else float('nan')
+        mem = r['peak_alloc_mb'] / b['peak_alloc_mb'] if b['peak_alloc_mb'] else float('nan')
+        print('{:<15} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.2f}'.format(
+            r['stage'], b['wall'], r['wall'], ratio, mem))
+
+    return True
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage on the real or a synthetic corpus'
+    )
+    parser.add_argument('--synthetic',
+        metavar='X', type=float, default=None,
+        help='use a synthetic corpus X times the size of the real one, '
+             'e.g. 1, 10 or 100; default: the real corpus')
+    parser.add_argument('--bench',
+        metavar='FILE', type=str, default=os.path.join('conf', 'bench', 'battles.txt'),
+        help='test passages to plot, for the real corpus')
+    parser.add_argument('--size',
+        metavar='SIZE', type=int, default=30,
+        help='sample size in lines; default 30')
+    parser.add_argument('--step',
+        metavar='STEP', type=int, default=None,
+        help='window step; default SIZE')
+    parser.add_argument('--sparse',
+        action='store_true',
+        help='benchmark the sparse TF-IDF / truncated SVD path')
+    parser.add_argument('--lemmatizer',
+        metavar='NAME', type=str, default='cltk', choices=['cltk', 'table', 'whitespace'],
+        help='"cltk", "table" (lemmatize.py --backend table, using '
+             'DATA/lemma_lookup), or "whitespace" to time lowercased '
+             'whitespace tokens instead of lemmatization; default cltk')
+    parser.add_argument('--work',
+        metavar='DIR', type=str, default=os.path.join('data', 'bench', 'work'),
+        help='scratch directory, emptied first; default data/bench/work')
+    parser.add_argument('--out',
+        metavar='FILE', type=str, default=None,
+        help='results file; default data/bench/LABEL-TIMESTAMP.json')
+    parser.add_argument('--compare',
+        metavar='FILE', type=str, default=None,
+        help='earlier results file to compare against')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    # paths are resolved before Config is pointed at the scratch directory
+    work = os.path.abspath(args.work)
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+
+    if args.synthetic is None:
+        label = 'real'
+        xml_root = os.path.abspath(os.path.join(Config.DATA, 'xml'))
+        index = os.path.abspath(Config.INDEX)
+        bench_file = os.path.abspath(args.bench)
+    else:
+        label = 'synth-{:g}x'.format(args.synthetic)
+        synth = loadScript('synth_corpus', 'synth_corpus.py')
+        synth_dir = os.path.join(work, 'synth')
+        synth.makeCorpus(synth_dir, args.synthetic)
+        xml_root = os.path.join(synth_dir, 'xml')
+        index = os.path.join(synth_dir, 'corpus.json')
+        bench_file = os.path.join(synth_dir, 'bench.txt')
+
+    if args.out is None:
+        args.out = os.path.join('data', 'bench', '{}-{}.json'.format(
+            label, time.strftime('%Y%m%d-%H%M%S')))
+    out = os.path.abspath(args.out)
+
+    stages = runBenchmark(xml_root, index, bench_file, os.path.join(work, 'data'),
+                          args.size, args.step, lemmatizer=args.lemmatizer,
+                          use_sparse=args.sparse)
+
+    results = {
+        'corpus': label,
+        'commit': gitVersion(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'params': {'size': args.size, 'step': args.step, 'sparse': args.sparse,
+                   'lemmatizer': args.lemmatizer},
+        'stages': stages,
+    }
+
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Wrote {}'.format(out))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            if not compareResults(json.load(f), results):
+                sys.exit(1)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+''' Score how well trials separate the labelled bench passages
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Stage, findTrials, loadTrialArray
+from mta_summer_2018 import addMetricsArgs, startMetrics
+from plot import Trial
+
+import numpy as np
+from scipy import sparse
+
+#
+# global values
+#
+
+METRICS = ['knn', 'silhouette', 'centroid']
+
+# rows of the distance matrix computed at once
+BLOCK = 1000
+
+#
+# functions
+#
+
+def readBench(files, strict=False):
+    '''Labelled passages from bench files, as (author, start, stop, tag)
+
+    Tags marked uncertain with a trailing "?" count as the tag itself,
+    or, if STRICT, are left out.
+    '''
+
+    rows = []
+    for file in files:
+        with open(file) as f:
+            for l in f:
+                if l.strip() == '':
+                    continue
+                # tab-separated; tags may contain spaces, e.g. "Tempête ?"
+                auth, loc_start, loc_stop, tag = l.strip().split(None, 3)
+                if tag.endswith('?'):
+                    if strict:
+                        continue
+                    tag = tag.rstrip('?').strip()
+                rows.append((auth, loc_start, loc_stop, tag))
+
+    return rows
+
+
+def labelSamples(trial, rows):
+    '''Sample ids, label codes and bench row of every labelled sample
+
+    Each passage is expanded to all the samples it spans, without a
+    Python loop over samples. A sample labelled twice the same way
+    (e.g. by overlapping passages) is kept once.
+    '''
+
+    first, last = trial.resolvePassages(rows)
+    found = first >= 0
+
+    tags = sorted(set(r[3] for r in rows))
+    codes = np.array([tags.index(r[3]) for r in rows])
+
+    lengths = (last - first + 1)[found]
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ids = np.repeat(first[found], lengths) + np.arange(lengths.sum()) - starts
+    labels = np.repeat(codes[found], lengths)
+    groups = np.repeat(np.flatnonzero(found), lengths)
+
+    _, keep = np.unique(np.stack([ids, labels]), axis=1, return_index=True)
+    keep.sort()
+
+    return ids[keep], labels[keep], groups[keep], tags, int(found.sum())
+
+
+def scoreSamples(x, labels, groups, k=5):
+    '''Separation of labelled vectors X, as a dict of scores
+
+    knn: share of each sample's K nearest neighbours, from other bench
+      passages, that carry its label, averaged over samples.
+    silhouette: mean silhouette coefficient, by Euclidean distance.
+    centroid: distance between the closest two label centroids, over
+      the mean distance of samples to their own centroid.
+    '''
+
+    n = len(labels)
+    n_labels = labels.max() + 1 if n > 0 else 0
+    scores = {metric: np.nan for metric in METRICS}
+    if n < 2 or len(np.unique(labels)) < 2:
+        return scores
+
+    onehot = np.zeros((n, n_labels))
+    onehot[np.arange(n), labels] = 1
+    sizes = onehot.sum(axis=0)
+    sq = (x ** 2).sum(axis=1)
+
+    agree = []
+    silhouette = []
+    for start in range(0, n, BLOCK):
+        stop = min(n, start + BLOCK)
+
+        # distances from this block of samples to all of them
+        d = np.sqrt(np.maximum(sq[start:stop, None] + sq[None, :] -
+                               2 * x[start:stop].dot(x.T), 0))
+
+        # silhouette: mean distance to own label vs nearest other label
+        sums = d.dot(onehot)
+        own = labels[start:stop]
+        rows = np.arange(stop - start)
+        a = sums[rows, own] / np.maximum(sizes[own] - 1, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums / sizes
+        mean[rows, own] = np.inf
+        mean[:, sizes == 0] = np.inf
+        b = mean.min(axis=1)
+        s = (b - a) / np.maximum(a, b)
+        s[sizes[own] < 2] = 0
+        silhouette.append(s)
+
+        # nearest neighbours, never from the sample's own passage
+        d[groups[start:stop, None] == groups[None, :]] = np.inf
+        kk = min(k, n - 1)
+        near = np.argpartition(d, kk - 1, axis=1)[:, :kk]
+        valid = np.isfinite(np.take_along_axis(d, near, axis=1))
+        same = (labels[near] == own[:, None]) & valid
+        with np.errstate(invalid='ignore'):
+            agree.append(same.sum(axis=1) / valid.sum(axis=1))
+
+    agree = np.concatenate(agree)
+    scores['knn'] = float(np.nanmean(agree)) if np.isfinite(agree).any() else np.nan
+    scores['silhouette'] = float(np.concatenate(silhouette).mean())
+
+    # centroid separation
+    present = sizes > 0
+    centroids = onehot.T.dot(x)[present] / sizes[present, None]
+    spread = np.linalg.norm(x - onehot[:, present].dot(centroids), axis=1).mean()
+    gaps = np.linalg.norm(centroids[:, None] - centroids[None, :], axis=2)
+    gaps[np.diag_indices(len(centroids))] = np.inf
+    scores['centroid'] = float(gaps.min() / spread) if spread > 0 else np.nan
+
+    return scores
+
+
+def evaluateTrial(label, rows, space='pca', k=5):
+    '''Load one trial and score it against bench ROWS; returns a table row'''
+
+    trial = Trial(label)
+    ids, labels, groups, tags, n_found = labelSamples(trial, rows)
+
+    x = loadTrialArray(trial.PATH, trial.manifest, space)
+    if sparse.issparse(x):
+        x = x[ids].toarray()
+    else:
+        x = np.asarray(x[ids], dtype=np.float64)
+
+    rec = {
+        'trial': label,
+        'feature': trial.manifest.get('feature'),
+        'size': trial.manifest.get('size'),
+        'step': trial.manifest.get('step'),
+        'offset': trial.manifest.get('offset'),
+        'passages': n_found,
+        'samples': len(ids),
+    }
+    rec.update(scoreSamples(x, labels, groups, k))
+
+    return rec
+
+
+def printTable(table, rank):
+    '''Print trial scores, best first by RANK'''
+
+    cols = ['trial', 'feature', 'size', 'step', 'offset', 'passages', 'samples'] + METRICS
+    widths = [max([len(c)] + [len(formatCell(r[c])) for r in table]) for c in cols]
+
+    print('  '.join(c.rjust(w) for c, w in zip(cols, widths)))
+    for r in sorted(table, key=lambda r: sortKey(r[rank]), reverse=True):
+        print('  '.join(formatCell(r[c]).rjust(w) for c, w in zip(cols, widths)))
+
+
+def writeTable(file, table, rank):
+    '''Write trial scores as a TSV, best first by RANK'''
+
+    cols = ['trial', 'feature', 'size', 'step', 'offset', 'passages', 'samples'] + METRICS
+    with open(file, 'w') as f:
+        f.write('\t'.join(cols) + '\n')
+        for r in sorted(table, key=lambda r: sortKey(r[rank]), reverse=True):
+            f.write('\t'.join(formatCell(r[c]) for c in cols) + '\n')
+
+
+def formatCell(val):
+    '''Table cell text'''
+
+    if val is None:
+        return '-'
+    if isinstance(val, float):
+        return '{:.4f}'.format(val)
+    return str(val)
+
+
+def sortKey(val):
+    '''Sort NaN scores last'''
+
+    return -np.inf if val is None or np.isnan(val) else val
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Rank trials by how well they separate the scene labels of bench passages'
+    )
+    parser.add_argument('trials',
+        nargs='+',
+        help='Trials to score; shell-style patterns such as "lemmata-*" match cached trials.')
+    parser.add_argument('--bench',
+        metavar='FILE', type=str, action='append', default=None,
+        help='Labelled passages; repeat for several files. '
+             'Default conf/bench/battles_tempests.txt.')
+    parser.add_argument('--strict',
+        action='store_true',
+        help='Leave out passages whose label ends in "?". By default they count.')
+    parser.add_argument('--space',
+        metavar='SPACE', type=str, default='pca', choices=['pca', 'tfidf'],
+        help='Score "pca" or "tfidf" vectors. Default "pca".')
+    parser.add_argument('-k',
+        metavar='K', type=int, default=5,
+        help='Neighbours for the knn score. Default 5.')
+    parser.add_argument('--rank',
+        metavar='METRIC', type=str, default='knn', choices=METRICS,
+        help='Score to rank by: knn, silhouette or centroid. Default knn.')
+    parser.add_argument('--out',
+        metavar='FILE', type=str, default=None,
+        help='Also write the table to FILE as a TSV.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    if args.bench is None:
+        args.bench = [os.path.join('conf', 'bench', 'battles_tempests.txt')]
+    rows = readBench(args.bench, args.strict)
+    labels = findTrials(args.trials)
+    print('Scoring {} trials on {} passages'.format(len(labels), len(rows)))
+
+    table = []
+    with Stage('evaluate', total=len(labels), unit='trials') as stage:
+        for label in labels:
+            table.append(evaluateTrial(label, rows, args.space, args.k))
+            stage.add()
+
+    printTable(table, args.rank)
+
+    if args.out is not None:
+        print('Writing scores to {}'.format(args.out))
+        writeTable(args.out, table, args.rank)
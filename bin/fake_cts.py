@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+'''Local stand-in for a CTS server
+
+   Replays recorded CTS API responses so that downloads can be tested
+   offline, optionally with added latency and transient failures. With
+   --record, requests missing from the recording are passed on to a real
+   server and its responses saved.
+'''
+
+#
+# import statements
+#
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+
+#
+# global values
+#
+
+FIXTURES = os.path.join('conf', 'fixtures', 'cts')
+
+#
+# functions
+#
+
+def responseKey(params):
+    '''File name of the recorded response to a CTS request'''
+
+    parts = [params.get('request', ''), params.get('urn', '')]
+    if params.get('level') is not None:
+        parts.append('level' + params['level'])
+
+    return re.sub(r'[^A-Za-z0-9.-]', '_', '__'.join(parts)) + '.xml'
+
+
+class FakeCtsServer(ThreadingHTTPServer):
+    '''Threaded HTTP server replaying CTS responses from a directory
+
+    Every request first waits DELAY seconds. The first FAIL_FIRST
+    attempts at each distinct request, and a random FAIL_RATE share of
+    the rest, get a 503. Responses carry an ETag, and requests with a
+    matching If-None-Match get a 304. Counters, including the largest
+    number of requests in flight at once, are served as JSON from /_stats.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), responses=FIXTURES,
+                 upstream=None, delay=0., fail_rate=0., fail_first=0,
+                 seed=None, verbose=False):
+        super(FakeCtsServer, self).__init__(address, CtsHandler)
+        self.responses = responses
+        self.upstream = upstream
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.fail_first = fail_first
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.attempts = dict()
+        self.active = 0
+        self.stats = {
+            'requests': 0,
+            'served': 0,
+            'failed': 0,
+            'missing': 0,
+            'recorded': 0,
+            'not_modified': 0,
+            'max_active': 0,
+        }
+        self.thread = None
+
+
+    @property
+    def url(self):
+        '''Endpoint to give to HttpCtsRetriever'''
+
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/api/cts/'.format(host, port)
+
+
+    def start(self):
+        '''Serve from a background thread; returns the endpoint URL'''
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self.url
+
+
+    def stop(self):
+        '''Shut down a server started with start()'''
+
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def count(self, key, n=1):
+        '''Increment a counter'''
+
+        with self.lock:
+            self.stats[key] += n
+
+
+    def enter(self, key):
+        '''Note a request arriving; return True if it should fail'''
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.active += 1
+            self.stats['max_active'] = max(self.stats['max_active'], self.active)
+
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+
+            return attempt < self.fail_first or \
+                self.random.random() < self.fail_rate
+
+
+    def leave(self):
+        '''Note a request finishing'''
+
+        with self.lock:
+            self.active -= 1
+
+
+    def record(self, params, file):
+        '''Fetch a response from the upstream server and save it'''
+
+        with urlopen(self.upstream + '?' + urlencode(params)) as response:
+            body = response.read()
+
+        if not os.path.exists(self.responses):
+            os.makedirs(self.responses)
+        with open(file, 'wb') as f:
+            f.write(body)
+        self.count('recorded')
+
+
+class CtsHandler(BaseHTTPRequestHandler):
+    '''Answer one CTS API request from the recordings'''
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+
+        if url.path.endswith('/_stats'):
+            with server.lock:
+                body = json.dumps(server.stats).encode('utf-8')
+            self._send(200, body, 'application/json')
+            return
+
+        params = {key: val[0] for key, val in parse_qs(url.query).items()}
+        key = responseKey(params)
+        file = os.path.join(server.responses, key)
+
+        fail = server.enter(key)
+        try:
+            time.sleep(server.delay)
+
+            if fail:
+                server.count('failed')
+                self._send(503, b'Service Unavailable', 'text/plain')
+                return
+
+            if not os.path.exists(file) and server.upstream is not None:
+                server.record(params, file)
+
+            if not os.path.exists(file):
+                server.count('missing')
+                self._send(404, 'No recording {}'.format(key).encode('utf-8'),
+                           'text/plain')
+                return
+
+            with open(file, 'rb') as f:
+                body = f.read()
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+            if self.headers.get('If-None-Match') == etag:
+                server.count('not_modified')
+                self._send(304, b'', None, etag)
+                return
+
+            server.count('served')
+            self._send(200, body, 'text/xml; charset=utf-8', etag)
+
+        finally:
+            server.leave()
+
+
+    def _send(self, status, body, content_type, etag=None):
+        '''Write a complete response'''
+
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('{} {}\n'.format(self.address_string(), format % args))
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Serve recorded CTS responses for offline testing'
+    )
+    parser.add_argument('--responses',
+        metavar='DIR', type=str, default=FIXTURES,
+        help='directory of recorded responses; default {}'.format(FIXTURES))
+    parser.add_argument('--port',
+        metavar='PORT', type=int, default=8765,
+        help='port to listen on, on localhost; default 8765')
+    parser.add_argument('--record',
+        metavar='URL', type=str, default=None,
+        help='pass unrecorded requests on to this CTS server and save the responses')
+    parser.add_argument('--delay',
+        metavar='SEC', type=float, default=0.,
+        help='wait SEC seconds before answering each request')
+    parser.add_argument('--fail-rate',
+        metavar='P', type=float, default=0.,
+        help='answer a random share P of requests with 503')
+    parser.add_argument('--fail-first',
+        metavar='N', type=int, default=0,
+        help='answer the first N attempts at each request with 503')
+    parser.add_argument('--seed',
+        metavar='N', type=int, default=None,
+        help='random seed for --fail-rate')
+
+    args = parser.parse_args()
+
+    server = FakeCtsServer(('127.0.0.1', args.port), args.responses,
+                           upstream=args.record, delay=args.delay,
+                           fail_rate=args.fail_rate, fail_first=args.fail_first,
+                           seed=args.seed, verbose=True)
+
+    print('Serving {} at {}'.format(args.responses, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+        print(json.dumps(server.stats))
@@ -7,19 +7,17 @@
 #
 
 import os
+import re
 import sys
 import json
 import shutil
 import argparse
-from collections import Counter
-
-import gensim
-from cltk.stem.latin.j_v import JVReplacer
-from cltk.tokenize.word import WordTokenizer
-from cltk.stem.lemma import LemmaReplacer
+import multiprocessing
+from collections import Counter, OrderedDict, deque
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from mta_summer_2018 import Config, Text
+from mta_summer_2018 import Config, Text, FeatureStore, hashString, hashFile, saveJson
+from mta_summer_2018 import Stage, addMetricsArgs, startMetrics
 
 #
 # functions
@@ -35,15 +33,334 @@ def whiteTok(tok, whitelist='abcdefghijklmnopqrstuvwxyz01234567890-'):
         return token
 
 
+class LemmaCache(object):
+    '''Memoize token -> lemma, so each distinct form is lemmatized once
+
+    Raw tokens are kept in a bounded LRU; normalized forms missing from
+    the LRU are looked up in a persistent form -> lemma table, and only
+    forms found in neither go to the cltk lemmatizer. This relies on the
+    Latin LemmaReplacer treating each token independently of its context.
+    '''
+
+    def __init__(self, maxsize=100000, table=None):
+        self.maxsize = maxsize
+        self.lru = OrderedDict()
+        self.table = dict() if table is None else table
+        self.new = dict()
+        self.hits = 0
+        self.table_hits = 0
+        self.misses = 0
+
+
+    def lemmatize(self, tokens, lemmatizer):
+        '''Lemmatize a list of raw tokens, dropping any that whiteTok() empties'''
+
+        # normalized form of each token; '' if whiteTok() leaves nothing
+        forms = []
+
+        # forms we have to send to the lemmatizer, in order and as a set
+        todo = []
+        todo_set = set()
+
+        for tok in tokens:
+            if tok in self.lru:
+                self.hits += 1
+                self.lru.move_to_end(tok)
+                form = self.lru[tok]
+            else:
+                form = whiteTok(tok) or ''
+                if form in self.table:
+                    self.table_hits += 1
+                elif form != '' and form not in todo_set:
+                    self.misses += 1
+                    todo.append(form)
+                    todo_set.add(form)
+                self._remember(tok, form)
+            forms.append(form)
+
+        # lemmatize all the new forms in one call
+        if len(todo) > 0:
+            for form, lemma in zip(todo, lemmatizer.lemmatize(todo)):
+                self.table[form] = lemma
+                self.new[form] = lemma
+
+        return [self.table[form] for form in forms if form != '']
+
+
+    def _remember(self, tok, form):
+        '''Add a token to the LRU, evicting the oldest if full'''
+
+        self.lru[tok] = form
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+
+    def drain(self):
+        '''Return and reset new table entries and counters since last call'''
+
+        result = (self.new, self.hits, self.table_hits, self.misses)
+        self.new = dict()
+        self.hits = 0
+        self.table_hits = 0
+        self.misses = 0
+
+        return result
+
+
+    def merge(self, new, hits, table_hits, misses):
+        '''Fold in the output of another process's drain()
+
+        Workers find the same new forms independently, so only forms
+        not already in the table count as new.
+        '''
+
+        new = dict((form, lemma) for form, lemma in new.items() if form not in self.table)
+        self.table.update(new)
+        self.new.update(new)
+        self.hits += hits
+        self.table_hits += table_hits
+        self.misses += misses
+
+
+def loadLemmaTable(file):
+    '''Read a persistent form -> lemma table'''
+
+    table = dict()
+
+    if file and os.path.exists(file):
+        with open(file) as f:
+            for line in f:
+                form, lemma = line.rstrip('\n').split('\t')
+                table[form] = lemma
+
+    return table
+
+
+def saveLemmaTable(file, new):
+    '''Append new form -> lemma pairs to the persistent table'''
+
+    if file and len(new) > 0:
+        with open(file, 'a') as f:
+            for form, lemma in sorted(new.items()):
+                f.write(form + '\t' + lemma + '\n')
+
+
+#
+# table backend
+#
+
+# enclitics split off by the cltk Latin WordTokenizer, in the order it tries them
+ENCLITICS = ['que', 'n', 'ue', 've', 'st']
+
+# contractions the cltk tokenizer expands before splitting words
+CONTRACTIONS = {
+    'mecum': 'cum me', 'tecum': 'cum te', 'secum': 'cum se',
+    'nobiscum': 'cum nobis', 'vobiscum': 'cum vobis', 'quocum': 'cum quo',
+    'quacum': 'cum qua', 'quicum': 'cum qui', 'quibuscum': 'cum quibus',
+    'sodes': 'si audes', 'satin': 'satis ne', 'scin': 'scis ne',
+    'sultis': 'si vultis', 'similist': 'similis est', 'qualist': 'qualis est',
+}
+
+# one pass over a whole batch of lines: line breaks, sentence ends, words
+TOKEN_RE = re.compile(r'(\n)|([.?!])|([^\s.,;:?!()\[\]{}"\'`*@&#«»“”‘’]+)')
+CONTRACTION_RE = re.compile(r'\b(?:' + '|'.join(sorted(CONTRACTIONS, key=len, reverse=True)) + r')\b')
+
+
+class LemmaLookup(object):
+    '''Memory-mapped form -> lemma table, exported from the cltk LemmaReplacer
+
+    Forms are a sorted array of UTF-8 byte strings, so a whole batch of
+    them is looked up with one np.searchsorted(); each has the index of
+    its lemma in a second array. KEEP lists the forms ending in an
+    enclitic that the cltk tokenizer leaves whole.
+    '''
+
+    def __init__(self, path):
+        import numpy as np
+
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+
+        self.forms = np.load(os.path.join(path, 'forms.npy'), mmap_mode='r')
+        self.lemma_ids = np.load(os.path.join(path, 'lemma_ids.npy'), mmap_mode='r')
+        self.lemmas = [b.decode('utf-8') for b in np.load(os.path.join(path, 'lemmas.npy'))]
+        self.keep = set(b.decode('utf-8') for b in np.load(os.path.join(path, 'keep.npy')))
+
+
+    @classmethod
+    def export(self, path, lemmata, keep):
+        '''Write a form -> lemma dict and the unsplit forms KEEP to PATH'''
+        import numpy as np
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        forms = sorted(f.encode('utf-8') for f in lemmata)
+        lemmas = sorted(set(lemmata.values()))
+        lemma_id = dict((lem, i) for i, lem in enumerate(lemmas))
+
+        np.save(os.path.join(path, 'forms.npy'), np.array(forms, dtype=bytes))
+        np.save(os.path.join(path, 'lemma_ids.npy'), np.array(
+            [lemma_id[lemmata[f.decode('utf-8')]] for f in forms], dtype=np.int32))
+        np.save(os.path.join(path, 'lemmas.npy'),
+                np.array([lem.encode('utf-8') for lem in lemmas], dtype=bytes))
+        np.save(os.path.join(path, 'keep.npy'),
+                np.array(sorted(k.encode('utf-8') for k in keep), dtype=bytes))
+
+        saveJson({'forms': len(forms), 'lemmas': len(lemmas), 'keep': len(keep)},
+                 os.path.join(path, 'manifest.json'), indent=1)
+
+        return self(path)
+
+
+    def lookup(self, forms):
+        '''Lemma of each form, or the form itself if the table doesn't have it'''
+        import numpy as np
+
+        if len(forms) == 0 or len(self.forms) == 0:
+            return list(forms)
+
+        query = np.array([f.encode('utf-8') for f in forms], dtype=bytes)
+        i = np.minimum(np.searchsorted(self.forms, query), len(self.forms) - 1)
+        found = self.forms[i] == query
+        ids = self.lemma_ids[i]
+
+        return [self.lemmas[j] if hit else form
+                for form, j, hit in zip(forms, ids.tolist(), found.tolist())]
+
+
+def splitEnclitic(token, initial, keep):
+    '''Split a token the way the cltk Latin WordTokenizer does
+
+    INITIAL marks the first word of a sentence, where a final "ne" is
+    split off too. Forms in KEEP are never split.
+    '''
+
+    if token in keep:
+        return [token]
+
+    if initial and token.endswith('ne') and len(token) > 2:
+        return [token[:-2], '-ne']
+
+    for enclitic in ENCLITICS:
+        if token.endswith(enclitic):
+            if enclitic == 'n':
+                return [token[:-1], '-ne']
+            elif enclitic == 'st':
+                if token.endswith('ust'):
+                    return [token[:-1], 'est']
+                return [token[:-2], 'est']
+            return [token[:-len(enclitic)], '-' + enclitic]
+
+    return [token]
+
+
+def tableTokenize(lines, keep=()):
+    '''Tokenize a batch of lines with one regex pass; returns a token list per line'''
+
+    text = '\n'.join(lines).lower()
+    text = CONTRACTION_RE.sub(lambda m: CONTRACTIONS[m.group(0)], text)
+
+    tokens = [[]]
+    initial = True
+    for newline, stop, word in TOKEN_RE.findall(text):
+        if newline:
+            tokens.append([])
+            initial = True
+        elif stop:
+            initial = True
+        else:
+            tokens[-1].extend(splitEnclitic(word, initial, keep))
+            initial = False
+
+    return tokens
+
+
+def probeKeep(forms, wordTokenizer):
+    '''Forms ending in an enclitic that the cltk tokenizer leaves whole'''
+
+    keep = set()
+    for form in forms:
+        if form.endswith('ne') or any(form.endswith(e) for e in ENCLITICS):
+            if wordTokenizer.tokenize(form) == [form]:
+                keep.add(form)
+
+    return keep
+
+
+def exportLookup(path, source):
+    '''Export the cltk lemma data, and its tokenizer's exceptions, to a LemmaLookup
+
+    Enclitic exceptions are found by running the cltk tokenizer on every
+    candidate form, from the lemma data and the texts in SOURCE, so they
+    match whichever cltk version is installed.
+    '''
+
+    initTools()
+    lemmata = TOOLS['lemmatizer'].lemmata
+
+    forms = set(lemmata)
+    for file in os.listdir(source):
+        if file.endswith('.json'):
+            for loc, line in loadJson(os.path.join(source, file)):
+                forms.update(w for n, p, w in TOKEN_RE.findall(line.lower()) if w)
+
+    with Stage('probe', unit='forms') as stage:
+        keep = probeKeep(sorted(forms), TOOLS['wordTokenizer'])
+        stage.add(len(forms))
+
+    return LemmaLookup.export(path, lemmata, keep)
+
+
+# cltk tools, loaded once per process by initTools()
+TOOLS = {}
+
+def initTools(table=None, maxsize=100000, backend='cltk', lookup=None):
+    '''Load the lemmatizer backend and lemma cache, if this process hasn't already
+
+    BACKEND "cltk" loads the cltk models; "table" only opens the
+    LemmaLookup at LOOKUP. Given a LOOKUP, "cltk" opens it as well,
+    so both can be compared.
+    '''
+
+    if len(TOOLS) == 0:
+        TOOLS['backend'] = backend
+        TOOLS['cache'] = LemmaCache(maxsize, table)
+
+        if backend == 'cltk':
+            from cltk.tokenize.word import WordTokenizer
+            from cltk.stem.lemma import LemmaReplacer
+
+            #TOOLS['jvReplace'] = JVReplacer()
+            TOOLS['wordTokenizer'] = WordTokenizer('latin')
+            TOOLS['lemmatizer'] = LemmaReplacer('latin')
+
+        if lookup is not None:
+            TOOLS['lookup'] = LemmaLookup(lookup)
+            TOOLS['forms'] = dict()
+
+
 def lemmanade(lines):
+    '''Lemmatize lines with the backend chosen in initTools()'''
+
+    initTools()
+    if TOOLS['backend'] == 'table':
+        return tableLemmanade(lines)
+
+    return cltkLemmanade(lines)
+
+
+def cltkLemmanade(lines):
 
     count = 0
     lemons = []
 
     # initialize cltk tools
-    #jvReplace = JVReplacer()
-    wordTokenizer = WordTokenizer('latin')
-    lemmatizer = LemmaReplacer('latin')
+    initTools()
+    wordTokenizer = TOOLS['wordTokenizer']
+    lemmatizer = TOOLS['lemmatizer']
+    cache = TOOLS['cache']
 
     for verse in lines:
 
@@ -54,16 +371,238 @@ def lemmanade(lines):
 
         #tokenize the words
         chunkTok = wordTokenizer.tokenize(verse.lower())
-        chunkTok = [whiteTok(tok) for tok in chunkTok if whiteTok(tok) is not None]
 
-        #lemmatize the tokens
-        lemmata = lemmatizer.lemmatize(chunkTok)
+        #normalize and lemmatize the tokens, each distinct form only once
+        lemmata = cache.lemmatize(chunkTok, lemmatizer)
 
         #add all the lemmatized tokens together in a string
         lemons.append(lemmata)
 
     return lemons
 
+
+def tableLemmanade(lines):
+    '''Lemmatize a batch of lines from the LemmaLookup, without cltk
+
+    Tokens are normalized by whiteTok() as in cltkLemmanade(); forms
+    not seen before in this process are looked up all at once.
+    '''
+
+    lookup = TOOLS['lookup']
+    known = TOOLS['forms']
+
+    tokens = tableTokenize(lines, lookup.keep)
+
+    # normalized form of every new token; '' if whiteTok() leaves nothing
+    new = set(tok for line in tokens for tok in line if tok not in known)
+    new = dict((tok, whiteTok(tok) or '') for tok in new)
+    forms = sorted(set(f for f in new.values() if f != ''))
+    lemma = dict(zip(forms, lookup.lookup(forms)))
+    for tok, form in new.items():
+        known[tok] = lemma.get(form)
+
+    return [[known[tok] for tok in line if known[tok] is not None] for line in tokens]
+
+
+def partialDictionary(lines):
+    '''Worker task: gensim dictionary of one text's lemmatized lines'''
+    import gensim
+
+    return gensim.corpora.Dictionary(lines)
+
+
+def mergeDictionary(dictionary, part):
+    '''Fold a partial dictionary into DICTIONARY
+
+    Merged in text order, the result is the same as adding every text's
+    lines to one dictionary. gensim's merge_with() leaves out collection
+    frequencies, so they are added here.
+    '''
+
+    old2new = dictionary.merge_with(part).old2new
+    for old, new in old2new.items():
+        dictionary.cfs[new] = dictionary.cfs.get(new, 0) + part.cfs.get(old, 0)
+
+
+def lemmanadeChunk(lines):
+    '''Worker task: lemmatize a chunk and hand back the cache updates'''
+
+    lemons = lemmanade(lines)
+
+    return lemons, TOOLS['cache'].drain()
+
+
+def chunker(lines, size):
+    '''Split a list of lines into consecutive chunks of at most SIZE'''
+
+    return [lines[i:i+size] for i in range(0, len(lines), size)]
+
+
+def lemmanadeChunks(lines, pool=None, chunksize=500):
+    '''Lemmatize lines chunk by chunk, yielding each chunk's results in order'''
+
+    chunks = chunker(lines, chunksize)
+
+    if pool is None:
+        for chunk in chunks:
+            yield lemmanade(chunk)
+    else:
+        # imap returns results in the order the chunks were submitted;
+        # collect the workers' new forms and cache statistics as we go
+        for lemons, stats in pool.imap(lemmanadeChunk, chunks):
+            TOOLS['cache'].merge(*stats)
+            yield lemons
+
+
+def loadJson(file, default=None):
+    '''Read a JSON file if it exists'''
+
+    if os.path.exists(file):
+        with open(file) as f:
+            return json.load(f)
+
+    return default
+
+
+def loadCheckpoint(file):
+    '''Line hash -> lemmata from a checkpoint of JSON lines, one per chunk
+
+    Lines cut short by an interrupted write are skipped.
+    '''
+
+    done = dict()
+    if os.path.exists(file):
+        with open(file) as f:
+            for line in f:
+                try:
+                    done.update(json.loads(line))
+                except ValueError:
+                    continue
+
+    return done
+
+
+def lemmatizeText(text, source, dest, manifest, pool=None, chunksize=500, backend='cltk'):
+    '''Lemmatize one text, reusing whatever earlier runs left behind
+
+    Unchanged texts are read back from DEST. Otherwise, lines whose
+    content hash matches a line lemmatized in a previous run, or in the
+    checkpoint of an interrupted one, are reused, and only the rest are
+    sent to the lemmatizer. Each chunk's results are appended to a
+    checkpoint as they arrive.
+    Results of a different BACKEND are never reused.
+    '''
+
+    src_file = os.path.join(source, text.author + '.json')
+    out_file = os.path.join(dest, text.author + '.json')
+    if backend == 'cltk':
+        partial_file = os.path.join(dest, 'partial', text.author + '.jsonl')
+    else:
+        partial_file = os.path.join(dest, 'partial', text.author + '.' + backend + '.jsonl')
+
+    src_hash = hashFile(src_file)
+    rec = manifest.get(text.author)
+    if rec is not None and rec.get('backend', 'cltk') != backend:
+        rec = None
+    text.dataFromJson(src_file)
+
+    # nothing changed since the last run
+    if rec is not None and rec['source'] == src_hash and os.path.exists(out_file):
+        print('   unchanged')
+        return loadJson(out_file)
+
+    hashes = [hashString(verse) for verse in text.lines]
+
+    # line hash -> lemmata from the last complete run and any checkpoint
+    known = dict()
+    if rec is not None and os.path.exists(out_file):
+        known.update(zip(rec['lines'], loadJson(out_file)))
+    known.update(loadCheckpoint(partial_file))
+
+    # distinct lines still to do
+    todo = dict()
+    for h, verse in zip(hashes, text.lines):
+        if h not in known:
+            todo[h] = verse
+    print('   {} of {} lines to lemmatize'.format(len(todo), len(hashes)))
+
+    done = dict()
+    todo_hashes = list(todo.keys())
+    todo_lines = list(todo.values())
+    if chunksize is None:
+        chunksize = max(len(todo_lines), 1)
+    with open(partial_file, 'a') as checkpoint, \
+            Stage('lemmanade', total=len(todo_lines), unit='lines') as stage:
+        # start on a new line, after whatever an interrupted run left
+        if checkpoint.tell() > 0:
+            checkpoint.write('\n')
+
+        for i, lemons in enumerate(lemmanadeChunks(todo_lines, pool, chunksize)):
+            start = i * chunksize
+            chunk = dict(zip(todo_hashes[start:start+len(lemons)], lemons))
+            done.update(chunk)
+            checkpoint.write(json.dumps(chunk) + '\n')
+            checkpoint.flush()
+            stage.add(len(lemons))
+            stage.add(sum(len(l) for l in lemons), 'lemmata')
+    known.update(done)
+
+    lemmatized = [known[h] for h in hashes]
+
+    # save lemmata, then record them as complete
+    saveJson(lemmatized, out_file, indent=1)
+    manifest[text.author] = {'source': src_hash, 'lines': hashes, 'backend': backend}
+    saveJson(manifest, os.path.join(dest, 'manifest.json'))
+    if os.path.exists(partial_file):
+        os.remove(partial_file)
+
+    return lemmatized
+
+
+def verifyBackends(corpus, source, out_file):
+    '''Lemmatize every line with both backends; write each disagreement to OUT_FILE
+
+    Lines are compared lemma by lemma. Where the backends give a line
+    different numbers of lemmata, the whole line is one disagreement.
+    Returns counts of lines, lemmata and disagreements, and a Counter
+    of (cltk, table) pairs.
+    '''
+
+    n_lines = 0
+    n_lemmata = 0
+    pairs = Counter()
+
+    with open(out_file, 'w') as f:
+        f.write('author\tloc\tposition\tcltk\ttable\n')
+
+        with Stage('verify', total=len(corpus), unit='texts') as run:
+            for text in corpus:
+                print(' - {} {}'.format(text.author, text.title))
+                text.dataFromJson(os.path.join(source, text.author + '.json'))
+
+                with Stage(text.author, unit='lines') as stage:
+                    cltk = cltkLemmanade(text.lines)
+                    table = tableLemmanade(text.lines)
+
+                    for loc, a, b in zip(text.loci, cltk, table):
+                        if len(a) != len(b):
+                            a, b = [' '.join(a)], [' '.join(b)]
+                            positions = ['*']
+                        else:
+                            positions = range(len(a))
+                        for i, x, y in zip(positions, a, b):
+                            if x != y:
+                                pairs[(x, y)] += 1
+                                f.write('{}\t{}\t{}\t{}\t{}\n'.format(text.author, loc, i, x, y))
+                        n_lemmata += len(a)
+
+                    stage.add(len(text.lines))
+                n_lines += len(text.lines)
+                run.add()
+
+    return n_lines, n_lemmata, sum(pairs.values()), pairs
+
+
 #
 # main
 #
@@ -75,21 +614,86 @@ if __name__ == '__main__':
     parser.add_argument('--feature',
         metavar="NAME", default = 'lemmata',
         help='Featureset to create')
+    parser.add_argument('--clean',
+        action='store_true',
+        help='Discard results of earlier runs and lemmatize everything.')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='Lemmatize in N parallel processes. Default 1 (serial).')
+    parser.add_argument('--chunk',
+        metavar='LINES', type=int, default=None,
+        help='Lines per parallel work unit. Default 500, or the whole text '
+             'with --backend table.')
+    parser.add_argument('--cache-size',
+        metavar='N', type=int, default=100000,
+        help='Token forms kept in the in-memory LRU. Default 100000.')
+    parser.add_argument('--lemma-table',
+        metavar='FILE', type=str,
+        default=os.path.join(Config.DATA, 'lemma_table.tsv'),
+        help='Persistent form->lemma table shared across runs and feature '
+             'sets; "" to disable. Default DATA/lemma_table.tsv.')
+    parser.add_argument('--no-dictionary',
+        action='store_false', dest='dictionary',
+        help='Skip the gensim dictionary, e.g. when sampling with '
+             '"sample.py --hashing", and remove any left by an earlier run. '
+             'The feature store is still written.')
+    parser.add_argument('--backend',
+        metavar='NAME', type=str, default='cltk', choices=['cltk', 'table'],
+        help='"cltk" tokenizer and LemmaReplacer, or "table": one regex and '
+             'a lookup in the table made by --export-lookup. Default cltk.')
+    parser.add_argument('--lookup',
+        metavar='DIR', type=str,
+        default=os.path.join(Config.DATA, 'lemma_lookup'),
+        help='Lemma table for the table backend. Default DATA/lemma_lookup.')
+    parser.add_argument('--export-lookup',
+        action='store_true',
+        help='Export the cltk lemma data to the --lookup table, then stop.')
+    parser.add_argument('--verify',
+        metavar='FILE', type=str, default=None,
+        help='Lemmatize the whole corpus with both backends, write every '
+             'disagreement to FILE as a TSV, then stop.')
+    addMetricsArgs(parser)
 
     args = parser.parse_args()
+    startMetrics(args)
 
     # paths
     source = os.path.join(Config.DATA, 'lines')
     dest = os.path.join(Config.DATA, args.feature)
 
-    print("Cleaning destination directory {}".format(dest))
-
-    # clean destination directory
-    if os.path.exists(dest):
+    if args.export_lookup:
+        print('Exporting cltk lemma data to {}'.format(args.lookup))
+        lookup = exportLookup(args.lookup, source)
+        print('{forms} forms, {lemmas} lemmata, {keep} forms kept whole'.format(
+            **lookup.manifest))
+        sys.exit(0)
+
+    if (args.backend == 'table' or args.verify) and not os.path.exists(
+            os.path.join(args.lookup, 'manifest.json')):
+        parser.error('No lemma table at {}; make one with --export-lookup'.format(args.lookup))
+
+    if args.verify is not None:
+        with open(Config.INDEX) as f:
+            corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
+        initTools(loadLemmaTable(args.lemma_table), args.cache_size, 'cltk', args.lookup)
+
+        print('Comparing backends')
+        n_lines, n_lemmata, n_diff, pairs = verifyBackends(corpus, source, args.verify)
+        print('{} of {} lemmata in {} lines differ; see {}'.format(
+            n_diff, n_lemmata, n_lines, args.verify))
+        for (a, b), n in pairs.most_common(20):
+            print('{:>8}  {} -> {}'.format(n, a, b))
+        sys.exit(0)
+
+    # clean destination directory only on request; otherwise resume
+    if args.clean and os.path.exists(dest):
+        print("Cleaning destination directory {}".format(dest))
         shutil.rmtree(dest)
-        os.makedirs(dest)
-    else:
-        os.makedirs(dest)
+    if not os.path.exists(os.path.join(dest, 'partial')):
+        os.makedirs(os.path.join(dest, 'partial'))
+
+    # hashes of source texts and lines from earlier runs
+    manifest = loadJson(os.path.join(dest, 'manifest.json'), dict())
 
     # Read the corpus metadata
     with open(Config.INDEX) as f:
@@ -98,40 +702,111 @@ if __name__ == '__main__':
     # initialize feature counts
     counts = Counter()
 
-    # corpus-wide featureset for creating gensim dictionary
-    all_features = []
-
+    # corpus-wide gensim dictionary, grown as each text is done
+    if args.dictionary:
+        import gensim
+        dictionary = gensim.corpora.Dictionary()
+
+    # partial dictionaries from worker processes, waiting to be merged in order
+    partials = deque()
+
+    # load the persistent lemma table
+    table = loadLemmaTable(args.lemma_table)
+    print('Loaded {} known forms from {}'.format(len(table), args.lemma_table))
+    lookup = args.lookup if args.backend == 'table' else None
+    initTools(table, args.cache_size, args.backend, lookup)
+
+    # table batches are whole texts, cltk ones --chunk lines
+    chunk = args.chunk
+    if chunk is None and args.backend == 'cltk':
+        chunk = 500
+
+    # start worker processes; each loads the cltk models once and keeps them
+    if args.workers > 1:
+        print('Starting {} worker processes'.format(args.workers))
+        pool = multiprocessing.Pool(args.workers, initializer=initTools,
+                                    initargs=(table, args.cache_size, args.backend, lookup))
+    else:
+        pool = None
 
     print("Lemmatizing...")
 
-    # Read the JSON files
-    for text in corpus:
-        print(" - {} {}".format(text.author, text.title))
-
-        text.dataFromJson(os.path.join(source, text.author + '.json'))
-
-        # tokenize and lemmatize
-        lemmatized = lemmanade(text.lines)
-
-        # save lemmata
-        filename = os.path.join(dest, text.author + '.json')
-        with open(filename, 'w') as f:
-            json.dump(lemmatized, f, indent=1)
+    # columnar integer-token copy of the feature set, for sample.py
+    store = FeatureStore.create(os.path.join(dest, 'store'))
 
-        # update word counts
-        counts.update([lem for line in lemmatized for lem in line])
+    # cache statistics, summed over texts
+    cache_stats = [0, 0, 0, 0]
 
-        # update corpus-wide featureset
-        all_features.extend(lemmatized)
-
-
-    # create gensim dictionary
-    dict_file = os.path.join(dest, 'gensim.dict')
-    print('Writing dictionary {}'.format(dict_file))
+    # Read the JSON files
+    with Stage('lemmatize', total=len(corpus), unit='texts') as run:
+        for text in corpus:
+            print(" - {} {}".format(text.author, text.title))
+
+            with Stage(text.author, unit='lines') as stage:
+
+                # tokenize and lemmatize what has changed; saves lemmata
+                lemmatized = lemmatizeText(text, source, dest, manifest, pool, chunk,
+                                           args.backend)
+
+                # save newly lemmatized forms
+                new, hits, table_hits, misses = TOOLS['cache'].drain()
+                saveLemmaTable(args.lemma_table, new)
+                for i, n in enumerate([len(new), hits, table_hits, misses]):
+                    cache_stats[i] += n
+
+                # add to the columnar store
+                store.addText(text.author, lemmatized, text.loci)
+
+                # update word counts
+                counts.update(lem for line in lemmatized for lem in line)
+
+                # update the dictionary, or have a worker build this text's part
+                if args.dictionary and pool is None:
+                    dictionary.add_documents(lemmatized)
+                elif args.dictionary:
+                    partials.append(pool.apply_async(partialDictionary, (lemmatized,)))
+                while len(partials) > 0 and partials[0].ready():
+                    mergeDictionary(dictionary, partials.popleft().get())
+
+                stage.add(len(lemmatized))
+                stage.add(sum(len(line) for line in lemmatized), 'lemmata')
+            run.add()
+            run.add(len(lemmatized), 'lines')
+
+    if pool is not None:
+        while len(partials) > 0:
+            mergeDictionary(dictionary, partials.popleft().get())
+        pool.close()
+        pool.join()
+
+    # report cache performance
+    if args.backend == 'cltk':
+        print('Lemma cache: {1} LRU hits, {2} table hits, {3} misses; {0} new forms'.format(
+            *cache_stats))
+
+    if args.dictionary:
+        # filter and save the gensim dictionary
+        dict_file = os.path.join(dest, 'gensim.dict')
+        print('Writing dictionary {}'.format(dict_file))
+
+        with Stage('dictionary', unit='lines') as stage:
+            stage.add(dictionary.num_docs)
+            dictionary.filter_extremes(no_below = 5)
+            dictionary.save(dict_file)
+
+            # finish the store with a map onto the dictionary ids
+            print('Writing feature store {}'.format(store.path))
+            store.finish(dictionary, dict_file)
 
-    dictionary = gensim.corpora.Dictionary(all_features)
-    dictionary.filter_extremes(no_below = 5)
-    dictionary.save(dict_file)
+    else:
+        # a dictionary from an earlier run no longer matches these lemmata
+        dict_file = os.path.join(dest, 'gensim.dict')
+        if os.path.exists(dict_file):
+            print('Removing stale dictionary {}'.format(dict_file))
+            os.remove(dict_file)
+
+        print('Writing feature store {}'.format(store.path))
+        store.finish()
 
     # write word counts
     count_file = os.path.join(dest, 'wordCounts.tsv')
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''Single entry point for the bin/ scripts
+
+   "mta.py SUBCOMMAND [ARGS]" runs the matching script with ARGS, as if
+   it had been run directly. Nothing is imported until the subcommand is
+   known, and the scripts themselves import gensim, sklearn, matplotlib
+   and cltk only where they are used, so "--help" and light commands
+   start quickly. "mta.py --startup" times the cold start of each
+   subcommand.
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import time
+import runpy
+import argparse
+import subprocess
+
+#
+# global values
+#
+
+BIN = os.path.dirname(os.path.realpath(__file__))
+
+# subcommand -> script, in pipeline order
+COMMANDS = [
+    ('init', 'setup_0.init_cltk.py', 'install and test the CLTK models'),
+    ('download', 'setup_1.dl_texts.py', 'download texts from the CTS server'),
+    ('extract', 'setup_2.extract_texts.py', 'extract verse lines from the XML'),
+    ('lemmatize', 'lemmatize.py', 'lemmatize the lines, build the dictionary'),
+    ('sample', 'sample.py', 'sample, weight and reduce a trial'),
+    ('plot', 'plot.py', 'plot a trial'),
+    ('render', 'render.py', 'plot many trials in parallel'),
+    ('neighbours', 'neighbours.py', 'find samples similar to a passage'),
+    ('evaluate', 'evaluate.py', 'score trials against the bench passages'),
+    ('stability', 'stability.py', 'compare trial PCA spaces by Procrustes'),
+    ('serve', 'serve.py', 'serve trial queries and plots over HTTP'),
+    ('pipeline', 'pipeline.py', 'bring every stage up to date'),
+    ('benchmark', 'benchmark.py', 'time each stage of the pipeline'),
+    ('synth', 'synth_corpus.py', 'generate a synthetic corpus'),
+    ('fake-cts', 'fake_cts.py', 'serve recorded CTS responses'),
+]
+
+# slow imports to look out for in the startup benchmark
+HEAVY = ['numpy', 'scipy', 'sklearn', 'gensim', 'matplotlib', 'cltk',
+         'MyCapytain', 'lxml']
+
+#
+# functions
+#
+
+def runCommand(name, args):
+    '''Run the script for subcommand NAME with command-line ARGS'''
+
+    script = dict((c, s) for c, s, h in COMMANDS)[name]
+
+    # run_path() sets argv[0] to the script
+    sys.argv = [sys.argv[0]] + list(args)
+    runpy.run_path(os.path.join(BIN, script), run_name='__main__')
+
+
+def importedHeavy(stderr):
+    '''Heavy packages named in "python -X importtime" output'''
+
+    found = set()
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            module = line.rsplit('|', 1)[1].strip()
+            if module in HEAVY:
+                found.add(module)
+
+    return [m for m in HEAVY if m in found]
+
+
+def startupBenchmark(repeat=3, commands=None):
+    '''Cold-start time of "SUBCOMMAND --help" in a fresh interpreter
+
+    Returns the commands that failed to start.
+    '''
+
+    failed = []
+    print('{:<12} {:>9} {:>9}  {}'.format('command', 'best ms', 'median ms', 'imports'))
+    for name, script, help in COMMANDS:
+        if commands and name not in commands:
+            continue
+
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', os.path.realpath(__file__), name, '--help'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            times.append(time.perf_counter() - start)
+            if proc.returncode != 0:
+                break
+
+        # a command that crashes on startup has no start time to speak of
+        if proc.returncode != 0:
+            errors = [l for l in proc.stderr.splitlines() if not l.startswith('import time:')]
+            print('{:<12} {:>9} {:>9}  exit {}: {}'.format(
+                name, 'FAILED', '-', proc.returncode, errors[-1] if errors else ''))
+            failed.append(name)
+            continue
+
+        times.sort()
+        print('{:<12} {:>9.0f} {:>9.0f}  {}'.format(
+            name, 1000 * times[0], 1000 * times[len(times) // 2],
+            ', '.join(importedHeavy(proc.stderr)) or '-'))
+
+    return failed
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Typical scenes in Latin epic: run a pipeline step',
+        epilog='Run "%(prog)s COMMAND --help" for the options of each command.'
+    )
+    parser.add_argument('command',
+        nargs='?', choices=[c for c, s, h in COMMANDS], metavar='COMMAND',
+        help='one of: ' + '; '.join('{} ({})'.format(c, h) for c, s, h in COMMANDS))
+    parser.add_argument('args',
+        nargs=argparse.REMAINDER,
+        help='options for the command')
+    parser.add_argument('--startup',
+        action='store_true',
+        help='time the cold start of every command, or of COMMAND')
+    parser.add_argument('--repeat',
+        metavar='N', type=int, default=3,
+        help='runs per command for --startup; default 3')
+
+    args = parser.parse_args()
+
+    if args.startup:
+        if startupBenchmark(args.repeat, [args.command] if args.command else None):
+            sys.exit(1)
+    elif args.command is None:
+        parser.print_help()
+    else:
+        runCommand(args.command, args.args)
@@ -3,7 +3,13 @@
 
 import re
 import os
+import sys
 import json
+import time
+import atexit
+import hashlib
+import resource
+import tracemalloc
 
 #
 # Set default paths, CTS server here
@@ -17,6 +23,67 @@ class Config(object):
     DATA = os.path.join('data', 'corpus')
 
 
+def hashString(s):
+    '''Content hash of a string'''
+
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def hashFile(file):
+    '''Content hash of a file'''
+
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def saveJson(data, file, indent=None):
+    '''Write JSON via a temp file, so an interrupted run never leaves half a file
+
+    The temp file has a unique name, so concurrent writers never share it.
+    '''
+    import tempfile
+
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(file) or '.',
+                                     suffix='.tmp', delete=False) as f:
+        json.dump(data, f, indent=indent)
+    os.replace(f.name, file)
+
+
+def loadScript(name, file):
+    '''Import one of the bin/ scripts, e.g. setup_2.extract_texts.py, as a module'''
+    import importlib.util
+
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), file)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def peakMemory():
+    '''Peak resident set size of this process so far, in MB'''
+
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def currentMemory():
+    '''Resident set size of this process now, in MB, or None where /proc is missing'''
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return pages * resource.getpagesize() / 2**20
+
+
 class Text(object):
     '''Metadata for one text'''
     
@@ -58,3 +125,535 @@ class Text(object):
             lang = rec.get('lang', None),
             urn = rec.get('cts_urn', None)
         )
+
+
+#
+# Trial cache
+#
+
+# version of the binary trial format written by saveTrial()
+TRIAL_FORMAT = 2
+
+# text files written by earlier versions of sample.py
+LEGACY_FILES = ['authors.txt', 'loci.txt', 'pca.txt', 'tfidf.txt']
+
+
+def saveTrial(path, authors, loci, pca, tfidf=None, meta=None, arrays=None, written=None):
+    '''Write one trial to PATH in binary, memory-mappable form
+
+    Authors are stored as integer codes into a lookup table, and loci
+    as a flat string array with per-sample offsets. TF-IDF may be a
+    dense array (tfidf.npy) or a scipy sparse matrix (tfidf.npz). Any
+    further ARRAYS, by name, are saved as NAME.npy. WRITTEN lists, by
+    name, files already written to PATH, e.g. a PCA of None streamed to
+    pca.npy. manifest.json lists the files and the parameters in META.
+    '''
+    import numpy as np
+    from scipy import sparse
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # author lookup table, in order of first appearance
+    names = []
+    code_of = dict()
+    for a in authors:
+        if a not in code_of:
+            code_of[a] = len(names)
+            names.append(a)
+    codes = np.array([code_of[a] for a in authors], dtype=np.int16)
+
+    # flatten loci
+    flat = np.array([l for sample in loci for l in sample], dtype=str)
+    offsets = np.zeros(len(loci) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sample) for sample in loci])
+
+    files = {
+        'authors': 'authors.npy',
+        'loci': 'loci.npy',
+        'loci_offsets': 'loci_offsets.npy',
+    }
+    np.save(os.path.join(path, files['authors']), codes)
+    np.save(os.path.join(path, files['loci']), flat)
+    np.save(os.path.join(path, files['loci_offsets']), offsets)
+
+    if pca is not None:
+        files['pca'] = 'pca.npy'
+        np.save(os.path.join(path, files['pca']), pca)
+
+    if tfidf is not None:
+        if sparse.issparse(tfidf):
+            files['tfidf'] = 'tfidf.npz'
+            sparse.save_npz(os.path.join(path, files['tfidf']), tfidf.tocsr())
+        else:
+            files['tfidf'] = 'tfidf.npy'
+            np.save(os.path.join(path, files['tfidf']), tfidf)
+
+    for name, array in (arrays or {}).items():
+        files[name] = name + '.npy'
+        np.save(os.path.join(path, files[name]), array)
+
+    files.update(written or {})
+
+    # remove stale text files from older runs under the same label
+    for file in LEGACY_FILES:
+        if os.path.exists(os.path.join(path, file)):
+            os.remove(os.path.join(path, file))
+
+    manifest = dict(meta or {})
+    manifest.update({
+        'format': TRIAL_FORMAT,
+        'samples': len(codes),
+        'authors': names,
+        'files': files,
+    })
+    saveJson(manifest, os.path.join(path, 'manifest.json'), indent=1)
+
+    return manifest
+
+
+def convertTrial(path):
+    '''Convert a text trial cache from older versions to binary form
+
+    A legacy tfidf.txt is left in place and listed in the manifest
+    rather than parsed, since nothing needs it at load time.
+    '''
+    import numpy as np
+
+    authors = np.loadtxt(os.path.join(path, 'authors.txt'), dtype=str, ndmin=1)
+    with open(os.path.join(path, 'loci.txt')) as f:
+        loci = json.load(f)
+    pca = np.loadtxt(os.path.join(path, 'pca.txt'), ndmin=2)
+
+    tfidf_txt = os.path.join(path, 'tfidf.txt')
+    keep = tfidf_txt + '.keep'
+    if os.path.exists(tfidf_txt):
+        os.rename(tfidf_txt, keep)
+
+    manifest = saveTrial(path, authors, loci, pca, meta={'converted': True})
+
+    if os.path.exists(keep):
+        os.rename(keep, tfidf_txt)
+        manifest['files']['tfidf'] = 'tfidf.txt'
+        saveJson(manifest, os.path.join(path, 'manifest.json'), indent=1)
+
+    return manifest
+
+
+def loadManifest(path):
+    '''Read a trial manifest, converting a legacy text cache first'''
+
+    file = os.path.join(path, 'manifest.json')
+
+    if not os.path.exists(file):
+        print('Converting text cache {} to binary format'.format(path))
+        return convertTrial(path)
+
+    with open(file) as f:
+        return json.load(f)
+
+
+def findTrials(patterns):
+    '''Trial labels in the cache matching any of PATTERNS, e.g. "lemmata-30-*"'''
+    import fnmatch
+
+    cache = os.path.join(Config.DATA, 'cache')
+    available = sorted(os.listdir(cache)) if os.path.exists(cache) else []
+
+    labels = []
+    for pattern in patterns:
+        matched = fnmatch.filter(available, pattern)
+        if len(matched) == 0:
+            print("Can't find trial {}".format(pattern))
+        labels.extend(l for l in matched if l not in labels)
+
+    return labels
+
+
+def loadTrialArray(path, manifest, key, mmap_mode='r'):
+    '''Open one array of a trial, memory-mapped where possible'''
+    import numpy as np
+    from scipy import sparse
+
+    file = os.path.join(path, manifest['files'][key])
+
+    if file.endswith('.npz'):
+        return sparse.load_npz(file)
+    elif file.endswith('.txt'):
+        return np.loadtxt(file, ndmin=2)
+    else:
+        return np.load(file, mmap_mode=mmap_mode)
+
+
+def addTrialArray(path, manifest, key, array):
+    '''Save one more array to an existing trial and list it in the manifest
+
+    The array is written under a temp name and moved into place, so a
+    reader never memory-maps a half-written file.
+    '''
+    import tempfile
+    import numpy as np
+    from scipy import sparse
+
+    with tempfile.NamedTemporaryFile(dir=path, suffix='.tmp', delete=False) as f:
+        if sparse.issparse(array):
+            name = key + '.npz'
+            sparse.save_npz(f, array.tocsr())
+        else:
+            name = key + '.npy'
+            np.save(f, array)
+    os.replace(f.name, os.path.join(path, name))
+    manifest['files'][key] = name
+
+    saveJson(manifest, os.path.join(path, 'manifest.json'), indent=1)
+
+    return manifest
+
+
+#
+# Feature store
+#
+
+class FeatureStore(object):
+    '''Columnar integer-token store for one feature set
+
+    Holds a vocabulary table and, for each author, a flat array of
+    token ids, an array of line offsets into it and the aligned loci.
+    All arrays are .npy files, so readers can memory-map them. A map
+    from token ids to the ids of the feature set's gensim dictionary
+    lets samplers go straight from tokens to bag-of-words vectors.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = None
+        self.vocab = None
+        self._token_id = None
+
+
+    @classmethod
+    def create(self, path):
+        '''Start writing a new, empty store at PATH'''
+
+        import shutil
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        store = self(path)
+        store.vocab = []
+        store._token_id = dict()
+        store.manifest = {'authors': []}
+
+        return store
+
+
+    @classmethod
+    def open(self, path):
+        '''Open an existing store, or return None if there isn't one'''
+
+        file = os.path.join(path, 'manifest.json')
+        if not os.path.exists(file):
+            return None
+
+        store = self(path)
+        with open(file) as f:
+            store.manifest = json.load(f)
+
+        return store
+
+
+    def _file(self, author, what):
+        return os.path.join(self.path, '{}.{}.npy'.format(author, what))
+
+
+    def addText(self, author, lines, loci):
+        '''Write one author's tokenized lines and loci'''
+        import numpy as np
+
+        ids = []
+        for line in lines:
+            for tok in line:
+                i = self._token_id.get(tok)
+                if i is None:
+                    i = len(self.vocab)
+                    self._token_id[tok] = i
+                    self.vocab.append(tok)
+                ids.append(i)
+
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(line) for line in lines])
+
+        np.save(self._file(author, 'tokens'), np.array(ids, dtype=np.int32))
+        np.save(self._file(author, 'offsets'), offsets)
+        np.save(self._file(author, 'loci'), np.array(loci, dtype=str))
+
+        self.manifest['authors'].append(author)
+
+
+    def finish(self, dictionary=None, dict_file=None):
+        '''Write the vocabulary, dictionary id map and manifest'''
+        import numpy as np
+
+        saveJson(self.vocab, os.path.join(self.path, 'vocab.json'))
+
+        if dictionary is not None:
+            dictmap = np.array([dictionary.token2id.get(tok, -1) for tok in self.vocab],
+                               dtype=np.int32)
+            np.save(os.path.join(self.path, 'dictmap.npy'), dictmap)
+            self.manifest['dictionary'] = hashFile(dict_file)
+
+        self.manifest['vocab'] = len(self.vocab)
+        saveJson(self.manifest, os.path.join(self.path, 'manifest.json'), indent=1)
+
+
+    def tokens(self, author, mmap_mode='r'):
+        '''Flat array of token ids for one author'''
+        import numpy as np
+
+        return np.load(self._file(author, 'tokens'), mmap_mode=mmap_mode)
+
+
+    def offsets(self, author, mmap_mode='r'):
+        '''Start of each line in tokens(), plus the end of the last'''
+        import numpy as np
+
+        return np.load(self._file(author, 'offsets'), mmap_mode=mmap_mode)
+
+
+    def loci(self, author, mmap_mode='r'):
+        '''Locus of each line'''
+        import numpy as np
+
+        return np.load(self._file(author, 'loci'), mmap_mode=mmap_mode)
+
+
+    def dictMap(self, dict_file=None, mmap_mode='r'):
+        '''Token id -> gensim dictionary id, -1 if filtered out
+
+        If DICT_FILE is given, returns None unless it is the dictionary
+        the map was built against.
+        '''
+        import numpy as np
+
+        if 'dictionary' not in self.manifest:
+            return None
+        if dict_file is not None and hashFile(dict_file) != self.manifest['dictionary']:
+            return None
+
+        return np.load(os.path.join(self.path, 'dictmap.npy'), mmap_mode=mmap_mode)
+
+
+    def getVocab(self):
+        '''Token strings, indexed by token id'''
+
+        if self.vocab is None:
+            with open(os.path.join(self.path, 'vocab.json')) as f:
+                self.vocab = json.load(f)
+
+        return self.vocab
+
+
+#
+# Instrumentation
+#
+
+class Metrics(object):
+    '''Run-wide settings for Stage, set from the command line by startMetrics()'''
+
+    # script name included in every record
+    SCRIPT = os.path.basename(sys.argv[0])
+
+    # open file receiving one JSON record per finished stage, or None
+    LOG = None
+
+    # open stages tracing allocations, outermost first
+    TRACED = []
+
+    # trace every stage's allocations, not only those asking for it
+    TRACE = False
+
+    # list receiving every finished stage's record as well, or None
+    RECORDS = None
+
+    # seconds between progress lines for stages with a known total
+    INTERVAL = 10.
+
+    # names of the stages currently open, outermost first
+    STACK = []
+
+
+def addMetricsArgs(parser):
+    '''Add the --metrics and --profile options to an ArgumentParser'''
+
+    parser.add_argument('--metrics',
+        metavar='FILE', type=str, default=None,
+        help='append per-stage timings and memory use to FILE as JSON lines')
+    parser.add_argument('--profile',
+        metavar='FILE', type=str, default=None,
+        help='run under cProfile and save the stats to FILE')
+
+
+def startMetrics(args):
+    '''Open the metrics log and start the profiler, as given by ARGS'''
+
+    if getattr(args, 'metrics', None) is not None:
+        Metrics.LOG = open(args.metrics, 'a')
+        atexit.register(Metrics.LOG.close)
+
+    if getattr(args, 'profile', None) is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(stopProfile, profiler, args.profile)
+        profiler.enable()
+
+
+def stopProfile(profiler, file):
+    '''Save profiler stats and print the top entries by cumulative time'''
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(file)
+    print('Profile saved to {}'.format(file))
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+
+class Stage(object):
+    '''Measure one stage of a run, for use as a context manager
+
+    Records wall and CPU time, resident memory at the end and its change
+    over the stage, the process's peak RSS so far, and the number of
+    items (lines, tokens, samples...) counted with add(), with their
+    throughput. The RSS peak is the process's high-water mark, not the
+    stage's own; with TRACE (or Metrics.TRACE), the stage's own peak of
+    allocations is measured with tracemalloc, which is slower. Stages
+    can be nested; the record's name is the path of open stages, e.g.
+    "lemmatize/ovid". If TOTAL is given, progress with an ETA is printed
+    every Metrics.INTERVAL seconds. Each finished stage is written to the
+    metrics log, if there is one, kept in Stage.record, and added to
+    Metrics.RECORDS if that is a list.
+    '''
+
+    def __init__(self, name, total=None, unit='items', quiet=False, trace=False):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.quiet = quiet
+        self.trace = trace or Metrics.TRACE
+        self.items = dict()
+        self.record = None
+
+
+    def __enter__(self):
+        Metrics.STACK.append(self.name)
+        self.path = '/'.join(Metrics.STACK)
+
+        # python heap tracing is slow, so only on request
+        self.tracing = self.trace and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        if self.trace:
+            # hand the enclosing traced stages their peak so far, then
+            # measure this stage's peak from here
+            peak = tracemalloc.get_traced_memory()[1]
+            for outer in Metrics.TRACED:
+                outer.peak = max(outer.peak, peak)
+            tracemalloc.reset_peak()
+            self.peak = 0
+            Metrics.TRACED.append(self)
+
+        self.rss = currentMemory()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.last = self.wall
+
+        return self
+
+
+    def add(self, n=1, unit=None):
+        '''Count N more items of UNIT (default: this stage's unit)'''
+
+        unit = self.unit if unit is None else unit
+        self.items[unit] = self.items.get(unit, 0) + n
+
+        if self.total is not None and unit == self.unit and not self.quiet:
+            now = time.perf_counter()
+            if now - self.last >= Metrics.INTERVAL:
+                self.last = now
+                print(' - {}'.format(self.progress()))
+
+
+    def progress(self):
+        '''Items done, rate and estimated time remaining, as a string'''
+
+        done = self.items.get(self.unit, 0)
+        elapsed = time.perf_counter() - self.wall
+        rate = done / elapsed if elapsed > 0 else 0.
+        msg = '{}: {}/{} {} ({:.1f}/s'.format(self.path, done, self.total,
+                                              self.unit, rate)
+        if rate > 0:
+            msg += ', ETA {}'.format(formatSeconds((self.total - done) / rate))
+
+        return msg + ')'
+
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+
+        rec = {
+            'script': Metrics.SCRIPT,
+            'stage': self.path,
+            'pid': os.getpid(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'wall': round(wall, 4),
+            'cpu': round(cpu, 4),
+            'process_peak_rss_mb': round(peakMemory(), 1),
+            'items': self.items,
+            'rates': {unit: round(n / wall, 1) for unit, n in self.items.items()
+                      if wall > 0},
+        }
+        rss = currentMemory()
+        if rss is not None:
+            rec['rss_mb'] = round(rss, 1)
+            rec['rss_change_mb'] = round(rss - self.rss, 1)
+        if self.trace:
+            Metrics.TRACED.remove(self)
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            for outer in Metrics.TRACED:
+                outer.peak = max(outer.peak, self.peak)
+            rec['peak_alloc_mb'] = round(self.peak / 2**20, 2)
+        if self.tracing:
+            tracemalloc.stop()
+        if exc_type is not None:
+            rec['error'] = exc_type.__name__
+
+        self.record = rec
+        Metrics.STACK.pop()
+        if Metrics.RECORDS is not None:
+            Metrics.RECORDS.append(rec)
+
+        if Metrics.LOG is not None:
+            Metrics.LOG.write(json.dumps(rec) + '\n')
+            Metrics.LOG.flush()
+
+        if not self.quiet:
+            rates = ', '.join('{} {}/s'.format(r, unit) for unit, r in rec['rates'].items())
+            if 'peak_alloc_mb' in rec:
+                mem = '{:.0f} MB allocated at peak'.format(rec['peak_alloc_mb'])
+            elif 'rss_mb' in rec:
+                mem = '{:.0f} MB rss ({:+.0f})'.format(rec['rss_mb'], rec['rss_change_mb'])
+            else:
+                mem = '{:.0f} MB process peak so far'.format(rec['process_peak_rss_mb'])
+            print(' - {}: {:.2f}s wall, {:.2f}s cpu, {}{}'.format(
+                self.path, wall, cpu, mem, '; ' + rates if rates else ''))
+
+
+def formatSeconds(sec):
+    '''H:MM:SS, or M:SS under an hour'''
+
+    m, s = divmod(int(round(sec)), 60)
+    h, m = divmod(m, 60)
+
+    return '{}:{:02d}:{:02d}'.format(h, m, s) if h else '{}:{:02d}'.format(m, s)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+''' Find the samples most similar to a passage
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import addMetricsArgs, startMetrics
+from plot import Trial
+
+#
+# functions
+#
+
+def printMatches(row, matches):
+    '''Print one passage and its nearest samples'''
+
+    print('{} {}-{} {}'.format(*row))
+    for rank, (auth, first, last, sim) in enumerate(matches):
+        print('  {:>3}. {:.4f}  {} {}-{}'.format(rank + 1, sim, auth, first, last))
+
+
+def writeMatches(file, results):
+    '''Write batch results as a TSV, one row per match'''
+
+    with open(file, 'w') as f:
+        f.write('author\tstart\tstop\ttag\trank\tmatch_author\tmatch_start\tmatch_stop\tsimilarity\n')
+        for row, matches in results:
+            for rank, (auth, first, last, sim) in enumerate(matches):
+                f.write('\t'.join(list(row) + [str(rank + 1), auth, first, last,
+                                               '{:.6f}'.format(sim)]) + '\n')
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Find the samples of a trial closest to a passage, or to every passage in a bench file'
+    )
+    parser.add_argument('trial',
+        help='Name of the sample set to search.')
+    parser.add_argument('--passage',
+        metavar=('AUTHOR', 'START', 'STOP'), nargs=3, default=None,
+        help='Passage to look up, e.g. "lucan 6.507 6.588".')
+    parser.add_argument('--bench',
+        metavar='FILE', type=str, default=None,
+        help='Look up every passage in FILE, e.g. conf/bench/test_passages.txt.')
+    parser.add_argument('-k',
+        metavar='K', type=int, default=10,
+        help='Number of matches per passage. Default 10.')
+    parser.add_argument('--space',
+        metavar='SPACE', type=str, default='pca', choices=['pca', 'tfidf'],
+        help='Compare "pca" or "tfidf" vectors. Default "pca".')
+    parser.add_argument('--other-authors',
+        action='store_true',
+        help="Only return samples by other authors than the passage's.")
+    parser.add_argument('--rebuild',
+        action='store_true',
+        help='Rebuild the cached neighbour index.')
+    parser.add_argument('--out',
+        metavar='FILE', type=str, default=None,
+        help='Also write the matches to FILE as a TSV.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    if args.passage is None and args.bench is None:
+        parser.error('give --passage or --bench')
+
+    trial = Trial(args.trial)
+    trial.neighbourIndex(args.space, args.rebuild)
+
+    results = []
+    start = time.perf_counter()
+
+    if args.passage is not None:
+        auth, loc_start, loc_stop = args.passage
+        matches = trial.findSimilar(auth, loc_start, loc_stop, args.k, args.space,
+                                    args.other_authors)
+        if matches is None:
+            print("Couldn't find passage {} {}-{}".format(auth, loc_start, loc_stop))
+        else:
+            results.append(((auth, loc_start, loc_stop, ''), matches))
+
+    if args.bench is not None:
+        results.extend(trial.findSimilarBatch(args.bench, args.k, args.space,
+                                              args.other_authors))
+
+    elapsed = time.perf_counter() - start
+
+    for row, matches in results:
+        printMatches(row, matches)
+    print('{} queries in {:.1f} ms'.format(len(results), elapsed * 1000))
+
+    if args.out is not None:
+        print('Writing matches to {}'.format(args.out))
+        writeMatches(args.out, results)
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+'''Run the whole pipeline, redoing only what is out of date
+
+   Stages are download, extract, lemmatize, sample and render. Each
+   unit of work (one author's lines, one trial, ...) leaves a stamp
+   under DATA/.pipeline recording a hash of its input files, parameters
+   and code, and the hashes of its outputs. A unit whose stamp matches
+   and whose outputs are intact is skipped; since inputs are compared by
+   content, a change only invalidates what is downstream of it.
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Config, Text, Stage, hashString, hashFile, saveJson
+from mta_summer_2018 import loadScript, addMetricsArgs, startMetrics
+
+#
+# global values
+#
+
+BIN = os.path.dirname(os.path.realpath(__file__))
+
+STAGES = ['download', 'extract', 'lemmatize', 'sample', 'render']
+
+# scripts each stage runs, whose content is part of its stamp
+CODE = {
+    'download': ['setup_1.dl_texts.py'],
+    'extract': ['setup_2.extract_texts.py'],
+    'lemmatize': ['lemmatize.py'],
+    'sample': ['sample.py'],
+    'render': ['render.py', 'plot.py'],
+}
+
+DEFAULTS = {
+    'download': {'workers': 4},
+    'extract': {},
+    'lemmatize': {'feature': 'lemmata', 'workers': 1, 'backend': 'cltk', 'lookup': None},
+    'sample': {'sizes': '30', 'offsets': '0', 'step': None, 'components': 10,
+               'sparse': False},
+    'render': {'plots': 'scatter', 'format': 'png'},
+}
+
+#
+# functions
+#
+
+class Stamps(object):
+    '''Stage stamps and a file hash cache, kept under DATA/.pipeline
+
+    File hashes are remembered by path, size and modification time, so
+    unchanged files are never read twice.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.path = os.path.join(data, '.pipeline')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.hash_file = os.path.join(self.path, 'hashes.json')
+        if os.path.exists(self.hash_file):
+            with open(self.hash_file) as f:
+                self.hashes = json.load(f)
+        else:
+            self.hashes = dict()
+
+
+    def fileHash(self, file):
+        '''Content hash of FILE, or None if it doesn't exist'''
+
+        try:
+            st = os.stat(file)
+        except FileNotFoundError:
+            return None
+
+        sig = [st.st_size, st.st_mtime_ns]
+        rec = self.hashes.get(file)
+        if rec is None or rec[0] != sig:
+            rec = [sig, hashFile(file)]
+            self.hashes[file] = rec
+
+        return rec[1]
+
+
+    def hashFiles(self, files):
+        '''Hashes of FILES, by path relative to DATA where possible'''
+
+        return {self.relative(f): self.fileHash(f) for f in sorted(files)}
+
+
+    def relative(self, file):
+        '''FILE relative to DATA, if it is inside it'''
+
+        rel = os.path.relpath(file, self.data)
+        return file if rel.startswith('..') else rel
+
+
+    def stampFile(self, stage, unit):
+        return os.path.join(self.path, stage, unit + '.json')
+
+
+    def current(self, stage, unit, key, outputs):
+        '''True if UNIT of STAGE was last made with KEY and its outputs are intact'''
+
+        file = self.stampFile(stage, unit)
+        if not os.path.exists(file):
+            return False
+        with open(file) as f:
+            stamp = json.load(f)
+
+        if stamp['key'] != key:
+            return False
+
+        return self.hashFiles(outputs) == stamp['outputs']
+
+
+    def save(self, stage, unit, key, inputs, params, outputs):
+        '''Record that UNIT of STAGE was made from KEY'''
+
+        if not os.path.exists(os.path.join(self.path, stage)):
+            os.makedirs(os.path.join(self.path, stage))
+
+        saveJson({
+            'key': key,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'inputs': inputs,
+            'params': params,
+            'outputs': self.hashFiles(outputs),
+        }, self.stampFile(stage, unit), indent=1)
+
+
+    def flush(self):
+        '''Save the hash cache'''
+
+        saveJson(self.hashes, self.hash_file)
+
+
+def codeHash(stage):
+    '''Hash of the scripts a stage runs, plus the shared module'''
+
+    files = CODE[stage] + ['mta_summer_2018.py']
+
+    return hashString(''.join(hashFile(os.path.join(BIN, f)) for f in files))
+
+
+def stageKey(inputs, params, code):
+    '''Content address of one unit of work'''
+
+    return hashString(json.dumps([inputs, params, code], sort_keys=True))
+
+
+class Pipeline(object):
+    '''Work out what is stale, stage by stage, and bring it up to date'''
+
+    def __init__(self, config, workers=1, force=(), dry_run=False):
+        self.config = config
+        self.workers = workers
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.stamps = Stamps(Config.DATA)
+        self.ran = dict()
+
+        with open(Config.INDEX) as f:
+            self.corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
+
+
+    def path(self, *parts):
+        return os.path.join(Config.DATA, *parts)
+
+
+    def plan(self, stage, units):
+        '''Units of STAGE that need to run, from (unit, inputs, params, outputs)'''
+
+        code = codeHash(stage)
+        todo = []
+        for unit, inputs, params, outputs in units:
+            key = stageKey(inputs, params, code)
+            if stage in self.force or not self.stamps.current(stage, unit, key, outputs):
+                todo.append((unit, key, inputs, params, outputs))
+
+        print('{}: {} of {} up to date'.format(stage, len(units) - len(todo), len(units)))
+        for unit, key, inputs, params, outputs in todo:
+            print(' - {} {}'.format('would run' if self.dry_run else 'running', unit))
+
+        self.ran[stage] = [] if self.dry_run else [t[0] for t in todo]
+
+        return [] if self.dry_run else todo
+
+
+    def finish(self, stage, done):
+        '''Stamp the units that ran'''
+
+        for unit, key, inputs, params, outputs in done:
+            self.stamps.save(stage, unit, key, inputs, params, outputs)
+        self.stamps.flush()
+
+
+    def download(self):
+        '''Fetch texts from the CTS server; the script itself is incremental'''
+
+        params = self.config['download']
+        inputs = self.stamps.hashFiles([Config.INDEX])
+        units = [('corpus', inputs, params, [self.path('xml', 'manifest.json')])]
+
+        todo = self.plan('download', units)
+        if len(todo) > 0:
+            runScript('setup_1.dl_texts.py', '--index', Config.INDEX,
+                      '--corpus', Config.DATA, '--workers', params['workers'])
+        self.finish('download', todo)
+
+
+    def extract(self):
+        '''Parse each author's XML into lines, one author per process'''
+
+        params = self.config['extract']
+        units = []
+        for text in self.corpus:
+            xml = sorted(glob.glob(self.path('xml', text.author, '*.xml')))
+            units.append((text.author, self.stamps.hashFiles(xml), params,
+                          [self.path('lines', text.author + '.json')]))
+
+        todo = self.plan('extract', units)
+        if len(todo) > 0:
+            if not os.path.exists(self.path('lines')):
+                os.makedirs(self.path('lines'))
+            jobs = [(self.path('xml', unit), outputs[0]) for unit, k, i, p, outputs in todo]
+            with Stage('extract', total=len(jobs), unit='texts') as stage:
+                if self.workers > 1 and len(jobs) > 1:
+                    with multiprocessing.Pool(min(self.workers, len(jobs))) as pool:
+                        for n in pool.imap_unordered(extractAuthor, jobs):
+                            stage.add()
+                            stage.add(n, 'lines')
+                else:
+                    for job in jobs:
+                        stage.add(extractAuthor(job), 'lines')
+                        stage.add()
+        self.finish('extract', todo)
+
+
+    def lemmatize(self):
+        '''Lemmatize all texts and build the dictionary and feature store'''
+
+        params = self.config['lemmatize']
+        feature = params['feature']
+        lines = [self.path('lines', text.author + '.json') for text in self.corpus]
+        outputs = [self.path(feature, 'gensim.dict'),
+                   self.path(feature, 'store', 'manifest.json')]
+        outputs += [self.path(feature, text.author + '.json') for text in self.corpus]
+
+        # the table backend's lemmata depend on the lemma table too
+        lookup = params['lookup']
+        if lookup is None:
+            lookup = self.path('lemma_lookup')
+        if params['backend'] == 'table':
+            lines += glob.glob(os.path.join(lookup, '*'))
+        units = [(feature, self.stamps.hashFiles(lines), params, outputs)]
+
+        # lemmatize.py redoes only the texts and lines that changed
+        todo = self.plan('lemmatize', units)
+        if len(todo) > 0:
+            runScript('lemmatize.py', '--feature', feature,
+                      '--workers', max(params['workers'], self.workers),
+                      '--backend', params['backend'], '--lookup', lookup)
+        self.finish('lemmatize', todo)
+
+
+    def trials(self):
+        '''(label, size, offset) of every trial in the sample grid'''
+        import sample
+
+        params = self.config['sample']
+        feature = self.config['lemmatize']['feature']
+        grid = []
+        for size in sample.parseGrid(str(params['sizes'])):
+            for offset in sample.parseGrid(str(params['offsets']), size):
+                label = sample.trialLabel(feature, size, params['step'], offset)
+                grid.append((label, size, offset))
+
+        return sample, grid
+
+
+    def sample(self):
+        '''Make every trial in the grid whose inputs changed'''
+
+        sample, grid = self.trials()
+        params = self.config['sample']
+        feature = self.config['lemmatize']['feature']
+
+        inputs = self.stamps.hashFiles(
+            [self.path(feature, 'gensim.dict'), self.path(feature, 'store', 'manifest.json')] +
+            [self.path(feature, text.author + '.json') for text in self.corpus])
+        units = []
+        for label, size, offset in grid:
+            unit_params = dict(params, size=size, offset=offset, feature=feature)
+            del unit_params['sizes'], unit_params['offsets']
+            units.append((label, inputs, unit_params,
+                          [self.path('cache', label, 'manifest.json')]))
+
+        todo = self.plan('sample', units)
+        if len(todo) > 0:
+            import gensim
+            dictionary = gensim.corpora.Dictionary.load(self.path(feature, 'gensim.dict'))
+            corpus = sample.loadCorpus(feature, dictionary)
+
+            # loaded corpus and options, for this process or each worker
+            state = {
+                'corpus': corpus,
+                'dictionary': dictionary,
+                'feature': feature,
+                'step': params['step'],
+                'engine': 'prefix',
+                'sparse': params['sparse'],
+                'components': params['components'],
+                'chunk': None,
+            }
+            points = [(p['size'], p['offset']) for u, k, i, p, o in todo]
+            with Stage('sample', total=len(points), unit='trials') as stage:
+                if self.workers > 1 and len(points) > 1:
+                    with multiprocessing.Pool(min(self.workers, len(points)),
+                                              initializer=sample.initSweep,
+                                              initargs=(state,)) as pool:
+                        for label, n in pool.imap_unordered(sample.sweepPoint, points):
+                            stage.add()
+                else:
+                    sample.initSweep(state)
+                    for point in points:
+                        sample.sweepPoint(point)
+                        stage.add()
+        self.finish('sample', todo)
+
+
+    def render(self):
+        '''Draw the figures of every trial that changed'''
+        import render
+
+        sample, grid = self.trials()
+        params = self.config['render']
+        plots = params['plots'].split(',')
+        bench = sorted(glob.glob(os.path.join('conf', 'bench', '*.txt')))
+
+        units = []
+        for label, size, offset in grid:
+            manifest = self.path('cache', label, 'manifest.json')
+            inputs = self.stamps.hashFiles([manifest])
+            if 'bench' in plots:
+                inputs.update(self.stamps.hashFiles(bench))
+
+            # the figures render.py will write, once the trial exists
+            outputs = []
+            if os.path.exists(manifest):
+                outputs = [job[-1] for job in render.listFigures(
+                    [label], plots, bench, render.FIGURES, params['format'])]
+            units.append((label, inputs, params, outputs))
+
+        todo = self.plan('render', units)
+        if len(todo) > 0:
+            runScript('render.py', *[u for u, k, i, p, o in todo],
+                      '--plots', params['plots'], '--format', params['format'],
+                      '--workers', self.workers)
+        self.finish('render', todo)
+
+
+def extractAuthor(job):
+    '''Worker task: parse one author's XML files into a lines JSON file'''
+
+    source, dest = job
+    extract = loadScript('extract_texts', 'setup_2.extract_texts.py')
+
+    return extract.extractText(source, dest)
+
+
+def runScript(script, *args):
+    '''Run one of the bin/ scripts as a subprocess, failing if it fails'''
+
+    cmd = [sys.executable, os.path.join(BIN, script)] + [str(a) for a in args]
+    print('$ ' + ' '.join(cmd[1:]))
+    subprocess.run(cmd, check=True)
+
+
+def loadConfig(file):
+    '''Pipeline parameters from FILE, over the defaults'''
+
+    config = {stage: dict(params) for stage, params in DEFAULTS.items()}
+    if file is not None and os.path.exists(file):
+        with open(file) as f:
+            for stage, params in json.load(f).items():
+                config[stage].update(params)
+
+    return config
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run the pipeline, skipping stages whose inputs, parameters and code are unchanged'
+    )
+    parser.add_argument('--config',
+        metavar='FILE', type=str, default=os.path.join('conf', 'pipeline.json'),
+        help='Stage parameters. Default conf/pipeline.json.')
+    parser.add_argument('--stages',
+        metavar='LIST', type=str, default='extract,lemmatize,sample',
+        help='Comma-separated stages to bring up to date, in pipeline order: '
+             '{}. Default "extract,lemmatize,sample".'.format(','.join(STAGES)))
+    parser.add_argument('--force',
+        metavar='LIST', type=str, default='',
+        help='Comma-separated stages to rerun even if up to date.')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='Run per-author and per-trial work in N processes. Default 1.')
+    parser.add_argument('--dry-run',
+        action='store_true',
+        help='Only report what is out of date.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    stages = args.stages.split(',')
+    force = [s for s in args.force.split(',') if s]
+    for stage in stages + force:
+        if stage not in STAGES:
+            parser.error('unknown stage {}; choose from {}'.format(stage, ', '.join(STAGES)))
+
+    pipeline = Pipeline(loadConfig(args.config), args.workers, force, args.dry_run)
+
+    with Stage('pipeline'):
+        for stage in STAGES:
+            if stage in stages:
+                getattr(pipeline, stage)()
+
+    for stage in stages:
+        print('{}: ran {}'.format(stage, ', '.join(pipeline.ran[stage]) or 'nothing'))
@@ -8,15 +8,18 @@
 
 import os
 import sys
-import json
 import argparse
+import threading
+from collections import OrderedDict
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from mta_summer_2018 import Config, Text
+from mta_summer_2018 import Config, Text, loadManifest, loadTrialArray, addTrialArray
+from mta_summer_2018 import findTrials
+from mta_summer_2018 import Stage, addMetricsArgs, startMetrics
 
+# matplotlib and scipy are only imported when needed, so that loading
+# and querying a Trial stays quick
 import numpy as np
-import matplotlib
-from matplotlib import pyplot
 
 #
 # global values
@@ -49,6 +52,7 @@ FIG_H = 7
 
 def basePlot(xs, ys, labels, colors=COLORS, title=None, legend=False):
     '''Basic plot'''
+    from matplotlib import pyplot
 
     # if we're going to have a legend, adjust figure width to make room
     if legend and len(set(labels)) > 1:
@@ -80,6 +84,7 @@ def basePlot(xs, ys, labels, colors=COLORS, title=None, legend=False):
 
 def ACAbasePlot(xs, ys, labels, colors=COLORS, title=None, legend=False, hi=None):
     '''Basic plot w/ single author highlighted'''
+    from matplotlib import pyplot
 
     # if we're going to have a legend, adjust figure width to make room
     if legend and len(set(labels)) > 1:
@@ -122,13 +127,47 @@ def ACAbasePlot(xs, ys, labels, colors=COLORS, title=None, legend=False, hi=None
 
     return fig
 
+
+def objectBytes(obj):
+    '''Approximate size of OBJ and what it holds; memory-mapped arrays count as nothing'''
+
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, 'indptr'):
+        # scipy sparse matrix
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(objectBytes(k) + objectBytes(v)
+                                        for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(objectBytes(v) for v in obj)
+
+    return sys.getsizeof(obj)
+
+
 class Trial(object):
     '''Represents one sample set'''
 
     def __init__(self, label):
+        self._neighbours = dict()
+        self._locKeys = None
+
+        # held while building and saving the neighbour indexes, which
+        # several server threads may ask for at once
+        self._lock = threading.RLock()
         if self._checkCache(label):
             self._loadSampleLabels()
             self._loadPCA()
+            self._buildIndex()
+
+
+    @classmethod
+    def listAuthors(self, label):
+        '''Authors in a cached trial, read from its manifest without loading it'''
+
+        return loadManifest(os.path.join(Config.DATA, 'cache', label))['authors']
 
 
     def _checkCache(self, label):
@@ -148,35 +187,85 @@ class Trial(object):
     def _loadSampleLabels(self):
         '''load authors, loci'''
 
+        # read the manifest, converting an old text cache if necessary
+        self.manifest = loadManifest(self.PATH)
+
         # load the author labels
-        file_authors = os.path.join(self.PATH, 'authors.txt')
-        print('Reading {}'.format(file_authors))
-        self.authors = np.loadtxt(file_authors, dtype=str)
+        print('Reading authors from {}'.format(self.PATH))
+        codes = loadTrialArray(self.PATH, self.manifest, 'authors')
+        self.authors = np.array(self.manifest['authors'])[codes]
 
         # load the loci
-        file_loci = os.path.join(self.PATH, 'loci.txt')
-        print('Reading {}'.format(file_loci))
-        with open(file_loci) as f:
-          self.loci = json.load(f)
-          self.firstlines = np.array([l[0] for l in self.loci])
+        print('Reading loci from {}'.format(self.PATH))
+        self._loci_flat = loadTrialArray(self.PATH, self.manifest, 'loci')
+        self._loci_offsets = loadTrialArray(self.PATH, self.manifest, 'loci_offsets')
+        self._loci = None
+        self.firstlines = np.array(self._loci_flat[self._loci_offsets[:-1]])
+
+
+    @property
+    def loci(self):
+        '''loci of each sample, as a list of lists'''
+
+        # build on first use only
+        if self._loci is None:
+            flat = self._loci_flat.tolist()
+            off = self._loci_offsets.tolist()
+            self._loci = [flat[off[i]:off[i+1]] for i in range(len(off)-1)]
+
+        return self._loci
 
 
     def _loadPCA(self):
         '''load pca feature set'''
 
-        file_pca = os.path.join(self.PATH, 'pca.txt')
-        print('Reading {}'.format(file_pca))
-        self.pca = np.loadtxt(file_pca)
+        print('Reading PCA from {}'.format(self.PATH))
+        self.pca = loadTrialArray(self.PATH, self.manifest, 'pca')
+
+
+    def _buildIndex(self):
+        '''index samples by locus'''
+
+        # sample id of each entry in the flat loci array
+        sample_ids = np.repeat(np.arange(len(self.authors)),
+                               np.diff(self._loci_offsets))
+        flat_authors = self.authors[sample_ids]
+        self._flat_ids = sample_ids
+        self._flat_authors = flat_authors
+
+        # author -> locus -> first sample containing it
+        self._locIndex = dict()
+
+        # (author, book) -> sorted integer line numbers, first sample for each
+        self._lineIndex = dict()
+
+        for auth in np.unique(self.authors):
+            mask = flat_authors == auth
+            locs, first = np.unique(self._loci_flat[mask], return_index=True)
+            ids = sample_ids[mask][first]
+            self._locIndex[auth] = dict(zip(locs.tolist(), ids.tolist()))
+
+            # only loci findLocWithin() can generate, i.e. "BOOK.N" with N
+            # an integer written without leading zeros
+            books = dict()
+            for loc, i in self._locIndex[auth].items():
+                parts = loc.split('.')
+                if len(parts) == 2 and parts[1].isdigit() and \
+                        str(int(parts[1])) == parts[1]:
+                    books.setdefault(parts[0], []).append((int(parts[1]), i))
+            for bk, pairs in books.items():
+                pairs.sort()
+                self._lineIndex[(auth, bk)] = (
+                    np.array([l for l, i in pairs]),
+                    np.array([i for l, i in pairs]))
 
 
     def findLoc(self, auth, loc, quiet=False):
         '''Return sample index containing given locus'''
 
-        in_auth = np.arange(len(self.authors))[self.authors==auth]
-
-        for i in in_auth:
-            if loc in self.loci[i]:
-                return i
+        i = self._locIndex.get(auth, dict()).get(loc)
+        if i is not None:
+            return i
 
         if not quiet:
             print("Couldn't find {} {}".format(auth, loc))
@@ -187,20 +276,25 @@ class Trial(object):
 
         bk, start = loc.split('.')
         start = int(start)
+
+        # line numbers indexed in this book
+        lines, ids = self._lineIndex.get((auth, bk), (np.zeros(0), None))
+
+        # nearest indexed line from start towards lim, not including lim
+        i = None
         if lim > start:
-            step = 1
+            j = np.searchsorted(lines, start, side='left')
+            if j < len(lines) and lines[j] < lim:
+                i = j
         elif lim < start:
-            step = -1
-        else:
-            step = 1
-            lim = start
+            j = np.searchsorted(lines, start, side='right') - 1
+            if j >= 0 and lines[j] > lim:
+                i = j
 
-        for l in range(start, lim, step):
-            i = self.findLoc(auth, '{}.{}'.format(bk, l), quiet=True)
-            if i is not None:
-                if not quiet:
-                    print(' -> using {}.{}'.format(bk, l))
-                return i
+        if i is not None:
+            if not quiet:
+                print(' -> using {}.{}'.format(bk, lines[i]))
+            return int(ids[i])
 
 
     def findPassage(self, auth, loc_start, loc_stop):
@@ -216,10 +310,208 @@ class Trial(object):
             return range(i_start, i_stop+1)
 
 
+    def locusKeys(self):
+        '''Sorted "author<TAB>locus" keys of every line, and the first sample containing each'''
+
+        if self._locKeys is None:
+            keys = np.char.add(np.char.add(self._flat_authors.astype(str), '\t'),
+                               self._loci_flat.astype(str))
+            self._locKeys, first = np.unique(keys, return_index=True)
+            self._locIds = self._flat_ids[first]
+
+        return self._locKeys, self._locIds
+
+
+    def memoryUsage(self):
+        '''Approximate bytes held by this trial, leaving out memory-mapped arrays'''
+
+        return objectBytes(vars(self))
+
+
+    def resolvePassages(self, rows):
+        '''First and last sample id of many passages at once
+
+        ROWS are (author, start locus, stop locus). Gives the same ranges
+        as findPassage(), but looks up every locus with one binary search
+        over a sorted key array. Returns arrays FIRST and LAST, with -1
+        where a passage can't be found.
+        '''
+
+        loc_keys, loc_ids = self.locusKeys()
+
+        if len(rows) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        auths = np.char.add(np.array([r[0] for r in rows], dtype=str), '\t')
+
+        def lookup(locs):
+            keys = np.char.add(auths, np.array(locs, dtype=str))
+            j = np.minimum(np.searchsorted(loc_keys, keys), len(loc_keys) - 1)
+            return np.where(loc_keys[j] == keys, loc_ids[j], -1)
+
+        start = lookup([r[1] for r in rows])
+        stop = lookup([r[2] for r in rows])
+
+        # a stop locus missing from the trial falls back to the nearest before it
+        for i in np.flatnonzero(stop < 0):
+            i_stop = self.findLocWithin(rows[i][0], rows[i][2], 0, quiet=True)
+            if i_stop is not None:
+                stop[i] = i_stop
+
+        found = (start >= 0) & (stop >= 0)
+        first = np.where(found, np.minimum(start, stop), -1)
+        last = np.where(found, np.maximum(start, stop), -1)
+
+        return first, last
+
+
+    def neighbourIndex(self, space='pca', rebuild=False):
+        '''Unit-length sample vectors for cosine similarity search
+
+        SPACE is "pca" or "tfidf". The index is built on first use and
+        saved to the trial cache as nn_SPACE, then memory-mapped after.
+        Safe to call from several threads at once.
+        '''
+
+        key = 'nn_' + space
+        with self._lock:
+            if key in self._neighbours and not rebuild:
+                return self._neighbours[key]
+
+            if rebuild or key not in self.manifest['files']:
+                self._buildNeighbourIndex(space)
+
+            self._neighbours[key] = loadTrialArray(self.PATH, self.manifest, key)
+
+            return self._neighbours[key]
+
+
+    def _buildNeighbourIndex(self, space):
+        '''Normalize the SPACE vectors and save them as nn_SPACE'''
+        from scipy import sparse
+
+        print('Building {} neighbour index for {}'.format(space, self.LABEL))
+        m = loadTrialArray(self.PATH, self.manifest, space)
+        if sparse.issparse(m):
+            norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+            norms[norms == 0] = 1
+            index = sparse.diags(1 / norms).dot(m).astype(np.float32).tocsr()
+        else:
+            m = np.asarray(m, dtype=np.float32)
+            norms = np.linalg.norm(m, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            index = m / norms
+        addTrialArray(self.PATH, self.manifest, 'nn_' + space, index)
+
+
+    def nearest(self, passages, k=10, space='pca', other_authors=False):
+        '''Top K samples most similar to each of several passages
+
+        PASSAGES is a list of lists of sample ids; each passage is
+        represented by the mean of its samples' vectors. Samples of the
+        same author sharing a line with the passage are never returned,
+        nor, with OTHER_AUTHORS, any samples by that author. Returns, for
+        each passage, a list of (sample id, cosine similarity), best first.
+        '''
+        from scipy import sparse
+
+        index = self.neighbourIndex(space)
+
+        # one query vector per passage; all similarities in one product
+        rows = np.concatenate([list(ids) for ids in passages]).astype(int)
+        groups = np.repeat(np.arange(len(passages)), [len(ids) for ids in passages])
+        mean = sparse.csr_matrix((np.ones(len(rows)) / np.bincount(groups)[groups],
+                                  (groups, rows)),
+                                 shape=(len(passages), index.shape[0]))
+        queries = mean.dot(index)
+        if sparse.issparse(queries):
+            queries = queries.toarray()
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        sims = np.asarray(index.dot((queries / norms).T), dtype=np.float64)
+
+        results = []
+        for j, ids in enumerate(passages):
+            col = sims[:, j]
+            auth = self.authors[ids[0]]
+
+            # drop the passage itself and any windows overlapping it
+            mask = self._flat_authors == auth
+            lines = self._loci_flat[self._loci_offsets[min(ids)]:self._loci_offsets[max(ids)+1]]
+            overlap = np.unique(self._flat_ids[mask][np.isin(self._loci_flat[mask], lines)])
+            col[overlap] = -np.inf
+            if other_authors:
+                col[self.authors == auth] = -np.inf
+
+            n = min(k, np.isfinite(col).sum())
+            top = np.argpartition(-col, n - 1)[:n] if n > 0 else np.zeros(0, dtype=int)
+            top = top[np.argsort(-col[top], kind='stable')]
+            results.append([(int(i), float(col[i])) for i in top])
+
+        return results
+
+
+    def sampleRange(self, i):
+        '''First and last locus of sample I'''
+
+        return (str(self._loci_flat[self._loci_offsets[i]]),
+                str(self._loci_flat[self._loci_offsets[i+1] - 1]))
+
+
+    def findSimilar(self, auth, loc_start, loc_stop, k=10, space='pca',
+                    other_authors=False):
+        '''Top K samples most similar to a passage
+
+        Returns a list of (author, first locus, last locus, similarity),
+        best first, or None if the passage can't be found.
+        '''
+
+        ids = self.findPassage(auth, loc_start, loc_stop)
+        if ids is None:
+            return None
+
+        matches = self.nearest([ids], k, space, other_authors)[0]
+
+        return [(str(self.authors[i]),) + self.sampleRange(i) + (sim,) for i, sim in matches]
+
+
+    def findSimilarBatch(self, filename, k=10, space='pca', other_authors=False):
+        '''Top K matches for every passage in a bench file
+
+        Returns a list of ((author, start, stop, tag), matches) with
+        matches as in findSimilar(); passages that can't be found are
+        skipped.
+        '''
+
+        rows = []
+        passages = []
+
+        with open(filename) as f:
+            for l in f:
+                if l.strip() == '':
+                    continue
+                auth, loc_start, loc_stop, tag = l.strip().split(None, 3)
+                ids = self.findPassage(auth, loc_start, loc_stop)
+                if ids is not None:
+                    rows.append((auth, loc_start, loc_stop, tag))
+                    passages.append(ids)
+
+        if len(passages) == 0:
+            return []
+
+        results = []
+        for row, matches in zip(rows, self.nearest(passages, k, space, other_authors)):
+            results.append((row, [(str(self.authors[i]),) + self.sampleRange(i) + (sim,)
+                                  for i, sim in matches]))
+
+        return results
+
+
     def plotAuthor(self, auth, marker='', points=SHADOW[0], corpus=False,
                    text='#000000'):
         '''plot one author'''
-        
+        from matplotlib import pyplot
+
         # generate title
         title = '{} : {}'.format(self.LABEL, auth)
 
@@ -255,22 +547,37 @@ class Trial(object):
 
 
     def plotTestPassages(self, filename, title=None):
-        '''Read in a list of passages and plot them'''
+        '''Read in a list of passages and plot them
 
-        authors = []
-        passages = []
-        tags = []
+        Passages that can't be found in this trial, e.g. before the
+        first sample of an offset trial, are left out with a warning.
+        '''
 
         if title is None:
             title = filename
 
+        rows = []
         with open(filename) as f:
             for l in f:
-                auth, loc_start, loc_stop, tag = l.strip().split()
-                s_id = self.findPassage(auth, loc_start, loc_stop)
-                authors.append(auth)
-                passages.extend(s_id)
-                tags.extend([tag] * len(s_id))
+                if l.strip() == '':
+                    continue
+                # fields are tab-separated; tags may contain spaces
+                rows.append(l.strip().split(None, 3))
+
+        first, last = self.resolvePassages([r[:3] for r in rows])
+
+        authors = []
+        passages = []
+        tags = []
+        for r, i, j in zip(rows, first.tolist(), last.tolist()):
+            auth, loc_start, loc_stop, tag = r
+            if i < 0:
+                print("Skipping {} {}-{}: not in {}".format(auth, loc_start, loc_stop, self.LABEL))
+                continue
+            authors.append(auth)
+            passages.extend(range(i, j + 1))
+            tags.extend([tag] * (j - i + 1))
+        tags = np.array(tags)
 
         # plot shadow version of larger dataset
         mask = np.isin(self.authors, authors)
@@ -287,7 +594,7 @@ class Trial(object):
         # plot just the marked passages in color
         for i, t in enumerate(sorted(set(tags))):
             ax.plot(xs[tags==t], ys[tags==t],
-                ls='', marker='.', color=COLORS[i])
+                ls='', marker='.', color=COLORS[i % len(COLORS)])
 
         # add locus tags at every x,y point
         for x, y, tag in zip(xs, ys, tags):
@@ -327,6 +634,156 @@ class Trial(object):
 
         return fig
 
+class TrialSet(object):
+    '''Every cached trial matching PATTERNS, each loaded on first use
+
+    Manifests are read up front, so trials can be chosen by their
+    parameters without loading them. Loaded trials are kept, least
+    recently used first, until their estimated memory passes BUDGET
+    megabytes; then the oldest are dropped. The most recent one is
+    always kept.
+    '''
+
+    def __init__(self, patterns=None, budget=1024):
+        self.labels = findTrials(['*'] if patterns is None else patterns)
+        self.manifests = dict((label, loadManifest(os.path.join(Config.DATA, 'cache', label)))
+                              for label in self.labels)
+        self.budget = budget * 2 ** 20
+        self.trials = OrderedDict()
+        self.sizes = dict()
+        self.hits = 0
+        self.loads = 0
+
+
+    def __len__(self):
+        return len(self.labels)
+
+
+    def __iter__(self):
+        return iter(self.labels)
+
+
+    def __contains__(self, label):
+        return label in self.manifests
+
+
+    def __getitem__(self, label):
+        '''Loaded Trial for LABEL'''
+
+        if label in self.trials:
+            self.hits += 1
+            self.trials.move_to_end(label)
+            return self.trials[label]
+
+        if label not in self.manifests:
+            raise KeyError(label)
+
+        self.loads += 1
+        trial = Trial(label)
+        self.trials[label] = trial
+        self.remeasure(label)
+
+        return trial
+
+
+    def remeasure(self, label):
+        '''Update a loaded trial's size, e.g. after it built an index, and evict if need be'''
+
+        self.sizes[label] = self.trials[label].memoryUsage()
+        while len(self.trials) > 1 and self.memoryUsage() > self.budget:
+            old, trial = self.trials.popitem(last=False)
+            del self.sizes[old]
+
+
+    def memoryUsage(self):
+        '''Estimated bytes held by the loaded trials'''
+
+        return sum(self.sizes.values())
+
+
+    def select(self, **params):
+        '''Labels of trials whose manifest has all of PARAMS, e.g. select(size=30)'''
+
+        return [label for label in self.labels
+                if all(self.manifests[label].get(key) == val for key, val in params.items())]
+
+
+    def anchorCoordinates(self, labels=None, npcs=None, stride=1):
+        '''PCA coordinates of the lines that every trial in LABELS samples
+
+        Trials of different sizes and offsets have different samples, but
+        share verse lines: each line is given the coordinates of the
+        first sample containing it. Only every STRIDE-th line of the
+        first trial is used. Each trial is loaded once. Returns the line
+        keys and an array of trials x lines x NPCS components (default:
+        as many as every trial has).
+        '''
+
+        if labels is None:
+            labels = self.labels
+
+        keys = None
+        coords = []
+        for label in labels:
+            trial = self[label]
+            trial_keys, trial_ids = trial.locusKeys()
+            self.remeasure(label)
+
+            if keys is None:
+                keys = trial_keys[::stride]
+
+            # drop lines this trial doesn't sample from all the trials so far
+            j = np.minimum(np.searchsorted(trial_keys, keys), len(trial_keys) - 1)
+            found = trial_keys[j] == keys
+            keys = keys[found]
+            coords = [c[found] for c in coords]
+
+            coords.append(np.asarray(trial.pca[trial_ids[j[found]], :npcs], dtype=np.float64))
+
+        width = min(c.shape[1] for c in coords)
+
+        return keys, np.stack([c[:, :width] for c in coords])
+
+
+    def stability(self, labels=None, npcs=None, stride=1):
+        '''Procrustes disparity between the PCA spaces of every pair of trials
+
+        Returns the labels and a square matrix of disparities: 0 where two
+        trials place the shared lines identically up to translation,
+        scaling, rotation and reflection, up to 1.
+        '''
+
+        if labels is None:
+            labels = self.labels
+
+        keys, coords = self.anchorCoordinates(labels, npcs, stride)
+
+        return labels, procrustesDisparity(coords)
+
+
+def procrustesDisparity(coords):
+    '''Procrustes disparity between every pair of point configurations at once
+
+    COORDS is configurations x points x dimensions. Each is centred and
+    scaled to unit norm; the disparity of a pair is then 1 minus the
+    squared sum of the singular values of their cross-product, as in
+    scipy.spatial.procrustes(). All the cross-products are made with one
+    tensor product and decomposed with one batched SVD.
+    '''
+
+    x = coords - coords.mean(axis=1, keepdims=True)
+    norms = np.sqrt((x ** 2).sum(axis=(1, 2)))
+    x = x / np.where(norms > 0, norms, 1)[:, None, None]
+
+    # trials x trials x dims x dims
+    cross = np.einsum('inj,mnk->imjk', x, x, optimize=True)
+    s = np.linalg.svd(cross, compute_uv=False)
+
+    disparity = np.clip(1 - s.sum(axis=-1) ** 2, 0, 1)
+    np.fill_diagonal(disparity, 0)
+
+    return disparity
+
 #
 # main
 #
@@ -347,8 +804,10 @@ if __name__ == '__main__':
     parser.add_argument('--format',
         metavar='FMT', type=str, default='pdf', choices=['pdf', 'png'],
         help='Output file format.')
+    addMetricsArgs(parser)
 
     args = parser.parse_args()
+    startMetrics(args)
 
     # set default title
     if args.title is None:
@@ -358,7 +817,9 @@ if __name__ == '__main__':
     # Load data
     #
 
-    trial = Trial(args.trial)
+    with Stage('load', unit='samples') as stage:
+        trial = Trial(args.trial)
+        stage.add(len(trial.authors))
 
     #
     # Plot
@@ -367,8 +828,10 @@ if __name__ == '__main__':
     print('Plotting')
 
     # create figure, canvas
-    fig = basePlot(xs=trial.pca[:,0], ys=trial.pca[:,1],
-        labels=trial.authors, colors=COLORS, title=args.title)
+    with Stage('plot', unit='samples') as stage:
+        fig = basePlot(xs=trial.pca[:,0], ys=trial.pca[:,1],
+            labels=trial.authors, colors=COLORS, title=args.title)
+        stage.add(len(trial.authors))
 
     # write output
     if args.out is None:
@@ -381,4 +844,5 @@ if __name__ == '__main__':
     file_out = os.path.join('plot', file_out)
 
     print('Saving plot to {}'.format(file_out))
-    fig.savefig(file_out)
+    with Stage('save'):
+        fig.savefig(file_out)
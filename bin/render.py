@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+''' Render figures for many trials at once
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Stage, findTrials, addMetricsArgs, startMetrics
+from plot import Trial, basePlot, COLORS
+
+#
+# global values
+#
+
+PLOTS = ['scatter', 'authors', 'bench']
+
+# default output directory
+FIGURES = 'plot'
+
+#
+# functions
+#
+
+def listFigures(labels, plots, bench_files, dest, fmt):
+    '''One job per figure: (label, plot type, argument, output file)'''
+
+    jobs = []
+    for label in labels:
+        if 'scatter' in plots:
+            jobs.append((label, 'scatter', None,
+                         os.path.join(dest, '{}.{}'.format(label, fmt))))
+        if 'authors' in plots:
+            # authors are read from the manifest, without loading the trial
+            for auth in Trial.listAuthors(label):
+                jobs.append((label, 'authors', auth,
+                             os.path.join(dest, label, '{}.{}'.format(auth, fmt))))
+        if 'bench' in plots:
+            for file in bench_files:
+                name = os.path.splitext(os.path.basename(file))[0]
+                jobs.append((label, 'bench', file,
+                             os.path.join(dest, label, '{}.{}'.format(name, fmt))))
+
+    return jobs
+
+
+def groupJobs(jobs, workers=1):
+    '''Split jobs into tasks that each share one trial
+
+    A trial is loaded once per task and dropped when the task is done.
+    With fewer trials than WORKERS, a trial's jobs are split further so
+    that every worker has something to do.
+    '''
+
+    groups = []
+    for job in jobs:
+        if len(groups) > 0 and groups[-1][0][0] == job[0]:
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+
+    parts = max(1, -(-workers // max(len(groups), 1)))
+    tasks = []
+    for group in groups:
+        size = -(-len(group) // parts)
+        tasks.extend(group[i:i+size] for i in range(0, len(group), size))
+
+    return tasks
+
+
+def renderTrial(jobs):
+    '''Worker task: draw the figures of JOBS, which share one trial
+
+    Returns (job, seconds, error) for each figure; ERROR is None on
+    success, so one bad figure doesn't stop the rest.
+    '''
+
+    # render off-screen; must precede the first pyplot import
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    results = []
+    try:
+        trial = Trial(jobs[0][0])
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        return [(job, 0., error) for job in jobs]
+
+    for job in jobs:
+        start = time.perf_counter()
+        try:
+            renderFigure(trial, job)
+            error = None
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            pyplot.close('all')
+        results.append((job, time.perf_counter() - start, error))
+
+    return results
+
+
+def renderFigure(trial, job):
+    '''Draw and save one figure'''
+    from matplotlib import pyplot
+
+    label, plot, arg, file = job
+
+    if plot == 'scatter':
+        fig = basePlot(xs=trial.pca[:,0], ys=trial.pca[:,1],
+            labels=trial.authors, colors=COLORS, title=label)
+    elif plot == 'authors':
+        fig = trial.plotAuthor(arg, corpus=True)
+    elif plot == 'bench':
+        fig = trial.plotTestPassages(arg, title='{} : {}'.format(
+            label, os.path.basename(arg)))
+
+    if not os.path.exists(os.path.dirname(file)):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+    fig.savefig(file)
+
+    # free the figure, or memory grows with every plot
+    pyplot.close(fig)
+
+
+def printSummary(timings, wall):
+    '''Time per figure by plot type, then any figures that failed'''
+
+    print('{:<10} {:>7} {:>10} {:>10} {:>10}'.format(
+        'plot', 'figures', 'total s', 'mean s', 'max s'))
+    for plot in PLOTS:
+        secs = [sec for (label, p, arg, file), sec, error in timings
+                if p == plot and error is None]
+        if len(secs) > 0:
+            print('{:<10} {:>7} {:>10.2f} {:>10.3f} {:>10.3f}'.format(
+                plot, len(secs), sum(secs), sum(secs) / len(secs), max(secs)))
+
+    failed = [(job, error) for job, sec, error in timings if error is not None]
+    print('{} figures in {:.1f}s; {} failed'.format(
+        len(timings) - len(failed), wall, len(failed)))
+    for (label, plot, arg, file), error in failed:
+        print(' ! {} {} {}: {}'.format(label, plot, arg or '', error))
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Render figures for many trials in parallel, off-screen'
+    )
+    parser.add_argument('trials',
+        nargs='+',
+        help='Trials to plot; shell-style patterns such as "lemmata-30-*" match cached trials.')
+    parser.add_argument('--plots',
+        metavar='TYPE', type=str, default='scatter',
+        help='Comma-separated plot types: "scatter" (all samples), "authors" '
+             '(one per author) and "bench" (one per bench file). Default "scatter".')
+    parser.add_argument('--bench',
+        metavar='FILE', type=str, nargs='+',
+        default=sorted(glob.glob(os.path.join('conf', 'bench', '*.txt'))),
+        help='Bench files for "bench" plots. Default conf/bench/*.txt.')
+    parser.add_argument('--out',
+        metavar='DIR', type=str, default=FIGURES,
+        help='Output directory. Default "{}".'.format(FIGURES))
+    parser.add_argument('--format',
+        metavar='FMT', type=str, default='png', choices=['pdf', 'png'],
+        help='Output file format. Default "png".')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='Render in N parallel processes. Default 1.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    plots = args.plots.split(',')
+    for plot in plots:
+        if plot not in PLOTS:
+            parser.error('unknown plot type {}; choose from {}'.format(plot, ', '.join(PLOTS)))
+
+    labels = findTrials(args.trials)
+    jobs = listFigures(labels, plots, args.bench, args.out, args.format)
+    print('Rendering {} figures for {} trials'.format(len(jobs), len(labels)))
+
+    timings = []
+    start = time.perf_counter()
+
+    # each task loads one trial, so no process holds more than one at a time
+    tasks = groupJobs(jobs, args.workers)
+
+    with Stage('render', total=len(jobs), unit='figures') as stage:
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers) as pool:
+                for results in pool.imap_unordered(renderTrial, tasks):
+                    timings.extend(results)
+                    stage.add(len(results))
+        else:
+            for task in tasks:
+                results = renderTrial(task)
+                timings.extend(results)
+                stage.add(len(results))
+
+    for (label, plot, arg, file), sec, error in sorted(timings, key=lambda t: t[0][3]):
+        if error is None:
+            print(' - {:.3f}s {}'.format(sec, file))
+    printSummary(timings, time.perf_counter() - start)
@@ -9,13 +9,17 @@
 import os
 import sys
 import json
+import zlib
 import argparse
+import itertools
+import multiprocessing
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from mta_summer_2018 import Config, Text
+from mta_summer_2018 import Config, Text, FeatureStore, peakMemory, saveTrial
+from mta_summer_2018 import Stage, addMetricsArgs, startMetrics
 
-import gensim
-from sklearn import decomposition
+# gensim and sklearn are slow to import, so are loaded where they're used
+from scipy import sparse
 import numpy as np
 
 #
@@ -35,140 +39,840 @@ def sampleMaker(lines, size, step, offset):
 
     return samples
 
-#
-# main
-#
 
-if __name__ == '__main__':
+def lineMatrix(lines, dictionary):
+    '''Sparse line x term count matrix, counting each line once'''
 
-    parser = argparse.ArgumentParser(
-        description='Create samples from the corpus, either in contiguous chunks (default) or using a sliding window.'
-    )
-    parser.add_argument('--size',
-        metavar='SIZE', type=int, default=30,
-        help='Make samples of SIZE lines. Default 30.')
-    parser.add_argument('--offset',
-        metavar='OFFSET', type=int, default = 0,
-        help='Shift samples by OFFSET lines. Default 0.')
-    parser.add_argument('--step',
-        metavar='STEP', type=int, default = None,
-        help='Move window by STEP lines each time. Default SIZE (no overlap between samples).')
-    parser.add_argument('--feature',
-        metavar='FEAT', type=str, default = 'lemmata',
-        help='Featureset to sample. Default "lemmata".')
-    parser.add_argument('--label',
-        metavar='LABEL', type=str, default=None,
-        help='Trial label. Default "FEAT-SIZE-OFFSET"')
+    indptr = [0]
+    indices = []
+    data = []
 
-    args = parser.parse_args()
+    for line in lines:
+        for term, count in dictionary.doc2bow(line):
+            indices.append(term)
+            data.append(count)
+        indptr.append(len(indices))
 
-    # set the default series label
-    if args.label is None:
-        if args.step is None:
-            args.label = '{f}-{s}-{o:02d}'.format(
-                f = args.feature,
-                s = args.size,
-                o = args.offset)
-        else:
-            args.label = '{f}-{s}-{t}-{o:02d}'.format(
-                f = args.feature,
-                s = args.size,
-                t = args.step,
-                o = args.offset)
-            
-    # set the default step size
-    if args.step is None:
-        args.step = args.size
+    return sparse.csr_matrix((data, indices, indptr),
+        shape=(len(lines), len(dictionary)), dtype=np.int64)
 
-    # clean cache dir
-    cache = os.path.join(Config.DATA, 'cache', args.label)
-    if not os.path.exists(cache):
-        os.makedirs(cache)
 
-    #
-    # sampling
-    #
+def storeMatrix(store, author, dictmap, num_terms):
+    '''Sparse line x term count matrix straight from a FeatureStore'''
 
-    print('Sampling {f}: size={s}; step={t}; offset={o}'.format(
-        f = args.feature,
-        s = args.size,
-        t = args.step,
-        o = args.offset))
+    ids = dictmap[store.tokens(author)]
+    offsets = store.offsets(author)
+
+    # line number of every token; drop tokens not in the dictionary
+    lines = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    keep = ids >= 0
+
+    counts = sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=np.int64), (lines[keep], ids[keep])),
+        shape=(len(offsets) - 1, num_terms))
+    counts.sum_duplicates()
+
+    return counts
+
+
+class FeatureHasher(object):
+    '''Map lemmata, and optionally their character n-grams, onto a fixed-width space
+
+    Each feature's column is a CRC-32 of its text, so columns are the
+    same in every run and every process, and no dictionary is needed:
+    lines are counted as they are read. Lemmata and n-grams of each
+    length are prefixed differently so they hash apart.
+    '''
+
+    def __init__(self, bits=18, ngrams=()):
+        self.bits = bits
+        self.width = 2 ** bits
+        self.ngrams = sorted(set(ngrams))
+        self._columns = dict()
+
+
+    @property
+    def name(self):
+        '''Short description for trial labels, e.g. "h18" or "h18c3-4"'''
+
+        name = 'h{}'.format(self.bits)
+        if len(self.ngrams) > 0:
+            name += 'c' + '-'.join(str(n) for n in self.ngrams)
+
+        return name
+
+
+    def features(self, token):
+        '''The lemma itself, then its character n-grams, padded with "<" and ">"'''
+
+        feats = ['w:' + token]
+        padded = '<' + token + '>'
+        for n in self.ngrams:
+            feats.extend('c{}:{}'.format(n, padded[i:i+n])
+                         for i in range(len(padded) - n + 1))
+
+        return feats
+
+
+    def columns(self, token):
+        '''Columns of all of a token's features, remembered per token'''
+
+        cols = self._columns.get(token)
+        if cols is None:
+            cols = [zlib.crc32(feat.encode('utf-8')) & (self.width - 1)
+                    for feat in self.features(token)]
+            self._columns[token] = cols
+
+        return cols
+
+
+    def lineMatrix(self, lines):
+        '''Sparse line x column count matrix of tokenized lines'''
+
+        indptr = [0]
+        indices = []
+
+        for line in lines:
+            for tok in line:
+                indices.extend(self.columns(tok))
+            indptr.append(len(indices))
+
+        counts = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int64), indices, indptr),
+            shape=(len(lines), self.width))
+        counts.sum_duplicates()
+
+        return counts
+
+
+    def vocabMatrix(self, vocab):
+        '''Sparse token x column count matrix for a FeatureStore vocabulary'''
+
+        return self.lineMatrix([[tok] for tok in vocab])
+
+
+def storeHashMatrix(store, author, vocab_matrix):
+    '''Sparse line x column count matrix from a FeatureStore, via FeatureHasher.vocabMatrix()'''
+
+    tokens = store.tokens(author)
+    offsets = store.offsets(author)
+
+    lines = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    onehot = sparse.csr_matrix(
+        (np.ones(len(tokens), dtype=np.int64), (lines, tokens)),
+        shape=(len(offsets) - 1, vocab_matrix.shape[0]))
+
+    return onehot.dot(vocab_matrix).tocsr()
+
+
+def windowBows(counts, size, step, offset):
+    '''Bag-of-words vectors for the same windows as sampleMaker(), as a list'''
+
+    return list(iterWindowBows(counts, size, step, offset))
+
+
+def iterWindowBows(counts, size, step, offset):
+    '''Generate bag-of-words vectors for the same windows as sampleMaker()
+
+    COUNTS is a lineMatrix(). Each window's counts are the previous
+    window's plus the lines entering it minus the lines leaving it, so
+    every line is added and removed once however large the window.
+    Output matches dictionary.doc2bow() on the concatenated window.
+    '''
+
+    starts = range(offset, counts.shape[0]-size, step)
+
+    # difference matrix: row k is window k minus window k-1
+    rows = []
+    cols = []
+    vals = []
+    a0 = b0 = 0
+    for k, a in enumerate(starts):
+        b = a + size
+        enter = np.arange(max(a, b0), b)
+        leave = np.arange(a0, min(a, b0))
+        rows.append(np.full(len(enter) + len(leave), k))
+        cols.extend([enter, leave])
+        vals.extend([np.ones(len(enter)), -np.ones(len(leave))])
+        a0, b0 = a, b
+
+    if len(rows) == 0:
+        return
+
+    diff = sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(starts), counts.shape[0]), dtype=np.int64)
+    diff = diff.dot(counts).tocsr()
+    diff.sort_indices()
+
+    # running sum over the difference rows
+    acc = np.zeros(counts.shape[1], dtype=np.int64)
+    terms = np.zeros(0, dtype=diff.indices.dtype)
+    for k in range(len(starts)):
+        idx = diff.indices[diff.indptr[k]:diff.indptr[k+1]]
+        acc[idx] += diff.data[diff.indptr[k]:diff.indptr[k+1]]
+        terms = np.union1d(terms, idx)
+        terms = terms[acc[terms] != 0]
+        yield list(zip(terms.tolist(), acc[terms].tolist()))
+
+
+def chunkBounds(n, chunk, minimum=1):
+    '''Split N rows into ranges of CHUNK rows, folding a last range smaller than MINIMUM into the one before'''
+
+    bounds = list(range(0, n, chunk)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < minimum:
+        del bounds[-2]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iterChunks(stream, bounds):
+    '''Cut a stream into lists of rows following chunkBounds()'''
+
+    stream = iter(stream)
+    for start, stop in bounds:
+        yield list(itertools.islice(stream, stop - start))
+
+
+class WindowCorpus(object):
+    '''Re-iterable stream of every text's window vectors, made on demand'''
+
+    def __init__(self, corpus, dictionary, size, step, offset, engine='prefix'):
+        self.corpus = corpus
+        self.dictionary = dictionary
+        self.size = size
+        self.step = step
+        self.offset = offset
+        self.engine = engine
+
+
+    def __iter__(self):
+        for text in self.corpus:
+            if self.engine == 'copy':
+                for sample in sampleMaker(text.features, self.size, self.step, self.offset):
+                    yield self.dictionary.doc2bow(sample)
+            else:
+                for bow in iterWindowBows(text.counts, self.size, self.step, self.offset):
+                    yield bow
+
+
+def sparsePCA(m, npcs):
+    '''PCA of a sparse matrix by truncated SVD, without densifying it
+
+    The column means are subtracted implicitly inside the matrix-vector
+    products, so this gives the same components as decomposition.PCA
+    on the dense matrix, with signs fixed the same way.
+    '''
+    from scipy.sparse.linalg import LinearOperator, svds
+    from sklearn.utils.extmath import svd_flip
+
+    mu = np.asarray(m.mean(axis=0)).ravel()
+
+    def matvec(v):
+        v = np.ravel(v)
+        return m.dot(v) - mu.dot(v)
+
+    def rmatvec(u):
+        u = np.ravel(u)
+        return m.T.dot(u) - mu * u.sum()
+
+    centered = LinearOperator(m.shape, matvec=matvec, rmatvec=rmatvec,
+                              dtype=m.dtype)
+
+    u, s, vt = svds(centered, k=npcs)
+
+    # svds returns singular values in ascending order
+    order = np.argsort(s)[::-1]
+    u, s, vt = u[:, order], s[order], vt[order]
+    # signs chosen from the components, as decomposition.PCA does
+    u, vt = svd_flip(u, vt, u_based_decision=False)
+
+    # explained variance, as a share of the total variance of M
+    n = m.shape[0]
+    variance = s ** 2 / (n - 1)
+    total = (m.multiply(m).sum() - n * mu.dot(mu)) / (n - 1)
+
+    return u * s, {
+        'pca_components': vt,
+        'pca_variance': variance,
+        'pca_variance_ratio': variance / total,
+    }
+
+def trialLabel(feature, size, step, offset):
+    '''Default trial label: FEAT-SIZE-OFFSET, or FEAT-SIZE-STEP-OFFSET'''
+
+    if step is None:
+        return '{f}-{s}-{o:02d}'.format(
+            f = feature,
+            s = size,
+            o = offset)
+    else:
+        return '{f}-{s}-{t}-{o:02d}'.format(
+            f = feature,
+            s = size,
+            t = step,
+            o = offset)
+
+
+def parseGrid(spec, size=None):
+    '''Parse a grid spec: "A:B" or "A:B:STEP" (inclusive), "A,B,C", or "all" for 0..SIZE-1'''
+
+    if spec == 'all':
+        return list(range(size))
+
+    if ':' in spec:
+        parts = [int(x) for x in spec.split(':')]
+        start, stop = parts[0], parts[1]
+        step = parts[2] if len(parts) > 2 else 1
+        return list(range(start, stop + 1, step))
+
+    return [int(x) for x in spec.split(',')]
+
+
+def loadCorpus(feature, dictionary, engine='prefix', hasher=None):
+    '''Read every text's loci and features once, ready for sampling
+
+    If lemmatize.py left a columnar store built against this dictionary,
+    line counts come straight from its arrays; otherwise from JSON.
+    With a FeatureHasher, counts are hashed from the store's vocabulary
+    or the JSON lemmata, and DICTIONARY is not used.
+    '''
 
     # Read the corpus metadata
     with open(Config.INDEX) as f:
         corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
 
-    # initialize corpus-wide samples, labels
-    samples = []
+    # columnar store, if there is one matching the dictionary
+    dictmap = None
+    vocab_matrix = None
+    if engine == 'prefix':
+        store = FeatureStore.open(os.path.join(Config.DATA, feature, 'store'))
+        if store is not None and hasher is not None:
+            vocab_matrix = hasher.vocabMatrix(store.getVocab())
+        elif store is not None:
+            dictmap = store.dictMap(os.path.join(Config.DATA, feature, 'gensim.dict'))
+        if dictmap is not None:
+            dictmap = np.asarray(dictmap)
+
+    for text in corpus:
+        print(' - reading {} {}'.format(text.author, text.title))
+
+        if vocab_matrix is not None and text.author in store.manifest['authors']:
+            text.loci = store.loci(text.author).tolist()
+            text.counts = storeHashMatrix(store, text.author, vocab_matrix)
+            continue
+
+        if dictmap is not None and text.author in store.manifest['authors']:
+            text.loci = store.loci(text.author).tolist()
+            text.counts = storeMatrix(store, text.author, dictmap, len(dictionary))
+            continue
+
+        text.dataFromJson(os.path.join(Config.DATA, 'lines', text.author + '.json'))
+
+        # read feature file
+        filename = os.path.join(Config.DATA, feature, text.author + '.json')
+        with open(filename) as f:
+            text.features = json.load(f)
+
+        # line-level counts are shared by every window size and offset
+        if hasher is not None:
+            text.counts = hasher.lineMatrix(text.features)
+            text.features = None
+        elif engine == 'prefix':
+            text.counts = lineMatrix(text.features, dictionary)
+            text.features = None
+
+    return corpus
+
+
+def makeSamples(corpus, dictionary, size, step, offset, engine='prefix', quiet=False):
+    '''Sample every text; return bag-of-words vectors, loci and author labels'''
+
+    # initialize corpus-wide bag-of-words vectors, labels
+    vec = []
     loci = []
     authors = []
 
     # iterate over texts
     for text in corpus:
-        print(' - {} {}'.format(text.author, text.title), end='...')
-        text.dataFromJson(os.path.join(Config.DATA, 'lines', text.author + '.json'))
+        locs = sampleMaker([[l] for l in text.loci], size, step, offset)
 
-        # read feature file, sample
-        filename = os.path.join(Config.DATA, args.feature, text.author + '.json')
-        with open(filename) as f:
-            features = json.load(f)
-        sams = sampleMaker(features, args.size, args.step, args.offset)
-        locs = sampleMaker([[l] for l in text.loci], args.size, args.step, args.offset)
-        print('{} samples'.format(len(sams)))
+        # create vector model
+        if engine == 'copy':
+            sams = sampleMaker(text.features, size, step, offset)
+            bows = [dictionary.doc2bow(sample) for sample in sams]
+        else:
+            bows = windowBows(text.counts, size, step, offset)
+
+        if not quiet:
+            print(' - {} {}...{} samples'.format(text.author, text.title, len(bows)))
 
         # add these samples, labels to master lists
-        authors.extend([text.author] * len(sams))
+        authors.extend([text.author] * len(bows))
         loci.extend(locs)
-        samples.extend(sams)
+        vec.extend(bows)
 
-    # save author labels
-    authors = np.array(authors)
-    author_file = os.path.join(cache, 'authors.txt')
-    print('Writing {}'.format(author_file))
-    np.savetxt(author_file, authors, fmt='%s')
+    return vec, loci, authors
 
-    # save loci
-    loci_file = os.path.join(cache, 'loci.txt')
-    print('Writing {}'.format(loci_file))
-    with open(loci_file, 'w') as f:
-        json.dump(loci, f)
 
-    #
-    # feature extraction
-    #
+def sampleLabels(corpus, size, step, offset, quiet=False):
+    '''Loci and author labels of every window, without counting them'''
+
+    loci = []
+    authors = []
+
+    for text in corpus:
+        locs = sampleMaker([[l] for l in text.loci], size, step, offset)
+
+        if not quiet:
+            print(' - {} {}...{} samples'.format(text.author, text.title, len(locs)))
+
+        authors.extend([text.author] * len(locs))
+        loci.extend(locs)
+
+    return loci, authors
 
-    # load gensim dictionary
-    dict_file = os.path.join(Config.DATA, args.feature, 'gensim.dict')
-    dictionary = gensim.corpora.Dictionary.load(dict_file)
 
-    # create vector model
-    print('Building vector model')
-    vec = [dictionary.doc2bow(sample) for sample in samples]
+def makeTfidf(vec, num_terms, use_sparse=False):
+    '''TF-IDF weighting of bag-of-words vectors, as a samples x terms matrix'''
+    import gensim
 
     # tfidf weighting
     tfidf_model = gensim.models.TfidfModel(vec)
     tfidf = tfidf_model[vec]
 
-    # convert gensim vectors to numpy matrix
-    m = gensim.matutils.corpus2dense(tfidf, num_terms=len(dictionary))
-    m = m.transpose()
+    if use_sparse:
+        # convert gensim vectors to scipy CSR matrix
+        m = gensim.matutils.corpus2csc(tfidf, num_terms=num_terms)
+        m = m.transpose().tocsr()
 
-    # save TF-IDF features
-    tfidf_file = os.path.join(cache, 'tfidf.txt')
-    print('Writing {}'.format(tfidf_file))
-    np.savetxt(tfidf_file, m)
+    else:
+        # convert gensim vectors to numpy matrix
+        m = gensim.matutils.corpus2dense(tfidf, num_terms=num_terms)
+        m = m.transpose()
 
-    #
-    # dimensionality reduction
-    #
+    return m
+
+
+def hashTfidf(vecs, num_terms):
+    '''TF-IDF weighting of hashed window vectors in a single pass, as a sparse matrix
+
+    Document frequencies are counted as the vectors stream past, so
+    VECS may be a one-shot stream. Weights follow gensim's defaults:
+    raw counts times log2(N / df), each row scaled to unit length.
+    '''
+
+    df = np.zeros(num_terms, dtype=np.int64)
+    indptr = [0]
+    indices = []
+    data = []
+
+    for bow in vecs:
+        cols = [term for term, count in bow]
+        df[cols] += 1
+        indices.extend(cols)
+        data.extend(count for term, count in bow)
+        indptr.append(len(indices))
+
+    n = len(indptr) - 1
+    m = sparse.csr_matrix((np.array(data, dtype=np.float64), indices, indptr),
+                          shape=(n, num_terms))
+
+    # terms in every window get zero weight, as in gensim
+    m.data *= np.log2(n / np.maximum(df, 1))[m.indices]
+    m.eliminate_zeros()
+
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    m = sparse.diags(1 / norms).dot(m).tocsr()
+
+    return m
+
+
+def makePCA(m, npcs=10):
+    '''PCA of a dense or sparse TF-IDF matrix; returns scores and fitted model'''
+    from sklearn import decomposition
+
+    if sparse.issparse(m):
+        return sparsePCA(m, npcs)
 
-    # PCA
-    npcs = 10
-    print('Calculating {} principal components'.format(npcs))
     pcmodel = decomposition.PCA(npcs)
     pca = pcmodel.fit_transform(m)
+    model = {
+        'pca_components': pcmodel.components_,
+        'pca_variance': pcmodel.explained_variance_,
+        'pca_variance_ratio': pcmodel.explained_variance_ratio_,
+    }
+
+    return pca, model
+
+
+def makeFeatures(vec, num_terms, npcs=10, use_sparse=False):
+    '''TF-IDF weighting and PCA of bag-of-words vectors'''
+
+    m = makeTfidf(vec, num_terms, use_sparse)
+    pca, model = makePCA(m, npcs)
+
+    return m, pca, model
+
+
+def streamFeatures(vecs, num_terms, path, npcs=10, chunk=1000):
+    '''TF-IDF weighting and incremental PCA, streaming rows in chunks to disk
+
+    VECS must be re-iterable, e.g. a WindowCorpus; it is read once for
+    document frequencies, once to fit the PCA and once to transform.
+    Only CHUNK rows at a time are ever in memory: the PCA features go
+    straight into a memory-mapped PATH/pca.npy, and the sparse TF-IDF
+    matrix into PATH/tfidf.npz. Returns the fitted model's arrays.
+    '''
+    import gensim
+    import shutil
+    import zipfile
+    from numpy.lib.format import open_memmap
+    from sklearn import decomposition
+
+    # tfidf weighting
+    tfidf_model = gensim.models.TfidfModel(vecs)
+    tfidf = tfidf_model[vecs]
+    n = tfidf_model.num_docs
+
+    # IncrementalPCA needs at least npcs rows in every chunk
+    bounds = chunkBounds(n, chunk, npcs)
+
+    # fit, counting the non-zero weights to size the TF-IDF arrays
+    pcmodel = decomposition.IncrementalPCA(npcs)
+    nnz = 0
+    for rows in iterChunks(tfidf, bounds):
+        m = gensim.matutils.corpus2dense(rows, num_terms=num_terms, num_docs=len(rows))
+        pcmodel.partial_fit(m.transpose())
+        nnz += int(np.count_nonzero(m))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    parts = os.path.join(path, 'tfidf.parts')
+    if os.path.exists(parts):
+        shutil.rmtree(parts)
+    os.makedirs(parts)
+
+    # CSR arrays of the TF-IDF matrix, filled in chunk by chunk
+    index_dtype = np.int32 if nnz < 2**31 else np.int64
+    csr = {
+        'data': open_memmap(os.path.join(parts, 'data.npy'), mode='w+',
+                            dtype=np.float32, shape=(nnz,)),
+        'indices': open_memmap(os.path.join(parts, 'indices.npy'), mode='w+',
+                               dtype=index_dtype, shape=(nnz,)),
+        'indptr': open_memmap(os.path.join(parts, 'indptr.npy'), mode='w+',
+                              dtype=index_dtype, shape=(n + 1,)),
+    }
+    csr['indptr'][0] = 0
+    np.save(os.path.join(parts, 'format.npy'), np.array(b'csr'))
+    np.save(os.path.join(parts, 'shape.npy'), np.array([n, num_terms]))
+
+    pca = None
+    done = 0
+    for (start, stop), rows in zip(bounds, iterChunks(tfidf, bounds)):
+        m = gensim.matutils.corpus2dense(rows, num_terms=num_terms, num_docs=len(rows))
+        m = m.transpose()
+
+        features = pcmodel.transform(m)
+        if pca is None:
+            pca = open_memmap(os.path.join(path, 'pca.npy'), mode='w+',
+                              dtype=features.dtype, shape=(n, npcs))
+        pca[start:stop] = features
+
+        part = sparse.csr_matrix(m)
+        csr['data'][done:done+part.nnz] = part.data
+        csr['indices'][done:done+part.nnz] = part.indices
+        csr['indptr'][start+1:stop+1] = part.indptr[1:] + done
+        done += part.nnz
+
+    pca.flush()
+    for array in csr.values():
+        array.flush()
+    del pca, csr
+
+    # pack the arrays as scipy.sparse.save_npz() does, a file at a time
+    tmp = os.path.join(path, 'tfidf.npz.tmp')
+    with zipfile.ZipFile(tmp, 'w', allowZip64=True) as f:
+        for name in ('format', 'shape', 'data', 'indices', 'indptr'):
+            f.write(os.path.join(parts, name + '.npy'), name + '.npy')
+    os.replace(tmp, os.path.join(path, 'tfidf.npz'))
+    shutil.rmtree(parts)
+
+    model = {
+        'pca_components': pcmodel.components_,
+        'pca_variance': pcmodel.explained_variance_,
+        'pca_variance_ratio': pcmodel.explained_variance_ratio_,
+    }
+
+    return model
+
+
+def runTrial(corpus, dictionary, feature, size, step, offset, label=None,
+             engine='prefix', use_sparse=False, quiet=False, npcs=10, chunk=None,
+             hasher=None):
+    '''Sample, weight and reduce one trial, and write it to the cache
+
+    If CHUNK is given, windows are streamed through an incremental PCA
+    CHUNK rows at a time, and the features written to the cache as they
+    are made, instead of being held in memory. With a FeatureHasher,
+    CORPUS must come from loadCorpus() with the same hasher; TF-IDF is
+    then always sparse, and windows are weighted as they stream past.
+    CHUNK and HASHER can't be combined.
+    '''
+
+    # set the default series label
+    if label is None:
+        if hasher is None:
+            label = trialLabel(feature, size, step, offset)
+        else:
+            label = trialLabel(feature + '_' + hasher.name, size, step, offset)
+
+    # set the default step size
+    if step is None:
+        step = size
+
+    cache = os.path.join(Config.DATA, 'cache', label)
+
+    #
+    # sampling
+    #
+
+    print('Sampling {f}: size={s}; step={t}; offset={o}'.format(
+        f = feature,
+        s = size,
+        t = step,
+        o = offset))
+
+    with Stage(label, unit='samples', quiet=quiet) as run:
+
+        with Stage('sample', unit='samples', quiet=quiet) as stage:
+            if chunk is None:
+                vec, loci, authors = makeSamples(corpus, dictionary, size, step,
+                                                 offset, engine, quiet)
+            else:
+                vec = WindowCorpus(corpus, dictionary, size, step, offset, engine)
+                loci, authors = sampleLabels(corpus, size, step, offset, quiet)
+            stage.add(len(authors))
+
+        #
+        # feature extraction, dimensionality reduction
+        #
+
+        if not quiet:
+            print('Calculating {} principal components'.format(npcs))
+        written = None
+        if hasher is not None:
+            with Stage('hashed_tfidf', unit='samples', quiet=quiet) as stage:
+                m = hashTfidf(vec, hasher.width)
+                stage.add(len(authors))
+            with Stage('pca', unit='samples', quiet=quiet) as stage:
+                pca, model = makePCA(m, npcs)
+                stage.add(len(authors))
+        elif chunk is None:
+            with Stage('tfidf', unit='samples', quiet=quiet) as stage:
+                m = makeTfidf(vec, len(dictionary), use_sparse)
+                stage.add(len(authors))
+            with Stage('pca', unit='samples', quiet=quiet) as stage:
+                pca, model = makePCA(m, npcs)
+                stage.add(len(authors))
+        else:
+            with Stage('streamed_pca', unit='samples', quiet=quiet) as stage:
+                model = streamFeatures(vec, len(dictionary), cache, npcs, chunk)
+                stage.add(len(authors))
+            m, pca = None, None
+            written = {'pca': 'pca.npy', 'tfidf': 'tfidf.npz'}
+
+        # save authors, loci, TF-IDF and PCA features, fitted PCA model
+        meta = {
+            'label': label,
+            'feature': feature,
+            'size': size,
+            'step': step,
+            'offset': offset,
+            'components': npcs,
+        }
+        if hasher is not None:
+            meta['hashing'] = {'bits': hasher.bits, 'ngrams': hasher.ngrams}
+
+        print('Writing trial {}'.format(cache))
+        with Stage('save', unit='samples', quiet=quiet) as stage:
+            saveTrial(cache, authors, loci, pca, tfidf=m, arrays=model, meta=meta,
+                      written=written)
+            stage.add(len(authors))
+
+        run.add(len(authors))
+
+    return label, len(authors)
+
+
+# corpus and options shared with sweep workers
+SWEEP = {}
+
+def initSweep(state):
+    '''Worker initializer: keep the corpus and options for sweepPoint()
+
+    Handed to each worker as Pool initargs rather than inherited from
+    the parent, so this works whatever the start method: with fork
+    nothing is copied, with spawn the state is pickled once per worker.
+    '''
+
+    SWEEP.clear()
+    SWEEP.update(state)
+
+
+def sweepPoint(point):
+    '''Worker task: run one (size, offset) point of a sweep'''
+
+    size, offset = point
+
+    return runTrial(SWEEP['corpus'], SWEEP['dictionary'], SWEEP['feature'],
+                    size, SWEEP['step'], offset, engine=SWEEP['engine'],
+                    use_sparse=SWEEP['sparse'], quiet=True,
+                    npcs=SWEEP['components'], chunk=SWEEP['chunk'],
+                    hasher=SWEEP.get('hasher'))
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Create samples from the corpus, either in contiguous chunks (default) or using a sliding window.'
+    )
+    parser.add_argument('--size',
+        metavar='SIZE', type=int, default=30,
+        help='Make samples of SIZE lines. Default 30.')
+    parser.add_argument('--offset',
+        metavar='OFFSET', type=int, default = 0,
+        help='Shift samples by OFFSET lines. Default 0.')
+    parser.add_argument('--step',
+        metavar='STEP', type=int, default = None,
+        help='Move window by STEP lines each time. Default SIZE (no overlap between samples).')
+    parser.add_argument('--feature',
+        metavar='FEAT', type=str, default = 'lemmata',
+        help='Featureset to sample. Default "lemmata".')
+    parser.add_argument('--label',
+        metavar='LABEL', type=str, default=None,
+        help='Trial label. Default "FEAT-SIZE-OFFSET"')
+    parser.add_argument('--sparse',
+        action='store_true',
+        help='Keep TF-IDF sparse: write tfidf.npz and use truncated SVD for PCA.')
+    parser.add_argument('--components',
+        metavar='N', type=int, default=10,
+        help='Number of principal components. Default 10.')
+    parser.add_argument('--out-of-core',
+        metavar='ROWS', type=int, default=None, dest='chunk',
+        help='Stream samples through an incremental PCA ROWS at a time, '
+             'keeping memory bounded for very many windows. ROWS must be at '
+             'least --components; a shorter last chunk joins the one before.')
+    parser.add_argument('--engine',
+        metavar='ENGINE', type=str, default='prefix', choices=['prefix', 'copy'],
+        help='How to count windows: "prefix" counts each line once and '
+             'differences running sums; "copy" rebuilds every window. '
+             'Default "prefix".')
+    parser.add_argument('--hashing',
+        metavar='BITS', type=int, default=None,
+        help='Skip the gensim dictionary: hash features into 2^BITS columns '
+             'while reading lines, and weight windows in one pass. Implies '
+             '--sparse. Default label "FEAT_hBITS-SIZE-OFFSET".')
+    parser.add_argument('--char-ngrams',
+        metavar='SPEC', type=str, default=None,
+        help='With --hashing, also hash character n-grams of each lemma, '
+             'e.g. "3" or "3:5". Default none.')
+    parser.add_argument('--sizes',
+        metavar='SPEC', type=str, default=None,
+        help='Sweep over sample sizes, e.g. "10:100:10" or "10,30,50". '
+             'Writes one trial per grid point with default labels.')
+    parser.add_argument('--offsets',
+        metavar='SPEC', type=str, default=None,
+        help='Offsets to sweep for each size, e.g. "0:9", "0,15", or "all" '
+             'for 0..SIZE-1. Default OFFSET.')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='Run sweep points in N parallel processes. Default 1.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    # IncrementalPCA needs at least as many rows as components in every chunk
+    if args.chunk is not None and args.hashing is not None:
+        parser.error('--out-of-core works with the dictionary only, not --hashing')
+    if args.chunk is not None and args.chunk < args.components:
+        parser.error('--out-of-core ROWS must be at least --components ({})'.format(
+            args.components))
+
+    if args.hashing is None:
+        if args.char_ngrams is not None:
+            parser.error('--char-ngrams needs --hashing')
+        hasher = None
+
+        # load gensim dictionary
+        import gensim
+        dict_file = os.path.join(Config.DATA, args.feature, 'gensim.dict')
+        if not os.path.exists(dict_file):
+            parser.error('No dictionary at {}; run lemmatize.py without '
+                         '--no-dictionary, or sample with --hashing'.format(dict_file))
+        dictionary = gensim.corpora.Dictionary.load(dict_file)
+
+    else:
+        if args.engine == 'copy':
+            parser.error('--hashing counts lines once; use --engine prefix')
+        ngrams = [] if args.char_ngrams is None else parseGrid(args.char_ngrams)
+        hasher = FeatureHasher(args.hashing, ngrams)
+        dictionary = None
+
+    # read the corpus once
+    print('Loading {}'.format(args.feature))
+    with Stage('load', unit='texts') as stage:
+        corpus = loadCorpus(args.feature, dictionary, args.engine, hasher)
+        stage.add(len(corpus))
+        stage.add(sum(len(text.loci) for text in corpus), 'lines')
+
+    if args.sizes is None:
+        runTrial(corpus, dictionary, args.feature, args.size, args.step,
+                 args.offset, args.label, args.engine, args.sparse,
+                 npcs=args.components, chunk=args.chunk, hasher=hasher)
+
+    else:
+        # build the parameter grid
+        grid = []
+        for size in parseGrid(args.sizes):
+            if args.offsets is None:
+                offsets = [args.offset]
+            else:
+                offsets = parseGrid(args.offsets, size)
+            grid.extend([(size, offset) for offset in offsets])
+        print('Sweeping {} trials'.format(len(grid)))
+
+        if args.label is not None:
+            print('Ignoring --label in sweep mode')
+
+        # loaded corpus and options, for this process or each worker
+        state = {
+            'corpus': corpus,
+            'dictionary': dictionary,
+            'feature': args.feature,
+            'step': args.step,
+            'engine': args.engine,
+            'sparse': args.sparse,
+            'components': args.components,
+            'chunk': args.chunk,
+            'hasher': hasher,
+        }
+
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers, initializer=initSweep,
+                                      initargs=(state,)) as pool:
+                results = pool.imap_unordered(sweepPoint, grid)
+                for i, (label, n) in enumerate(results):
+                    print('[{}/{}] {}: {} samples'.format(i+1, len(grid), label, n))
+        else:
+            initSweep(state)
+            for i, point in enumerate(grid):
+                label, n = sweepPoint(point)
+                print('[{}/{}] {}: {} samples'.format(i+1, len(grid), label, n))
 
-    # save PCA features
-    pca_file = os.path.join(cache, 'pca.txt')
-    np.savetxt(pca_file, pca)
\ No newline at end of file
+    print('Peak memory: {:.0f} MB'.format(peakMemory()))
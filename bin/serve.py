@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+'''Serve trial queries and plots from memory
+
+   A local HTTP service that keeps recently used trials loaded, so that
+   locus lookups, passage ranges, neighbour queries and figures are
+   answered without reloading numpy, matplotlib or the trial cache.
+   All answers are JSON, except /plot, which returns an image.
+
+   GET /trials                                  cached trial labels
+   GET /trial?trial=T                           a trial's manifest
+   GET /loc?trial=T&author=A&loc=L              sample containing a locus
+   GET /passage?trial=T&author=A&start=L&stop=L samples spanning a passage
+   GET /neighbours?trial=T&author=A&start=L&stop=L[&k=10&space=pca&other=1]
+   GET /plot?trial=T[&author=A[&start=L&stop=L]][&format=png]
+   GET /_stats                                  cache and latency counters
+'''
+
+#
+# import statements
+#
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Config, findTrials
+from plot import Trial, basePlot, COLORS
+
+#
+# functions
+#
+
+class QueryError(Exception):
+    '''A request we can't answer, with the HTTP status to send'''
+
+    def __init__(self, status, message):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+class TrialCache(object):
+    '''The SIZE most recently used trials, loaded on demand'''
+
+    def __init__(self, size=4):
+        self.size = size
+        self.trials = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = dict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, label):
+        '''Loaded Trial for LABEL; raises QueryError if there's no such trial'''
+
+        with self.lock:
+            if label in self.trials:
+                self.hits += 1
+                self.trials.move_to_end(label)
+                return self.trials[label]
+            self.misses += 1
+
+            # one lock per label, so a trial is only loaded once at a time
+            load_lock = self.loading.setdefault(label, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if label in self.trials:
+                    return self.trials[label]
+
+            if label not in findTrials([label]):
+                raise QueryError(404, 'No trial {}'.format(label))
+            trial = Trial(label)
+
+            with self.lock:
+                self.trials[label] = trial
+                while len(self.trials) > self.size:
+                    self.trials.popitem(last=False)
+
+        return trial
+
+
+class TrialServer(ThreadingHTTPServer):
+    '''Threaded HTTP server answering queries against cached trials'''
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), cache_size=4, verbose=False):
+        super(TrialServer, self).__init__(address, QueryHandler)
+        self.cache = TrialCache(cache_size)
+        self.verbose = verbose
+
+        # pyplot keeps global state, so figures are drawn one at a time
+        self.plot_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'seconds': 0.,
+        }
+        self.thread = None
+
+
+    @property
+    def url(self):
+        '''Base URL of the service'''
+
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+
+    def start(self):
+        '''Serve from a background thread; returns the base URL'''
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self.url
+
+
+    def stop(self):
+        '''Shut down a server started with start()'''
+
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def count(self, seconds, error=False):
+        '''Record one answered request'''
+
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['seconds'] += seconds
+            if error:
+                self.stats['errors'] += 1
+
+
+    def getStats(self):
+        '''Counters, with cache state and mean latency'''
+
+        with self.lock:
+            stats = dict(self.stats)
+        stats['mean_ms'] = 1000 * stats['seconds'] / max(stats['requests'], 1)
+        stats['cache_hits'] = self.cache.hits
+        stats['cache_misses'] = self.cache.misses
+        stats['loaded'] = list(self.cache.trials.keys())
+
+        return stats
+
+
+def sampleInfo(trial, i):
+    '''JSON-ready description of sample I'''
+
+    first, last = trial.sampleRange(i)
+
+    return {'sample': int(i), 'author': str(trial.authors[i]),
+            'first': first, 'last': last}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''Answer one request'''
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        params = {key: val[0] for key, val in parse_qs(url.query).items()}
+        route = url.path.strip('/')
+
+        error = False
+        try:
+            handler = getattr(self, 'get_' + route, None)
+            if handler is None:
+                raise QueryError(404, 'No such endpoint /{}'.format(route))
+            handler(params)
+        except QueryError as e:
+            error = True
+            self._json({'error': str(e)}, e.status)
+        except Exception as e:
+            error = True
+            self._json({'error': '{}: {}'.format(type(e).__name__, e)}, 500)
+
+        self.server.count(time.perf_counter() - start, error)
+
+
+    def _param(self, params, key, default=None):
+        '''One query parameter; raises QueryError if missing without a default'''
+
+        if key in params:
+            return params[key]
+        if default is None:
+            raise QueryError(400, 'Missing parameter {}'.format(key))
+        return default
+
+
+    def _count(self, params, key, default):
+        '''A positive integer query parameter; raises QueryError if it isn't one'''
+
+        value = self._param(params, key, default)
+        try:
+            n = int(value)
+        except ValueError:
+            n = 0
+        if n < 1:
+            raise QueryError(400, 'Parameter {} must be a positive integer, not {}'.format(
+                key, value))
+
+        return n
+
+
+    def _trial(self, params):
+        return self.server.cache.get(self._param(params, 'trial'))
+
+
+    def _passage(self, trial, params):
+        '''Sample ids spanning the passage in PARAMS'''
+
+        author = self._param(params, 'author')
+        try:
+            ids = trial.findPassage(author, self._param(params, 'start'),
+                                    self._param(params, 'stop'))
+        except ValueError:
+            # a stop locus not of the form BOOK.LINE
+            ids = None
+        if ids is None:
+            raise QueryError(404, 'No passage {} {}-{}'.format(
+                author, params['start'], params['stop']))
+
+        return ids
+
+
+    def get_trials(self, params):
+        self._json({'trials': findTrials(['*'])})
+
+
+    def get_trial(self, params):
+        self._json(self._trial(params).manifest)
+
+
+    def get_loc(self, params):
+        trial = self._trial(params)
+        author = self._param(params, 'author')
+        loc = self._param(params, 'loc')
+
+        i = trial.findLoc(author, loc, quiet=True)
+        if i is None:
+            raise QueryError(404, 'No locus {} {}'.format(author, loc))
+        self._json(sampleInfo(trial, i))
+
+
+    def get_passage(self, params):
+        trial = self._trial(params)
+        ids = self._passage(trial, params)
+        self._json({'samples': [sampleInfo(trial, i) for i in ids]})
+
+
+    def get_neighbours(self, params):
+        trial = self._trial(params)
+        ids = self._passage(trial, params)
+
+        space = self._param(params, 'space', 'pca')
+        if space not in ('pca', 'tfidf'):
+            raise QueryError(400, 'Unknown space {}'.format(space))
+
+        matches = trial.nearest([ids], self._count(params, 'k', '10'), space,
+                                self._param(params, 'other', '0') == '1')[0]
+        self._json({'matches': [dict(sampleInfo(trial, i), similarity=sim)
+                                for i, sim in matches]})
+
+
+    def get_plot(self, params):
+        trial = self._trial(params)
+        fmt = self._param(params, 'format', 'png')
+        if fmt not in ('png', 'pdf', 'svg'):
+            raise QueryError(400, 'Unknown format {}'.format(fmt))
+
+        # check what to draw before taking the plot lock
+        if 'start' in params:
+            self._passage(trial, params)
+        elif 'author' in params and params['author'] not in trial.manifest['authors']:
+            raise QueryError(404, 'No author {}'.format(params['author']))
+
+        buf = io.BytesIO()
+        with self.server.plot_lock:
+            # render off-screen; must precede the first pyplot import
+            import matplotlib
+            matplotlib.use('Agg')
+            from matplotlib import pyplot
+
+            if 'start' in params:
+                fig = trial.tracePassage(self._param(params, 'author'),
+                                         params['start'], self._param(params, 'stop'))
+            elif 'author' in params:
+                fig = trial.plotAuthor(params['author'], corpus=True)
+            else:
+                fig = basePlot(xs=trial.pca[:,0], ys=trial.pca[:,1],
+                    labels=trial.authors, colors=COLORS, title=trial.LABEL)
+            fig.savefig(buf, format=fmt)
+            pyplot.close(fig)
+
+        content_type = {'png': 'image/png', 'pdf': 'application/pdf',
+                        'svg': 'image/svg+xml'}[fmt]
+        self._send(200, buf.getvalue(), content_type)
+
+
+    def get__stats(self, params):
+        self._json(self.server.getStats())
+
+
+    def _json(self, data, status=200):
+        self._send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+
+    def _send(self, status, body, content_type):
+        '''Write a complete response'''
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('{} {}\n'.format(self.address_string(), format % args))
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Serve trial queries and plots from memory, on localhost'
+    )
+    parser.add_argument('--port',
+        metavar='PORT', type=int, default=8766,
+        help='port to listen on, on localhost; default 8766')
+    parser.add_argument('--cache',
+        metavar='N', type=int, default=4,
+        help='keep up to N trials loaded; default 4')
+    parser.add_argument('--preload',
+        metavar='TRIAL', type=str, nargs='*', default=[],
+        help='trials to load before serving')
+    parser.add_argument('--quiet',
+        action='store_true',
+        help="don't log requests")
+
+    args = parser.parse_args()
+
+    server = TrialServer(('127.0.0.1', args.port), args.cache, verbose=not args.quiet)
+    for label in args.preload:
+        server.cache.get(label)
+
+    print('Serving trials from {} at {}'.format(os.path.join(Config.DATA, 'cache'), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+        print(json.dumps(server.getStats()))
@@ -13,46 +13,324 @@ import shutil
 import json
 import argparse
 import sys
-from lxml import etree
-
-from MyCapytain.resolvers.cts.api import HttpCtsResolver
-from MyCapytain.retrievers.cts5 import HttpCtsRetriever
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from mta_summer_2018 import Config, Text
+from mta_summer_2018 import Config, Text, hashFile, saveJson
+from mta_summer_2018 import Stage, addMetricsArgs, startMetrics
 
 #
 # functions
 #
 
-def retrieveXML(resolver, text, dest):
+class RateLimiter(object):
+    '''Space out calls from any number of threads to at most RATE per second'''
+
+    def __init__(self, rate=None):
+        self.interval = 1. / rate if rate else 0.
+        self.next = 0.
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        '''Block until this caller's slot comes up'''
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class NotModified(Exception):
+    '''The server says our copy of a passage is current'''
+
+
+def makeRetriever(endpoint, retries=4, backoff=1., rate=None, timeout=60):
+    '''A CtsRetriever for ENDPOINT
+
+    The class is defined here, rather than at the top level, so that
+    MyCapytain and requests are only imported when something is downloaded.
+    '''
+    from MyCapytain.retrievers.cts5 import HttpCtsRetriever
+
+    class CtsRetriever(HttpCtsRetriever):
+        '''CTS retriever that retries failed requests with exponential backoff
+
+        Connection errors, timeouts, 429 and 5xx responses are retried up to
+        RETRIES times, waiting BACKOFF * 2^attempt seconds (with jitter) in
+        between. All requests through one retriever share a rate limit.
+
+        Requests for a URN with an entry in `validators` are sent as
+        conditional requests; a 304 reply raises NotModified. The ETag and
+        Last-Modified headers of each reply are kept in `received`.
+        '''
+
+        RETRY_STATUS = (429, 500, 502, 503, 504)
+
+        def __init__(self, endpoint, retries=4, backoff=1., rate=None, timeout=60):
+            super(CtsRetriever, self).__init__(endpoint)
+            self.retries = retries
+            self.backoff = backoff
+            self.timeout = timeout
+            self.limiter = RateLimiter(rate)
+            self.validators = dict()
+            self.received = dict()
+
+
+        def call(self, parameters):
+            '''Send one CTS request, retrying transient failures'''
+            import requests
+
+            parameters = {
+                key: str(parameters[key]) for key in parameters if parameters[key] is not None
+            }
+
+            # conditional request headers, if we have a copy already
+            urn = parameters.get('urn')
+            headers = dict()
+            validators = self.validators.get(urn, dict())
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+            for attempt in range(self.retries + 1):
+                self.limiter.wait()
+                try:
+                    response = requests.get(self.endpoint, params=parameters,
+                                            headers=headers, timeout=self.timeout)
+                    if response.status_code == 304:
+                        raise NotModified(urn)
+                    if response.status_code not in self.RETRY_STATUS:
+                        response.raise_for_status()
+                        if response.encoding is None:
+                            response.encoding = 'utf-8'
+                        self.received[urn] = {
+                            'etag': response.headers.get('ETag'),
+                            'last_modified': response.headers.get('Last-Modified'),
+                        }
+                        return response.text
+                    error = 'HTTP {}'.format(response.status_code)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e.__class__.__name__
+
+                if attempt == self.retries:
+                    raise IOError('{} {} failed after {} attempts: {}'.format(
+                        parameters.get('request'), parameters.get('urn'),
+                        attempt + 1, error))
+
+                delay = self.backoff * 2 ** attempt * random.uniform(.5, 1.5)
+                print(' - {} for {}; retrying in {:.1f}s'.format(
+                    error, parameters.get('urn'), delay))
+                time.sleep(delay)
+
+    return CtsRetriever(endpoint, retries, backoff, rate, timeout)
+
+
+class DownloadManifest(object):
+    '''Record of downloaded texts and books, saved as JSON after each change
+
+    For each author: the text URN, its list of book references, and for
+    each book the local file name, content hash and HTTP validators.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.texts = dict()
+
+        if os.path.exists(file):
+            with open(file) as f:
+                self.texts = json.load(f)
+
+
+    def reffs(self, text):
+        '''Book references recorded for a text, or None'''
+
+        rec = self.texts.get(text.author)
+        if rec is not None and rec['urn'] == text.urn:
+            return rec['reffs']
+
+
+    def setReffs(self, text, reffs):
+        '''Record a text's book references'''
+
+        with self.lock:
+            rec = self.texts.get(text.author)
+            if rec is None or rec['urn'] != text.urn:
+                rec = {'urn': text.urn, 'books': dict()}
+                self.texts[text.author] = rec
+            rec['title'] = text.title
+            rec['reffs'] = reffs
+            self._save()
+
+
+    def book(self, text, book):
+        '''Record for one book, or None'''
+
+        rec = self.texts.get(text.author)
+        if rec is not None and rec['urn'] == text.urn:
+            return rec['books'].get(book)
+
+
+    def setBook(self, text, book, rec):
+        '''Record one downloaded book'''
+
+        with self.lock:
+            self.texts[text.author]['books'][book] = rec
+            self._save()
+
+
+    def _save(self):
+        saveJson(self.texts, self.file, indent=1)
+
+
+def listBooks(resolver, text, manifest=None, refresh=False):
+    '''Get references to the books of a remote work'''
+
+    # use the list from the last run unless refreshing
+    if manifest is not None and not refresh:
+        reffs = manifest.reffs(text)
+        if reffs is not None:
+            return reffs
+
+    #  (all our texts are of `book.line` format)
+    reffs = [str(book) for book in resolver.getReffs(text.urn)]
+
+    if manifest is not None:
+        manifest.setReffs(text, reffs)
+
+    return reffs
+
+
+def fetchBook(resolver, text, i, book, dest, manifest=None, refresh=False):
+    '''Download one book and save it as local xml, unless we have it already
+
+    With a manifest, a book whose local file still matches its recorded
+    hash is skipped; with REFRESH it is requested again, conditionally
+    if the server gave us validators, and only rewritten if it changed.
+    '''
+
+    filename = os.path.join(dest, '{i:02d}_{urn}-{book}.xml'.format(
+        i=i, urn=text.author, book=book))
+    urn = '{}:{}'.format(text.urn, book)
+    retriever = resolver.endpoint
+
+    # check our copy, which may be under an older name if books were added
+    rec = None
+    if manifest is not None:
+        rec = manifest.book(text, book)
+    if rec is not None:
+        old_file = os.path.join(dest, rec['file'])
+        if os.path.exists(old_file) and hashFile(old_file) == rec['hash']:
+            if old_file != filename:
+                os.rename(old_file, filename)
+        else:
+            rec = None
+
+    if rec is not None and not refresh:
+        return filename
+
+    if rec is not None:
+        retriever.validators[urn] = rec.get('validators', dict())
+    try:
+        ctsPassage = resolver.getTextualNode(text.urn, subreference=book)
+    except NotModified:
+        print(' - {} not modified'.format(filename))
+        return filename
+    finally:
+        retriever.validators.pop(urn, None)
+
+    # extract xml and save
+    from lxml import etree
+    xml = ctsPassage.export('python/lxml')
+    data = etree.tostring(xml, encoding = 'utf-8', pretty_print = True)
+    digest = hashlib.sha1(data).hexdigest()
+
+    if rec is not None and rec['hash'] == digest:
+        print(' - {} unchanged'.format(filename))
+    else:
+        print(' - saving to {}'.format(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    if manifest is not None:
+        manifest.setBook(text, book, {
+            'file': os.path.basename(filename),
+            'hash': digest,
+            'validators': retriever.received.pop(urn, dict()),
+        })
+
+    return filename
+
+
+def pruneBooks(dest, keep):
+    '''Delete xml files in DEST that are not in KEEP'''
+
+    keep = set(os.path.basename(f) for f in keep)
+
+    for file in os.listdir(dest):
+        if file.endswith('.xml') and file not in keep:
+            print(' - removing stale {}'.format(file))
+            os.remove(os.path.join(dest, file))
+
+
+def retrieveXML(resolver, text, dest, manifest=None, refresh=False):
     '''Download a remote work and save individual books as local xml'''
 
     print('Downloading {} {}'.format(text.author, text.title))
-    
+
     if not os.path.exists(dest):
         os.mkdir(dest)
-    
+
     # Get references to books
-    #  (all our texts are of `book.line` format)
-    books = resolver.getReffs(text.urn)
+    books = listBooks(resolver, text, manifest, refresh)
 
     # download one book at a time
+    files = []
     for i, book in enumerate(books):
 
-        print(" - fetching book {}/{}".format(i+1, len(books)))
-        ctsPassage = resolver.getTextualNode(text.urn, subreference=book)
+        print(" - checking book {}/{}".format(i+1, len(books)))
+        files.append(fetchBook(resolver, text, i, book, dest, manifest, refresh))
+
+    pruneBooks(dest, files)
+
+
+def retrieveAll(resolver, corpus, dest, workers=4, manifest=None, refresh=False):
+    '''Download all works, fetching up to WORKERS books at once'''
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        # Get references to books of every text
+        print('Listing books of {} texts'.format(len(corpus)))
+        book_lists = list(pool.map(
+            lambda text: listBooks(resolver, text, manifest, refresh), corpus))
+
+        # queue every book of every text
+        jobs = []
+        for text, books in zip(corpus, book_lists):
+            print(' - {} {}: {} books'.format(text.author, text.title, len(books)))
+            text_dest = os.path.join(dest, text.author)
+            if not os.path.exists(text_dest):
+                os.mkdir(text_dest)
+            jobs.append([pool.submit(fetchBook, resolver, text, i, book,
+                                     text_dest, manifest, refresh)
+                         for i, book in enumerate(books)])
+
+        # wait for all, re-raising the first failure
+        for text, text_jobs in zip(corpus, jobs):
+            files = [job.result() for job in text_jobs]
+            pruneBooks(os.path.join(dest, text.author), files)
+
+    return sum(len(books) for books in book_lists)
 
-        # extract xml and save
-        xml = ctsPassage.export('python/lxml')
-        
-        filename = os.path.join(dest, '{i:02d}_{urn}-{book}.xml'.format(
-            i=i, urn=text.author, book=book))
-        
-        print(' - saving to {}'.format(filename))
-        with open(filename, 'wb') as f:
-            f.write(etree.tostring(xml, encoding = 'utf-8', pretty_print = True))
-    
 #
 # Main
 #
@@ -71,25 +349,60 @@ if __name__ == '__main__':
     parser.add_argument('--corpus', 
         metavar="DIR", default=Config.DATA,
         help='local corpus directory')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='download up to N books at once; default 1 (one at a time)')
+    parser.add_argument('--retries',
+        metavar='N', type=int, default=4,
+        help='retries per request on network or server errors; default 4')
+    parser.add_argument('--backoff',
+        metavar='SEC', type=float, default=1.,
+        help='initial retry delay, doubled on each attempt; default 1')
+    parser.add_argument('--rate',
+        metavar='REQ', type=float, default=None,
+        help='at most REQ requests per second to the server; default no limit')
+    parser.add_argument('--refresh',
+        action='store_true',
+        help='check books we already have for upstream changes')
+    parser.add_argument('--clean',
+        action='store_true',
+        help='delete all local xml and download everything again')
+    addMetricsArgs(parser)
 
     args = parser.parse_args()
+    startMetrics(args)
 
-    # clean destination directory
+    # clean destination directory only on request
     dest = os.path.join(args.corpus, 'xml')
-    if os.path.exists(dest):
+    if args.clean and os.path.exists(dest):
         shutil.rmtree(dest)
+    if not os.path.exists(dest):
         os.makedirs(dest)
-    else:
-        os.makedirs(dest)
+
+    # what we downloaded last time
+    manifest = DownloadManifest(os.path.join(dest, 'manifest.json'))
 
     # Read the corpus metadata
     with open(args.index) as f:
         corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
     
     # Create a Resolver instance
-    resolver = HttpCtsResolver(HttpCtsRetriever(args.server))
-    
-    for text in corpus:
-        retrieveXML(resolver, text, os.path.join(dest, text.author))
-        print()
-    
\ No newline at end of file
+    from MyCapytain.resolvers.cts.api import HttpCtsResolver
+    retriever = makeRetriever(args.server, retries=args.retries,
+                              backoff=args.backoff, rate=args.rate)
+    resolver = HttpCtsResolver(retriever)
+
+    with Stage('download', total=len(corpus), unit='texts') as stage:
+        if args.workers > 1:
+            n = retrieveAll(resolver, corpus, dest, args.workers, manifest,
+                            args.refresh)
+            print('Checked {} books'.format(n))
+            stage.add(len(corpus))
+            stage.add(n, 'books')
+        else:
+            for text in corpus:
+                with Stage(text.author):
+                    retrieveXML(resolver, text, os.path.join(dest, text.author),
+                                manifest, args.refresh)
+                stage.add()
+                print()
@@ -11,42 +11,94 @@ import shutil
 import json
 import argparse
 import sys
+import multiprocessing
 from lxml import etree
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from mta_summer_2018 import Config, Text
+from mta_summer_2018 import Config, Text, Stage, addMetricsArgs, startMetrics
 
 
 #
 # functions
 #
     
-#takes xml file as an argument    
+# TEI element names
+TEI_NS = '{http://www.tei-c.org/ns/1.0}'
+TEI_DIV = TEI_NS + 'div'
+TEI_L = TEI_NS + 'l'
+TEI_NOTE = TEI_NS + 'note'
+
+# compiled once, reused for every line
+lineText = etree.XPath('string()')
+
+#takes xml file as an argument
 def parseXML(xmlFile):
-    '''Parse a local xml file'''
-    
-    xml = etree.parse(xmlFile).getroot()
-    lines = []
-    
-    # get the number of the enclosing book
-    # FIXME: make this more elegant
-    book_n = 0
-    book_xpath='.//{http://www.tei-c.org/ns/1.0}div[@type="textpart" and @subtype="book"]'
-    bookFinder = etree.ETXPath(book_xpath)
-    book_list = bookFinder(xml)
-    if len(book_list) > 0:
-        book_n = book_list[0].get('n', 0)
-    
-    for l in xml.iter('{http://www.tei-c.org/ns/1.0}l'):
-        for note in l.iter('{http://www.tei-c.org/ns/1.0}note'):
+    '''Parse a local xml file, streaming its verse lines
+
+    Each <l> is handled as soon as it has been read, then freed along
+    with everything before it, so memory stays flat however large the
+    file.
+    '''
+
+    # number of the first book div in the document
+    book_n = None
+    verses = []
+
+    for event, elem in etree.iterparse(xmlFile, events=('start', 'end'),
+                                       tag=(TEI_DIV, TEI_L)):
+
+        if elem.tag == TEI_DIV:
+            if event == 'start' and book_n is None and \
+                    elem.get('type') == 'textpart' and elem.get('subtype') == 'book':
+                book_n = elem.get('n', 0)
+            continue
+
+        if event != 'end':
+            continue
+
+        # drop notes, keeping the text that follows them
+        for note in elem.iter(TEI_NOTE):
             tail = note.tail
             note.clear()
             note.tail = tail
-        line_n = l.get('n')
-        lines.append(('{}.{}'.format(book_n, line_n), l.xpath('string()').strip()))
+        verses.append((elem.get('n'), lineText(elem).strip()))
+
+        # free this line and its finished predecessors
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+    if book_n is None:
+        book_n = 0
+
+    return [('{}.{}'.format(book_n, line_n), verse) for line_n, verse in verses]
+
+
+def xmlFiles(source):
+    '''The XML files of one text, in order'''
+
+    return [os.path.join(source, f) for f in sorted(os.listdir(source))
+            if f.endswith('.xml')]
+
+
+def saveLines(lines, line_file):
+    '''Write a text's (locus, verse) pairs to LINE_FILE'''
+
+    with open(line_file, 'w') as f:
+        json.dump(lines, f, indent=1)
+
+
+def extractText(source, line_file):
+    '''Parse every XML file of one text and save its lines; return how many'''
+
+    lines = []
+    for file in xmlFiles(source):
+        lines.extend(parseXML(file))
+    saveLines(lines, line_file)
+
+    return len(lines)
 
-    return lines
-    
 #
 # main
 #
@@ -62,8 +114,13 @@ if __name__ == '__main__':
     parser.add_argument('--corpus', 
         metavar="DIR", default=Config.DATA,
         help='local corpus directory')
+    parser.add_argument('--workers',
+        metavar='N', type=int, default=1,
+        help='parse files in N parallel processes; default 1')
+    addMetricsArgs(parser)
 
     args = parser.parse_args()
+    startMetrics(args)
 
     # clean destination directory
     dest = os.path.join(args.corpus, 'lines')
@@ -77,23 +134,40 @@ if __name__ == '__main__':
     with open(args.index) as f:
         corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
     
-    # process the texts
+    # list every file of every text
+    jobs = []
     for text in corpus:
-        print('Processing {} {}'.format(text.author, text.title))
+        jobs.append(xmlFiles(os.path.join(args.corpus, 'xml', text.author)))
+
+    # parse the files, in order, in one pool for all texts
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(parseXML, [f for files in jobs for f in files])
+    else:
+        pool = None
+        results = (parseXML(f) for files in jobs for f in files)
+
+    # process the texts
+    with Stage('extract', unit='lines') as run:
+        for text, files in zip(corpus, jobs):
+            print('Processing {} {}'.format(text.author, text.title))
 
-        source = os.path.join(args.corpus, 'xml', text.author)
+            with Stage(text.author, total=len(files), unit='files') as stage:
+                all_lines = []
 
-        xml_files = [f for f in os.listdir(source) if f.endswith('.xml')]
-        all_lines = []
+                for i in range(len(files)):
+                    print(' - reading part {}/{}'.format(i, len(files)))
+                    lines = next(results)
+                    all_lines.extend(lines)
+                    stage.add()
+                    stage.add(len(lines), 'lines')
+                    run.add(len(lines))
 
-        for i, file in enumerate(sorted(xml_files)):
-            print(' - reading part {}/{}'.format(i, len(xml_files)))
-            lines = parseXML(os.path.join(source, file))
-            all_lines.extend(lines)
+                # save verse lines
+                line_file = os.path.join(dest, text.author + '.json')
+                print(' - saving {}'.format(line_file))
+                saveLines(all_lines, line_file)
 
-        # save verse lines
-        line_file = os.path.join(dest, text.author + '.json')
-        print(' - saving {}'.format(line_file))
-        with open(line_file, 'w') as f:
-            json.dump(all_lines, f, indent=1)
-        
+    if pool is not None:
+        pool.close()
+        pool.join()
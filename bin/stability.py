@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+''' Compare the PCA spaces of trials by Procrustes alignment
+'''
+
+#
+# import statements
+#
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from mta_summer_2018 import Stage, addMetricsArgs, startMetrics
+from plot import TrialSet, procrustesDisparity
+
+import numpy as np
+
+#
+# functions
+#
+
+def printMatrix(labels, disparity):
+    '''Print the disparity matrix, rows and columns numbered by trial'''
+
+    width = max(len(l) for l in labels)
+    print(' ' * (width + 5) + ''.join('{:>7d}'.format(i) for i in range(len(labels))))
+    for i, (label, row) in enumerate(zip(labels, disparity)):
+        print('{:>3d}  {}'.format(i, label.ljust(width)) +
+              ''.join('{:>7.3f}'.format(d) for d in row))
+
+
+def printSummary(labels, disparity):
+    '''Print each trial's mean disparity to the others, most stable first'''
+
+    n = len(labels)
+    mean = disparity.sum(axis=1) / max(n - 1, 1)
+    width = max(len(l) for l in labels)
+
+    print('{}  {:>9}'.format('trial'.ljust(width), 'mean'))
+    for i in np.argsort(mean):
+        print('{}  {:>9.4f}'.format(labels[i].ljust(width), mean[i]))
+
+
+def writeMatrix(file, labels, disparity):
+    '''Write the disparity matrix as a TSV'''
+
+    with open(file, 'w') as f:
+        f.write('\t'.join(['trial'] + labels) + '\n')
+        for label, row in zip(labels, disparity):
+            f.write('\t'.join([label] + ['{:.6f}'.format(d) for d in row]) + '\n')
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Measure how much the PCA space changes between trials, e.g. across sample sizes or offsets'
+    )
+    parser.add_argument('trials',
+        nargs='+',
+        help='Trials to compare; shell-style patterns such as "lemmata-*" match cached trials.')
+    parser.add_argument('--components',
+        metavar='N', type=int, default=None,
+        help='Compare the first N principal components. Default all that every trial has.')
+    parser.add_argument('--stride',
+        metavar='N', type=int, default=1,
+        help='Align on every Nth shared line only. Default 1 (all lines).')
+    parser.add_argument('--budget',
+        metavar='MB', type=float, default=1024,
+        help='Keep loaded trials under MB megabytes. Default 1024.')
+    parser.add_argument('--out',
+        metavar='FILE', type=str, default=None,
+        help='Also write the disparity matrix to FILE as a TSV.')
+    addMetricsArgs(parser)
+
+    args = parser.parse_args()
+    startMetrics(args)
+
+    trials = TrialSet(args.trials, args.budget)
+    print('Aligning {} trials'.format(len(trials)))
+
+    with Stage('align', total=len(trials), unit='trials') as stage:
+        keys, coords = trials.anchorCoordinates(npcs=args.components, stride=args.stride)
+        stage.add(len(trials))
+        stage.add(len(keys), 'lines')
+    print('{} shared lines, {} components'.format(coords.shape[1], coords.shape[2]))
+
+    with Stage('procrustes', unit='pairs') as stage:
+        disparity = procrustesDisparity(coords)
+        stage.add(len(trials) ** 2)
+
+    printMatrix(trials.labels, disparity)
+    print()
+    printSummary(trials.labels, disparity)
+
+    if args.out is not None:
+        print('Writing disparities to {}'.format(args.out))
+        writeMatrix(args.out, trials.labels, disparity)
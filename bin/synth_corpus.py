@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''Generate a synthetic Latin-like corpus
+
+   Writes TEI books shaped like the downloaded CTS passages, for six
+   "epics" the size of ours times a scale factor, along with a corpus
+   index and a list of labelled test passages. Word forms are built from
+   random stems and Latin endings and drawn with Zipfian frequencies, so
+   tokenizing, lemmatizing and sampling behave much as on the real texts.
+'''
+
+#
+# import statements
+#
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+#
+# global values
+#
+
+# author, title, books, lines, as in conf/corpus.json
+EPICS = [
+    ('vergil', 'aeneid', 12, 9896),
+    ('ovid', 'metamorphoses', 15, 11995),
+    ('lucan', 'bellum_civile', 10, 8060),
+    ('silius_italicus', 'punica', 17, 12202),
+    ('valerius_flaccus', 'argonautica', 8, 5593),
+    ('statius', 'thebaid', 12, 9748),
+]
+
+ONSETS = ['', 'b', 'c', 'd', 'f', 'g', 'l', 'm', 'n', 'p', 'qu', 'r', 's', 't',
+          'u', 'cl', 'cr', 'pr', 'tr', 'st', 'fl', 'gr']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'ae', 'au']
+ENDINGS = ['a', 'ae', 'am', 'arum', 'as', 'is', 'us', 'i', 'o', 'um', 'orum',
+           'os', 'em', 'es', 'ibus', 'e', 'ere', 'it', 'unt', 'at', 'ant',
+           'auit', 'entem', 'ebat', 'isse']
+ENCLITICS = ['que', 'ne', 'ue']
+PUNCT = [',', ',', '.', ';', ':', '?', '!']
+
+TAGS = ['Bataille', 'Tempête']
+
+TEI_HEAD = '''<GetPassage xmlns="http://chs.harvard.edu/xmlns/cts">
+  <request>
+    <requestName>GetPassage</requestName>
+    <requestUrn>{urn}:{book}</requestUrn>
+  </request>
+  <reply>
+    <urn>{urn}:{book}</urn>
+    <passage>
+      <TEI xmlns="http://www.tei-c.org/ns/1.0">
+        <text>
+          <body>
+            <div type="edition" n="{urn}" xml:lang="lat">
+              <div type="textpart" subtype="book" n="{book}">
+'''
+
+TEI_TAIL = '''              </div>
+            </div>
+          </body>
+        </text>
+      </TEI>
+    </passage>
+  </reply>
+</GetPassage>
+'''
+
+#
+# functions
+#
+
+def makeVocab(rng, n_stems=6000):
+    '''Word forms as stem + ending, and their Zipfian draw probabilities'''
+
+    stems = set()
+    while len(stems) < n_stems:
+        syllables = rng.integers(1, 4)
+        stems.add(''.join(rng.choice(ONSETS) + rng.choice(VOWELS)
+                          for _ in range(syllables)) + rng.choice(['', 'r', 'n', 'c', 't', 'l']))
+    stems = sorted(stems)
+
+    forms = []
+    for stem in stems:
+        for ending in rng.choice(ENDINGS, size=rng.integers(2, 8), replace=False):
+            forms.append(stem + ending)
+    forms = np.array(forms)
+    rng.shuffle(forms)
+
+    weights = 1. / np.arange(1, len(forms) + 1) ** 1.07
+
+    return forms, weights / weights.sum()
+
+
+def makeBook(rng, forms, probs, n_lines):
+    '''Verse lines of one book, as TEI <l> elements'''
+
+    lengths = rng.integers(5, 10, size=n_lines)
+    words = forms[rng.choice(len(forms), size=lengths.sum(), p=probs)]
+    ends = np.cumsum(lengths)
+
+    lines = []
+    for i, (start, stop) in enumerate(zip(ends - lengths, ends)):
+        verse = list(words[start:stop])
+        if rng.random() < .15:
+            j = rng.integers(len(verse))
+            verse[j] += rng.choice(ENCLITICS)
+        if rng.random() < .1:
+            verse[0] = verse[0].capitalize()
+        if rng.random() < .4:
+            verse[-1] += rng.choice(PUNCT)
+        text = ' '.join(verse)
+        if rng.random() < .01:
+            text += '<note type="crit">{}</note>'.format(rng.choice(forms))
+        lines.append('                <l n="{}">{}</l>\n'.format(i + 1, text))
+
+    return lines
+
+
+def makeCorpus(dest, scale=1., seed=0, n_bench=40):
+    '''Write a synthetic corpus under DEST; return its index and size'''
+
+    rng = np.random.default_rng(seed)
+    forms, probs = makeVocab(rng)
+
+    index = []
+    bench = []
+    total = 0
+
+    for author, title, n_books, n_lines in EPICS:
+        urn = 'urn:cts:latinLit:synth.{}.synth-lat1'.format(author)
+        index.append({'author': author, 'title': title, 'lang': 'latin',
+                      'cts_urn': urn})
+        print('Writing {} {}'.format(author, title))
+
+        xml_dir = os.path.join(dest, 'xml', author)
+        if not os.path.exists(xml_dir):
+            os.makedirs(xml_dir)
+
+        per_book = max(1, int(round(n_lines * scale / n_books)))
+        for i in range(n_books):
+            book = str(i + 1)
+            filename = os.path.join(xml_dir, '{i:02d}_{a}-{b}.xml'.format(
+                i=i, a=author, b=book))
+            with open(filename, 'w') as f:
+                f.write(TEI_HEAD.format(urn=urn, book=book))
+                f.writelines(makeBook(rng, forms, probs, per_book))
+                f.write(TEI_TAIL)
+        total += per_book * n_books
+
+        # labelled passages of 20 to 150 lines
+        for _ in range(n_bench // len(EPICS)):
+            book = rng.integers(1, n_books + 1)
+            length = int(rng.integers(20, 151))
+            start = int(rng.integers(1, max(2, per_book - length)))
+            stop = min(per_book, start + length)
+            bench.append('{}\t{}.{}\t{}.{}\t{}\n'.format(
+                author, book, start, book, stop, rng.choice(TAGS)))
+
+    with open(os.path.join(dest, 'corpus.json'), 'w') as f:
+        json.dump(index, f, indent='\t')
+    with open(os.path.join(dest, 'bench.txt'), 'w') as f:
+        f.writelines(bench)
+
+    return index, total
+
+#
+# main
+#
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Latin-like corpus'
+    )
+    parser.add_argument('--dest',
+        metavar='DIR', type=str, default=os.path.join('data', 'synth'),
+        help='output directory; default data/synth')
+    parser.add_argument('--scale',
+        metavar='X', type=float, default=1.,
+        help='size relative to the six real epics; default 1')
+    parser.add_argument('--seed',
+        metavar='N', type=int, default=0,
+        help='random seed; default 0')
+
+    args = parser.parse_args()
+
+    index, total = makeCorpus(args.dest, args.scale, args.seed)
+    print('Wrote {} lines in {} texts to {}'.format(total, len(index), args.dest))
@@ -0,0 +1,6 @@
+'''Make the bin/ scripts importable as modules'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'bin'))
@@ -0,0 +1,62 @@
+'''Tests for setup_1.dl_texts.py, against the fake CTS server'''
+
+import os
+import json
+import glob
+
+import pytest
+
+from mta_summer_2018 import Text, loadScript
+from fake_cts import FakeCtsServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                        'conf', 'fixtures')
+
+
+@pytest.fixture
+def server():
+    '''Fake CTS server failing the first attempt at every request'''
+
+    server = FakeCtsServer(responses=os.path.join(FIXTURES, 'cts'), fail_first=1)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_retrieve_all(server, tmp_path):
+    '''Parallel download retries the failures, then --refresh gets 304s'''
+
+    dl = loadScript('dl_texts', 'setup_1.dl_texts.py')
+    extract = loadScript('extract_texts', 'setup_2.extract_texts.py')
+    from MyCapytain.resolvers.cts.api import HttpCtsResolver
+
+    with open(os.path.join(FIXTURES, 'corpus.json')) as f:
+        corpus = [Text.metaFromDict(rec) for rec in json.load(f)]
+    dest = str(tmp_path)
+    manifest = dl.DownloadManifest(os.path.join(dest, 'manifest.json'))
+    resolver = HttpCtsResolver(dl.makeRetriever(server.url, backoff=.01))
+
+    n = dl.retrieveAll(resolver, corpus, dest, 4, manifest)
+
+    # one failed and one good attempt at every listing and book
+    books = glob.glob(os.path.join(FIXTURES, 'cts', 'GetPassage__*.xml'))
+    reffs = glob.glob(os.path.join(FIXTURES, 'cts', 'GetValidReff__*.xml'))
+    assert n == len(books)
+    assert server.stats['failed'] == len(books) + len(reffs)
+    assert server.stats['served'] == len(books) + len(reffs)
+
+    # every book saved, with the verses of the recorded passage
+    for text in corpus:
+        files = extract.xmlFiles(os.path.join(dest, text.author))
+        urn = text.urn.replace(':', '_')
+        recorded = sorted(f for f in books if urn + '_' in f)
+        assert len(files) == len(recorded)
+        for file, response in zip(files, recorded):
+            assert extract.parseXML(file) == extract.parseXML(response)
+
+    # nothing changed upstream, so every book is answered with a 304
+    before = {f: os.path.getmtime(f) for f in glob.glob(os.path.join(dest, '*', '*.xml'))}
+    dl.retrieveAll(resolver, corpus, dest, 4, manifest, refresh=True)
+
+    assert server.stats['not_modified'] == len(books)
+    assert {f: os.path.getmtime(f) for f in before} == before
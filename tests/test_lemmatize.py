@@ -0,0 +1,26 @@
+'''Tests for lemmatize.py'''
+
+import lemmatize
+
+
+def test_contractions_only_whole_words():
+    '''Contractions are expanded as words, never inside other words'''
+
+    tokens = lemmatize.tableTokenize(['fascinat consultis discinctus mecum',
+                                      'Sodes, scin quid velim?'])
+
+    assert tokens == [['fascinat', 'consultis', 'discinctus', 'cum', 'me'],
+                      ['si', 'audes', 'scis', 'ne', 'quid', 'velim']]
+
+
+def test_checkpoint_skips_interrupted_lines(tmp_path):
+    '''Chunks before and after a half-written line are all resumed'''
+
+    file = str(tmp_path / 'author.jsonl')
+    with open(file, 'w') as f:
+        f.write('{"a": [["arma", "arma"]]}\n{"b": [["vir')
+        f.write('\n{"c": [["cano", "cano"]]}\n')
+
+    assert lemmatize.loadCheckpoint(file) == {'a': [['arma', 'arma']],
+                                              'c': [['cano', 'cano']]}
+    assert lemmatize.loadCheckpoint(str(tmp_path / 'missing.jsonl')) == {}
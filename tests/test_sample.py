@@ -0,0 +1,58 @@
+'''Tests for sample.py'''
+
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn import decomposition
+
+import sample
+
+
+def test_sparse_pca_matches_dense():
+    '''Truncated SVD of the sparse matrix gives the dense PCA, signs included'''
+
+    m = sparse.random(300, 200, density=0.05, format='csr', random_state=0)
+    k = 10
+
+    pca, model = sample.sparsePCA(m, k)
+
+    dense = decomposition.PCA(n_components=k)
+    expected = dense.fit_transform(m.toarray())
+
+    assert np.allclose(pca, expected, atol=1e-8)
+    assert np.allclose(model['pca_components'], dense.components_, atol=1e-8)
+    assert np.allclose(model['pca_variance'], dense.explained_variance_)
+    assert np.allclose(model['pca_variance_ratio'], dense.explained_variance_ratio_)
+
+
+def test_chunk_bounds_fold_short_last_chunk():
+    '''Every chunk has at least MINIMUM rows, and together they cover all N'''
+
+    for n in (10, 25, 373, 400):
+        bounds = sample.chunkBounds(n, 10, 10)
+
+        assert bounds[0][0] == 0 and bounds[-1][1] == n
+        assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+        assert all(stop - start >= 10 for start, stop in bounds)
+
+
+def test_stream_features_writes_trial_files(tmp_path):
+    '''Streamed TF-IDF and PCA land on disk, equal to the whole-matrix results'''
+    import gensim
+
+    rng = np.random.RandomState(0)
+    vecs = [[(int(t), int(rng.randint(1, 4))) for t in sorted(rng.choice(50, 8, replace=False))]
+            for i in range(43)]
+
+    model = sample.streamFeatures(vecs, 50, str(tmp_path), npcs=3, chunk=10)
+
+    tfidf = gensim.models.TfidfModel(vecs)[vecs]
+    expected = gensim.matutils.corpus2dense(tfidf, num_terms=50).transpose()
+    m = sparse.load_npz(os.path.join(str(tmp_path), 'tfidf.npz'))
+    assert np.allclose(m.toarray(), expected)
+
+    pca = np.load(os.path.join(str(tmp_path), 'pca.npy'))
+    centred = expected - expected.mean(axis=0)
+    assert np.allclose(pca, centred.dot(model['pca_components'].T), atol=1e-5)
+    assert sorted(os.listdir(str(tmp_path))) == ['pca.npy', 'tfidf.npz']
@@ -0,0 +1,99 @@
+'''Tests for serve.py, with a local client'''
+
+import json
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from mta_summer_2018 import Config, saveTrial
+from serve import TrialServer
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    '''Server over one small trial of two authors, three lines per sample'''
+
+    monkeypatch.setattr(Config, 'DATA', str(tmp_path))
+
+    authors = ['alpha'] * 4 + ['beta'] * 4
+    loci = [['1.{}'.format(3 * i + j + 1) for j in range(3)] for i in range(4)] * 2
+    rng = np.random.RandomState(0)
+    saveTrial(str(tmp_path / 'cache' / 'small'), authors, loci, rng.rand(8, 2),
+              tfidf=sparse.random(8, 20, density=0.5, format='csr', random_state=0),
+              meta={'label': 'small'})
+
+    server = TrialServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+def get(server, query):
+    '''Status, content type and body of one request'''
+
+    try:
+        with urlopen(server.url + query) as response:
+            return response.status, response.headers['Content-Type'], response.read()
+    except HTTPError as e:
+        return e.code, e.headers['Content-Type'], e.read()
+
+
+def getJson(server, query):
+    status, content_type, body = get(server, query)
+    assert content_type == 'application/json'
+    return status, json.loads(body.decode('utf-8'))
+
+
+def test_queries(server):
+    '''Each endpoint answers a good request'''
+
+    assert getJson(server, 'trials') == (200, {'trials': ['small']})
+
+    status, data = getJson(server, 'loc?trial=small&author=alpha&loc=1.5')
+    assert status == 200
+    assert (data['sample'], data['first'], data['last']) == (1, '1.4', '1.6')
+
+    status, data = getJson(server, 'passage?trial=small&author=beta&start=1.1&stop=1.6')
+    assert status == 200
+    assert [s['sample'] for s in data['samples']] == [4, 5]
+
+    status, data = getJson(server, 'neighbours?trial=small&author=alpha&start=1.1'
+                                   '&stop=1.3&k=2&other=1')
+    assert status == 200
+    assert len(data['matches']) == 2
+    assert all(m['author'] == 'beta' for m in data['matches'])
+
+    for query in ['plot?trial=small', 'plot?trial=small&author=beta',
+                  'plot?trial=small&author=alpha&start=1.1&stop=1.9']:
+        status, content_type, body = get(server, query)
+        assert (status, content_type) == (200, 'image/png')
+        assert body.startswith(b'\x89PNG')
+
+
+def test_bad_requests(server):
+    '''Bad input gets a 400, missing trials and passages a 404, never a 500'''
+
+    passage = 'trial=small&author=alpha&start=1.1&stop=1.3'
+    cases = [
+        ('trial?trial=nothing', 404),
+        ('loc?trial=small&author=alpha&loc=9.9', 404),
+        ('passage?trial=small&author=alpha&start=9.1&stop=9.3', 404),
+        ('passage?trial=small&author=alpha&start=1.1&stop=end', 404),
+        ('neighbours?' + passage + '&k=x', 400),
+        ('neighbours?' + passage + '&k=0', 400),
+        ('neighbours?' + passage + '&space=words', 400),
+        ('neighbours?trial=small&author=alpha', 400),
+        ('plot?trial=small&author=alpha&start=9.1&stop=9.3', 404),
+        ('plot?trial=small&author=nobody', 404),
+        ('plot?trial=small&format=gif', 400),
+        ('nothing', 404),
+    ]
+    for query, expected in cases:
+        status, data = getJson(server, query)
+        assert (query, status) == (query, expected)
+        assert 'error' in data
+
+    assert getJson(server, '_stats')[1]['errors'] == len(cases)